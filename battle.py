@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-import random
+import asyncio
 from dataclasses import dataclass, field
 from typing import Dict, Iterable, List, Optional, Sequence, Tuple
 
@@ -11,114 +11,15 @@ from discobot_modules.emoji_actions import Emoji_Action, ea_response
 
 from db import ITEMS
 
+from battle_engine import BattleEngine, BattleEvent, BattleParticipant, BattleSide, QueuedAction
+
+import battle_ai
 import classes
-import moves
 import embeds
 import users
 import economy
 
 
-@dataclass
-class BattleParticipant:
-    user_id: Optional[int]
-    name: str
-    party: Sequence[classes.Individual]
-
-
-@dataclass
-class QueuedAction:
-    kind: str
-    move: Optional[moves.Move] = None
-    switch_index: Optional[int] = None
-    item_key: Optional[str] = None
-    flee: bool = False
-
-
-@dataclass
-class BattlePokemonState:
-    individual: classes.Individual
-    current_hp: int = field(init=False)
-    status: Optional[str] = None
-    status_turns: int = 0
-    participated: bool = False
-
-    def __post_init__(self) -> None:
-        self.current_hp = self.individual.max_hp()
-
-    def max_hp(self) -> int:
-        return self.individual.max_hp()
-
-    def is_fainted(self) -> bool:
-        return self.current_hp <= 0
-
-    def apply_damage(self, amount: int) -> int:
-        amount = max(0, int(amount))
-        if amount <= 0:
-            return 0
-        self.current_hp = max(0, self.current_hp - amount)
-        return amount
-
-    def heal(self, amount: int) -> int:
-        amount = max(0, int(amount))
-        before = self.current_hp
-        self.current_hp = min(self.max_hp(), self.current_hp + amount)
-        return self.current_hp - before
-
-    def set_status(self, kind: Optional[str]) -> None:
-        if kind is None:
-            self.status = None
-            self.status_turns = 0
-            return
-        if kind == "sleep":
-            self.status = kind
-            self.status_turns = random.randint(1, 3)
-        else:
-            self.status = kind
-            self.status_turns = -1
-
-    def status_text(self) -> str:
-        if not self.status:
-            return ""
-        if self.status == "burn":
-            return "BRN"
-        if self.status == "paralysis":
-            return "PAR"
-        if self.status == "poison":
-            return "PSN"
-        if self.status == "sleep":
-            return "SLP"
-        return self.status.upper()
-
-
-@dataclass
-class BattleSide:
-    participant: BattleParticipant
-    team: List[BattlePokemonState]
-    active_index: int = 0
-    selection_mode: str = "menu"
-    queued_action: Optional[QueuedAction] = None
-
-    def active(self) -> BattlePokemonState:
-        return self.team[self.active_index]
-
-    def alive_indices(self) -> List[int]:
-        return [idx for idx, mon in enumerate(self.team) if not mon.is_fainted()]
-
-    def has_available_switch(self) -> bool:
-        return any(idx != self.active_index and not mon.is_fainted() for idx, mon in enumerate(self.team))
-
-    def force_next_available(self) -> bool:
-        for idx, mon in enumerate(self.team):
-            if idx == self.active_index:
-                continue
-            if not mon.is_fainted():
-                self.active_index = idx
-                self.selection_mode = "menu"
-                self.queued_action = None
-                return True
-        return False
-
-
 @dataclass
 class BattleResult:
     participants: Tuple[BattleParticipant, BattleParticipant]
@@ -143,25 +44,47 @@ class BattleSession:
         challenger: BattleParticipant,
         opponent: BattleParticipant,
         battle_type: str = "trainer",
+        ai_difficulty: str = battle_ai.DEFAULT_DIFFICULTY,
     ) -> None:
         self.channel = channel
-        self.participants = (challenger, opponent)
-        self.battle_type = battle_type
-        self.sides = [
-            BattleSide(challenger, [BattlePokemonState(mon) for mon in challenger.party]),
-            BattleSide(opponent, [BattlePokemonState(mon) for mon in opponent.party]),
-        ]
-        self.turn = 1
+        # The rules live in the engine; the session only talks to Discord.
+        self.engine = BattleEngine(challenger, opponent, battle_type)
+        self.ai_difficulty = ai_difficulty
+        # Held while a turn is being decided and resolved, since the AI may think for a while.
+        self.turn_lock = asyncio.Lock()
         self.log: List[str] = []
         self.message: Optional[discord.Message] = None
-        self.pending_actions: List[Optional[QueuedAction]] = [None, None]
-        self.selection_modes: List[str] = ["menu", "menu"]
         self.item_options: Dict[int, List[str]] = {0: [], 1: []}
         self.experience_log: Dict[int, List[str]] = {}
-        self.finished = False
-        self.winner: Optional[int] = None
         self.rewards: Dict[int, int] = {}
-        self.participation: List[set[int]] = [set(), set()]
+
+    @property
+    def participants(self) -> Tuple[BattleParticipant, BattleParticipant]:
+        return self.engine.participants
+
+    @property
+    def battle_type(self) -> str:
+        return self.engine.battle_type
+
+    @property
+    def sides(self) -> List[BattleSide]:
+        return self.engine.sides
+
+    @property
+    def turn(self) -> int:
+        return self.engine.turn
+
+    @property
+    def finished(self) -> bool:
+        return self.engine.finished
+
+    @property
+    def winner(self) -> Optional[int]:
+        return self.engine.winner
+
+    @property
+    def pending_actions(self) -> List[Optional[QueuedAction]]:
+        return self.engine.pending_actions
 
     @property
     def challenger(self) -> BattleSide:
@@ -172,16 +95,13 @@ class BattleSession:
         return self.sides[1]
 
     async def start(self) -> None:
-        for idx, side in enumerate(self.sides):
-            if not side.alive_indices():
-                raise ValueError("Battle cannot start with empty parties.")
-            first_alive = side.alive_indices()[0]
-            side.active_index = first_alive
+        self.engine.start()
         embed = self._build_live_embed()
         self.message = await self.channel.send(embed=embed)
         ACTIVE_SESSIONS[self.message.id] = self
         await self._register_actions()
-        await self._ensure_ai_actions()
+        async with self.turn_lock:
+            await self._ensure_ai_actions()
         await self._refresh_interface()
 
     async def _register_actions(self) -> None:
@@ -236,7 +156,7 @@ class BattleSession:
             if self.battle_type == "trainer":
                 await self.channel.send("You can't run from a trainer battle!", delete_after=10)
             else:
-                self.pending_actions[side_index] = QueuedAction("run", flee=True)
+                self.engine.queue(side_index, QueuedAction("run", flee=True))
                 side.selection_mode = "ready"
                 await self._maybe_resolve_turn()
         await self._refresh_interface()
@@ -263,16 +183,13 @@ class BattleSession:
 
     async def _queue_move(self, side_index: int, index: int) -> None:
         side = self.sides[side_index]
-        moveset = side.active().individual.get_move_objects()
+        moveset = side.active().moveset
         if index >= len(moveset):
             await self.channel.send(f"{side.participant.name}, that move slot is empty.", delete_after=10)
             return
         move = moveset[index]
         side.selection_mode = "ready"
-        side.queued_action = QueuedAction("move", move=move)
-        self.pending_actions[side_index] = side.queued_action
-        side.active().participated = True
-        self.participation[side_index].add(side.active_index)
+        self.engine.queue(side_index, QueuedAction("move", move=move))
         await self.channel.send(f"{side.participant.name} queued {move.name}!", delete_after=8)
         await self._maybe_resolve_turn()
 
@@ -289,9 +206,7 @@ class BattleSession:
             await self.channel.send("They're already in battle!", delete_after=10)
             return
         side.selection_mode = "ready"
-        action = QueuedAction("switch", switch_index=slot)
-        side.queued_action = action
-        self.pending_actions[side_index] = action
+        self.engine.queue(side_index, QueuedAction("switch", switch_index=slot))
         await self.channel.send(f"{side.participant.name} will switch to slot {slot + 1}.", delete_after=8)
         await self._maybe_resolve_turn()
 
@@ -302,10 +217,8 @@ class BattleSession:
             return
         item_key = options[index]
         side = self.sides[side_index]
-        action = QueuedAction("item", item_key=item_key)
         side.selection_mode = "ready"
-        side.queued_action = action
-        self.pending_actions[side_index] = action
+        self.engine.queue(side_index, QueuedAction("item", item_key=item_key))
         try:
             item_record = ITEMS[item_key]
         except FileNotFoundError:
@@ -316,231 +229,65 @@ class BattleSession:
 
     async def _ensure_ai_actions(self) -> None:
         for idx, side in enumerate(self.sides):
-            if side.participant.user_id is not None:
+            if side.participant.user_id is not None or self.pending_actions[idx] is not None or self.finished:
                 continue
+            action = await battle_ai.choose_action(self.engine, idx, self.ai_difficulty)
             if self.pending_actions[idx] is None and not self.finished:
-                await self._queue_ai_action(idx)
-
-    async def _queue_ai_action(self, side_index: int) -> None:
-        side = self.sides[side_index]
-        attacker = side.active()
-        moveset = attacker.individual.get_move_objects()
-        move = None
-        if moveset:
-            move = max(moveset, key=lambda m: m.power)
-        if not move:
-            move = moves.get("tackle")
-        action = QueuedAction("move", move=move)
-        side.queued_action = action
-        self.pending_actions[side_index] = action
-        attacker.participated = True
-        self.participation[side_index].add(side.active_index)
+                self.engine.queue(idx, action)
 
     async def _maybe_resolve_turn(self) -> None:
-        await self._ensure_ai_actions()
-        if all(action is not None for action in self.pending_actions):
-            await self._resolve_turn()
+        async with self.turn_lock:
+            await self._ensure_ai_actions()
+            if self.engine.ready():
+                await self._resolve_turn()
 
     async def _resolve_turn(self) -> None:
         if self.finished:
             return
-        actions: List[Tuple[int, QueuedAction]] = []
-        for idx, action in enumerate(self.pending_actions):
-            if action is not None:
-                actions.append((idx, action))
-        order = sorted(actions, key=lambda entry: self._action_order_key(*entry), reverse=True)
-        turn_log: List[str] = []
-        for side_index, action in order:
-            if self.finished:
-                break
-            side = self.sides[side_index]
-            if action.kind == "move":
-                entry = self._execute_move(side_index, action.move)
-                if entry:
-                    turn_log.append(entry)
-            elif action.kind == "switch":
-                entry = self._execute_switch(side_index, action.switch_index)
-                if entry:
-                    turn_log.append(entry)
-            elif action.kind == "item":
-                entry = self._execute_item(side_index, action.item_key)
-                if entry:
-                    turn_log.append(entry)
-            elif action.kind == "run":
-                self.finished = True
-                self.winner = 1 - side_index
-                turn_log.append(f"{self.sides[side_index].participant.name} fled the battle!")
-        self.turn += 1
-        for idx in range(len(self.sides)):
-            if self.finished:
-                break
-            status_entry = self._apply_end_of_turn_status(idx)
-            if status_entry:
-                turn_log.append(status_entry)
-        self.pending_actions = [None, None]
-        for side in self.sides:
-            if side.selection_mode != "switch":
-                side.selection_mode = "menu"
-            side.queued_action = None
+        item_actions = await self._spend_items()
+        events = self.engine.resolve_turn()
+        await self._refund_unused_items(item_actions, events)
+        turn_log = [event.text for event in events]
         self.log.extend(turn_log)
         if self.finished:
             await self._conclude_battle()
         else:
             await self._refresh_interface(extra_log=turn_log)
 
-    def _action_order_key(self, side_index: int, action: QueuedAction) -> Tuple[int, int, float]:
-        if action.kind == "run":
-            priority = 6
-        elif action.kind == "switch":
-            priority = 5
-        elif action.kind == "item":
-            priority = 4
-        elif action.kind == "move" and action.move:
-            priority = 3 + action.move.priority
-        else:
-            priority = 0
-        speed = self.sides[side_index].active().individual.get_stats()["speed"]
-        return (priority, speed, random.random())
-
-    def _execute_move(self, side_index: int, move: Optional[moves.Move]) -> Optional[str]:
-        side = self.sides[side_index]
-        attacker = side.active()
-        if attacker.is_fainted():
-            return None
-        if attacker.status == "sleep":
-            if attacker.status_turns > 0:
-                attacker.status_turns -= 1
-                if attacker.status_turns <= 0:
-                    attacker.set_status(None)
-                    return f"{attacker.individual.get_title()} woke up!"
-                return f"{attacker.individual.get_title()} is fast asleep!"
-        if attacker.status == "paralysis" and random.random() < 0.25:
-            return f"{attacker.individual.get_title()} is paralyzed! It can't move!"
-        if not move:
-            move = moves.get("tackle")
-        target_index = 1 - side_index
-        defender_side = self.sides[target_index]
-        defender = defender_side.active()
-        damage = self._calculate_damage(attacker, defender, move)
-        healed = 0
-        if damage > 0:
-            defender.apply_damage(damage)
-        if move.heal:
-            healed = attacker.heal(move.heal)
-        entry = f"{attacker.individual.get_title()} used {move.name}!"
-        if damage:
-            entry += f" It dealt {damage} damage."
-        if healed:
-            entry += f" It restored {healed} HP!"
-        if move.status and not defender.is_fainted():
-            if random.random() <= move.status_chance:
-                if defender.status != move.status:
-                    defender.set_status(move.status)
-                    entry += f" {defender.individual.get_title()} is now {defender.status_text()}!"
-        if defender.is_fainted():
-            entry += f" {defender.individual.get_title()} fainted!"
-            faint_message = self._handle_faint(target_index)
-            if faint_message:
-                entry += f" {faint_message}"
-        return entry
-
-    def _execute_switch(self, side_index: int, slot: Optional[int]) -> Optional[str]:
-        if slot is None:
-            return None
-        side = self.sides[side_index]
-        if slot < 0 or slot >= len(side.team):
-            return None
-        side.active_index = slot
-        side.selection_mode = "menu"
-        return f"{side.participant.name} sent out {side.active().individual.get_title()}!"
-
-    def _execute_item(self, side_index: int, item_key: Optional[str]) -> Optional[str]:
-        if not item_key:
-            return None
-        side = self.sides[side_index]
-        uid = side.participant.user_id
-        if uid is None:
-            return None
-        try:
-            item_data = ITEMS[item_key]
-        except FileNotFoundError:
-            return f"{side.participant.name} tried to use an unknown item."
-        if not economy.user_spend_item(uid, item_key, 1):
-            return f"{side.participant.name} tried to use a {item_data['name']}, but didn't have one!"
-        item = item_data
-        heal_amount = int(item.get("battle_heal", 0))
-        healed = side.active().heal(heal_amount)
-        return f"{side.participant.name} used {item['name']} and restored {healed} HP!"
-
-    def _calculate_damage(self, attacker: BattlePokemonState, defender: BattlePokemonState, move: moves.Move) -> int:
-        if move.category == "status" or move.power <= 0:
-            return 0
-        atk_stats = attacker.individual.get_stats()
-        def_stats = defender.individual.get_stats()
-        if move.category == "physical":
-            attack_stat = atk_stats["attack"]
-            if attacker.status == "burn":
-                attack_stat = max(1, int(attack_stat * 0.8))
-            defense_stat = def_stats["defense"]
-        else:
-            attack_stat = atk_stats["sp_attack"]
-            defense_stat = def_stats["sp_defense"]
-        level = attacker.individual.level
-        base = (((2 * level / 5) + 2) * move.power * attack_stat / max(1, defense_stat)) / 50 + 2
-        modifier = random.uniform(0.85, 1.0)
-        stab = 1.0
-        attacker_types = [attacker.individual.species.type_1.name]
-        if attacker.individual.species.type_2:
-            attacker_types.append(attacker.individual.species.type_2.name)
-        if move.type in attacker_types:
-            stab = 1.5
-        damage = int(base * modifier * stab)
-        return max(1, damage)
-
-    def _handle_faint(self, side_index: int) -> Optional[str]:
-        side = self.sides[side_index]
-        if side.participant.user_id is None:
-            if side.force_next_available():
-                self.pending_actions[side_index] = None
-                side.selection_mode = "menu"
-                return None
-        else:
-            if side.has_available_switch():
-                self.pending_actions[side_index] = None
-                side.selection_mode = "switch"
-                return f"{side.participant.name}, choose your next Pokémon!"
-        self.finished = True
-        self.winner = 1 - side_index
-        return None
-
-    def _apply_end_of_turn_status(self, side_index: int) -> Optional[str]:
-        side = self.sides[side_index]
-        active = side.active()
-        if active.is_fainted() or not active.status:
-            return None
-        if active.status == "burn":
-            damage = max(1, active.max_hp() // 16)
-            active.apply_damage(damage)
-            message = f"{active.individual.get_title()} is hurt by its burn! (-{damage} HP)"
-            if active.is_fainted():
-                faint_message = self._handle_faint(side_index)
-                if faint_message:
-                    message += f" {faint_message}"
-            return message
-        if active.status == "poison":
-            damage = max(1, active.max_hp() // 8)
-            active.apply_damage(damage)
-            message = f"{active.individual.get_title()} is hurt by poison! (-{damage} HP)"
-            if active.is_fainted():
-                faint_message = self._handle_faint(side_index)
-                if faint_message:
-                    message += f" {faint_message}"
-            return message
-        return None
+    async def _spend_items(self) -> List[Tuple[int, QueuedAction]]:
+        """Take queued items from their trainers before the engine uses them. Returns the ones taken."""
+        spent = []
+        for side_index, action in enumerate(self.pending_actions):
+            if action is None or action.kind != "item" or not action.item_key:
+                continue
+            uid = self.sides[side_index].participant.user_id
+            if uid is None:
+                continue
+            try:
+                action.item = ITEMS[action.item_key]
+            except FileNotFoundError:
+                continue
+            action.item_spent = await economy.user_spend_item(uid, action.item_key, 1)
+            if action.item_spent:
+                spent.append((side_index, action))
+        return spent
+
+    async def _refund_unused_items(self, item_actions: List[Tuple[int, QueuedAction]], events: List[BattleEvent]) -> None:
+        # The battle can end before an item's turn comes up.
+        used = {event.side for event in events if event.kind == "item"}
+        for side_index, action in item_actions:
+            if side_index not in used:
+                await economy.user_gain_item(self.sides[side_index].participant.user_id, action.item_key, 1)
 
     async def _conclude_battle(self) -> None:
-        await self._distribute_rewards_and_xp()
-        self._record_battles()
+        # Both trainers' rewards, experience and records are committed together.
+        trainer_ids = [participant.user_id for participant in self.participants if participant.user_id]
+        async with users.USERS.transaction(*trainer_ids):
+            await self._distribute_rewards_and_xp()
+            logged = await self._record_battles()
+        # Only once the counters are committed, so a rollback can't leave log entries without them.
+        for uid, entry in logged:
+            await users.log_battle(uid, entry)
         result = BattleResult(
             participants=self.participants,
             winner=self.winner,
@@ -573,11 +320,13 @@ class BattleSession:
         for uid, amount in rewards.items():
             if uid is None or amount <= 0:
                 continue
-            users.adjust_bp(uid, amount)
+            await users.adjust_bp(uid, amount)
         self.rewards = {uid: amount for uid, amount in rewards.items() if uid is not None}
         await self._award_experience()
 
-    def _record_battles(self) -> None:
+    async def _record_battles(self) -> List[Tuple[int, Dict]]:
+        """Count the battle for each trainer. Returns (uid, entry) for their battle logs."""
+        logged = []
         challenger, opponent = self.participants
         if challenger.user_id:
             if self.winner is None:
@@ -592,7 +341,9 @@ class BattleSession:
             elif self.battle_type == "wild" and opponent.party:
                 wild = opponent.party[0]
                 context.update({"pokemon": wild.species.pokedex_number, "name": wild.species.name})
-            users.record_battle(challenger.user_id, outcome, context)
+            entry = await users.record_battle(challenger.user_id, outcome, context)
+            if entry:
+                logged.append((challenger.user_id, entry))
         if opponent.user_id:
             if self.winner is None:
                 outcome = "draw"
@@ -606,7 +357,10 @@ class BattleSession:
             elif self.battle_type == "wild" and challenger.party:
                 wild = challenger.party[0]
                 context.update({"pokemon": wild.species.pokedex_number, "name": wild.species.name})
-            users.record_battle(opponent.user_id, outcome, context)
+            entry = await users.record_battle(opponent.user_id, outcome, context)
+            if entry:
+                logged.append((opponent.user_id, entry))
+        return logged
 
     async def _award_experience(self) -> None:
         self.experience_log = {}
@@ -615,39 +369,25 @@ class BattleSession:
             if participant.user_id is None:
                 continue
             events: List[str] = []
-            xp_gain = self._xp_for_side(idx)
+            xp_gain = self.engine.xp_for_side(idx)
             if xp_gain <= 0:
                 continue
-            user_record = users.ensure_user_record(participant.user_id)
+            user_record = await users.ensure_user_record(participant.user_id)
             roster = user_record.get("pokemon", [])
-            roster_map = {entry.get("uid"): pos for pos, entry in enumerate(roster)}
             for mon in side.team:
                 if not mon.participated:
                     continue
-                uid = mon.individual.instance_id
-                pos = roster_map.get(uid, -1)
+                pos = users.roster_position(user_record, mon.individual.instance_id)
                 mon_events = mon.individual.gain_experience(xp_gain)
-                if pos >= 0:
+                if pos is not None:
                     roster[pos] = mon.individual.to_dict()
                 if mon_events["level"] or mon_events["evolution"]:
                     events.extend([f"{mon.individual.get_title()}: {msg}" for msg in mon_events["level"] + mon_events["evolution"]])
             user_record["pokemon"] = roster
-            users.USERS[participant.user_id] = user_record
-            users.USERS.save_item(participant.user_id)
+            await users.USERS.aput(participant.user_id, user_record)
             if events:
                 self.experience_log[participant.user_id] = events
 
-    def _xp_for_side(self, side_index: int) -> int:
-        opponent_index = 1 - side_index
-        defeated_levels = []
-        for mon in self.sides[opponent_index].team:
-            if mon.is_fainted():
-                defeated_levels.append(mon.individual.level)
-        if not defeated_levels:
-            return 0
-        base = sum(level for level in defeated_levels) // max(1, len(defeated_levels))
-        return max(10, base * 5)
-
     def _battle_items_for_user(self, user_id: Optional[int]) -> List[str]:
         if user_id is None:
             return []
@@ -670,7 +410,7 @@ class BattleSession:
             hp_line = f"HP: {active.current_hp}/{active.max_hp()}"
             status = active.status_text()
             status_text = f" [{status}]" if status else ""
-            moveset = ", ".join(move.name for move in active.individual.get_move_objects())
+            moveset = ", ".join(move.name for move in active.moveset)
             embed.add_field(
                 name=f"{self.participants[idx].name}",
                 value=(
@@ -715,10 +455,11 @@ async def start_wild_battle(
     trainer_name: str,
     party: Sequence[classes.Individual],
     wild: classes.Individual,
+    ai_difficulty: str = battle_ai.DEFAULT_DIFFICULTY,
 ) -> None:
     challenger = BattleParticipant(trainer_id, trainer_name, party)
     opponent = BattleParticipant(None, f"Wild {wild.species.name}", [wild])
-    session = BattleSession(channel, challenger, opponent, "wild")
+    session = BattleSession(channel, challenger, opponent, "wild", ai_difficulty)
     await session.start()
 
 
@@ -0,0 +1,250 @@
+import asyncio
+import math
+import os
+import pickle
+import random
+import struct
+import sys
+import time
+from typing import Dict, Optional, Tuple
+
+from battle_engine import BattleEngine, QueuedAction
+
+"""
+This module decides what computer-controlled pokemon do in battle.
+
+GreedyAI uses the strongest move after type effectiveness, which is what
+BattleEngine does on its own. SearchAI looks ahead: for each of its
+options it plays out every reply the other side could make, a few times
+each since damage and status are random, and keeps the option whose
+worst reply still leaves it best off (expectiminimax). It searches one
+turn deeper at a time until it runs out of depth or time, and remembers
+positions it has already scored, keyed by BattleEngine.state_key().
+
+DIFFICULTIES maps each tier to an AI. choose_action() runs searches in
+worker processes (see battle_ai_worker.py), so a long think never holds
+up other battles.
+"""
+
+WIN_SCORE = 1000.0
+
+
+class GreedyAI:
+    """Always the strongest move against the current opponent."""
+    def choose(self, engine: BattleEngine, side_index: int) -> QueuedAction:
+        return engine.choose_ai_action(side_index)
+
+
+class _OutOfTime(Exception):
+    pass
+
+
+def evaluate(engine: BattleEngine, side_index: int) -> float:
+    """How good the battle looks for side_index: healthy pokemon count for it, the other side's against it."""
+    if engine.finished:
+        if engine.winner is None:
+            return 0.0
+        return WIN_SCORE if engine.winner == side_index else -WIN_SCORE
+    score = 0.0
+    for idx, side in enumerate(engine.sides):
+        sign = 1 if idx == side_index else -1
+        for mon in side.team:
+            if mon.current_hp > 0:
+                score += sign * (1 + mon.current_hp / mon.max_hp() - (0.25 if mon.status else 0))
+    return score
+
+
+class SearchAI:
+    """Expectiminimax over the battle engine, with a time budget and a transposition cache."""
+    def __init__(self, depth: int, budget: float, samples: int = 3, cache_size: int = 50000):
+        self.depth = depth            # Most turns to look ahead
+        self.budget = budget          # Seconds to think per decision
+        self.samples = samples        # Times each pair of choices is played out, since the rolls are random
+        self.cache_size = cache_size  # Positions to remember before starting over
+        self.cache: Dict[Tuple, float] = {}  # (battle, side, depth, state_key) -> score
+
+    def choose(self, engine: BattleEngine, side_index: int) -> QueuedAction:
+        """Search on engine, which is left as it was. Pass a clone of a live battle."""
+        actions = engine.legal_actions(side_index)
+        if len(actions) == 1:
+            return actions[0]
+        best = engine.choose_ai_action(side_index)  # In case not even one turn fits in the budget
+        deadline = time.perf_counter() + self.budget
+        root = engine.state_key()
+        battle = tuple(mon.individual.instance_id for side in engine.sides for mon in side.team)
+        for depth in range(1, self.depth + 1):
+            try:
+                _, action = self._best_action(engine, battle, side_index, depth, deadline, root)
+            except _OutOfTime:
+                break
+            finally:
+                engine.restore(root)
+            if action is not None:
+                best = action
+        return best
+
+    def _value(self, engine, battle, me, depth, deadline) -> float:
+        if engine.finished or depth == 0:
+            return evaluate(engine, me)
+        state = engine.state_key()
+        key = (battle, me, depth, state)
+        score = self.cache.get(key)
+        if score is None:
+            score, _ = self._best_action(engine, battle, me, depth, deadline, state)
+            if len(self.cache) >= self.cache_size:
+                self.cache.clear()
+            self.cache[key] = score
+        return score
+
+    def _best_action(self, engine, battle, me, depth, deadline, state) -> Tuple[float, Optional[QueuedAction]]:
+        foe = 1 - me
+        best_score, best_action = -math.inf, None
+        for action in engine.legal_actions(me):
+            worst = math.inf
+            for reply in engine.legal_actions(foe) or [None]:
+                total = 0.0
+                for _ in range(self.samples):
+                    if time.perf_counter() > deadline:
+                        raise _OutOfTime()
+                    engine.restore(state)
+                    engine.queue(me, action)
+                    if reply is not None:
+                        engine.queue(foe, reply)
+                    engine.resolve_turn()
+                    total += self._value(engine, battle, me, depth - 1, deadline)
+                worst = min(worst, total / self.samples)
+                if worst <= best_score:
+                    # The foe can already hold this below the best option found.
+                    break
+            if worst > best_score:
+                best_score, best_action = worst, action
+        engine.restore(state)
+        if best_action is None:
+            return evaluate(engine, me), None
+        return best_score, best_action
+
+
+# Difficulty -> the AI that plays at it. Deeper searches need a bigger budget to finish.
+DIFFICULTIES = {
+    "easy": GreedyAI(),
+    "normal": SearchAI(depth=1, budget=0.05),
+    "hard": SearchAI(depth=2, budget=0.5),
+    "expert": SearchAI(depth=4, budget=2.0),
+}
+
+DEFAULT_DIFFICULTY = "normal"
+AI_WORKERS = 2
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "battle_ai_worker.py")
+
+
+def get_ai(difficulty: str):
+    return DIFFICULTIES.get(difficulty, DIFFICULTIES[DEFAULT_DIFFICULTY])
+
+
+def frame(payload: bytes) -> bytes:
+    """A message between the bot and a worker: its length, then the pickle."""
+    return struct.pack(">I", len(payload)) + payload
+
+
+class _SearchWorker:
+    """
+    One worker process, started fresh from battle_ai_worker.py rather than forked
+    from the bot, so it shares no threads, locks or open stores with it.
+    """
+    def __init__(self, process):
+        self.process = process
+
+    @classmethod
+    async def start(cls) -> "_SearchWorker":
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, WORKER_SCRIPT,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+        )
+        return cls(process)
+
+    async def search(self, difficulty: str, engine: BattleEngine, side_index: int) -> Tuple[bool, object]:
+        """Returns (True, action), or (False, what went wrong) if the search raised."""
+        self.process.stdin.write(frame(pickle.dumps((difficulty, engine, side_index))))
+        await self.process.stdin.drain()
+        size, = struct.unpack(">I", await self.process.stdout.readexactly(4))
+        return pickle.loads(await self.process.stdout.readexactly(size))
+
+    def close(self) -> None:
+        if self.process.returncode is None:
+            self.process.kill()
+
+
+class _SearchPool:
+    """Up to AI_WORKERS workers, started as searches need them and reused after."""
+    def __init__(self, loop):
+        self.loop = loop              # The event loop the workers' pipes belong to
+        self.idle = []                # Workers not searching right now
+        self.started = 0              # Workers alive, idle or not
+        self.freed = asyncio.Condition()
+
+    async def _take(self) -> _SearchWorker:
+        async with self.freed:
+            while True:
+                while self.idle:
+                    worker = self.idle.pop()
+                    if worker.process.returncode is None:
+                        return worker
+                    self.started -= 1  # Died while it was idle
+                if self.started < AI_WORKERS:
+                    break
+                await self.freed.wait()
+            self.started += 1
+        try:
+            return await _SearchWorker.start()
+        except BaseException:
+            await self._lose()
+            raise
+
+    async def _give_back(self, worker: _SearchWorker) -> None:
+        async with self.freed:
+            self.idle.append(worker)
+            self.freed.notify()
+
+    async def _lose(self) -> None:
+        async with self.freed:
+            self.started -= 1
+            self.freed.notify()
+
+    async def search(self, difficulty: str, engine: BattleEngine, side_index: int) -> QueuedAction:
+        worker = await self._take()
+        try:
+            ok, result = await worker.search(difficulty, engine, side_index)
+        except BaseException:
+            # Died, or cancelled part way through a message, so it can't be trusted with another.
+            worker.close()
+            await asyncio.shield(self._lose())
+            raise
+        await self._give_back(worker)
+        if not ok:
+            raise RuntimeError(f"Search failed in its worker: {result}")
+        return result
+
+
+_pool: Optional[_SearchPool] = None
+
+
+def _search_pool() -> _SearchPool:
+    global _pool
+    loop = asyncio.get_running_loop()
+    if _pool is None or _pool.loop is not loop:
+        _pool = _SearchPool(loop)
+    return _pool
+
+
+async def choose_action(engine: BattleEngine, side_index: int, difficulty: str = DEFAULT_DIFFICULTY) -> QueuedAction:
+    """Pick side_index's action without blocking the event loop."""
+    ai = get_ai(difficulty)
+    if isinstance(ai, GreedyAI):
+        return ai.choose(engine, side_index)
+    twin = engine.clone(random.Random())
+    try:
+        return await _search_pool().search(difficulty, twin, side_index)
+    except Exception as e:
+        # Whatever went wrong, the battle still needs an action from this side, or it stalls.
+        print(f"Battle AI search failed, using the simple AI instead: {e!r}")
+        return engine.choose_ai_action(side_index)
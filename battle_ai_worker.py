@@ -0,0 +1,47 @@
+import pickle
+import sys
+
+# stdout carries the answers, so anything printed while importing or searching goes to stderr.
+ANSWERS = sys.stdout.buffer
+sys.stdout = sys.stderr
+
+import battle_ai
+
+"""
+This module is the process battle_ai.choose_action() hands searches to.
+
+It reads (difficulty, engine, side_index) from stdin and writes back
+(True, action), or (False, error) if the search raised, each framed by
+battle_ai.frame(). It exits once the bot closes its stdin.
+
+It's started as a script of its own, so it only imports the battle modules,
+never main.py or db.py: a worker can't open, recover or save the bot's stores.
+Each worker keeps its own DIFFICULTIES, so their caches last between searches.
+"""
+
+
+def read_exactly(stream, size):
+    data = stream.read(size)
+    return data if len(data) == size else None
+
+
+def main():
+    requests = sys.stdin.buffer
+    while True:
+        header = read_exactly(requests, 4)
+        if header is None:
+            return
+        body = read_exactly(requests, int.from_bytes(header, "big"))
+        if body is None:
+            return
+        difficulty, engine, side_index = pickle.loads(body)
+        try:
+            reply = (True, battle_ai.get_ai(difficulty).choose(engine, side_index))
+        except Exception as e:
+            reply = (False, repr(e))
+        ANSWERS.write(battle_ai.frame(pickle.dumps(reply)))
+        ANSWERS.flush()
+
+
+if __name__ == "__main__":
+    main()
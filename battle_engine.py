@@ -0,0 +1,534 @@
+from __future__ import annotations
+
+import random
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import classes
+import moves
+import type_chart
+
+"""
+This module resolves battles without Discord or the database.
+
+BattleEngine holds both teams and resolves a turn at a time: queue an
+action for each side, call resolve_turn(), and read what happened from
+the BattleEvents it returns. Nothing here awaits, sends messages or
+saves records, so battles can be played out in tests, benchmarks and
+simulations as fast as the rules allow.
+
+battle.BattleSession is the Discord side. It turns reactions into
+queued actions, spends items before the turn, and shows the events.
+
+Pass a random.Random as rng for repeatable battles.
+"""
+
+
+@dataclass
+class BattleParticipant:
+    user_id: Optional[int]
+    name: str
+    party: Sequence[classes.Individual]
+
+
+@dataclass
+class QueuedAction:
+    kind: str
+    move: Optional[moves.Move] = None
+    switch_index: Optional[int] = None
+    item_key: Optional[str] = None
+    flee: bool = False
+    item: Optional[Dict[str, Any]] = None  # The item's record, filled in by whoever spends it
+    item_spent: bool = False               # Set once the item has been taken from the trainer
+
+
+@dataclass
+class BattleEvent:
+    """One line of the battle log, with what happened in data for anything that isn't reading it."""
+    kind: str
+    side: int
+    text: str
+    data: Dict[str, Any] = field(default_factory=dict)
+
+
+class CombatStats(NamedTuple):
+    hp: int
+    attack: int
+    defense: int
+    sp_attack: int
+    sp_defense: int
+    speed: int
+
+
+@dataclass(slots=True)
+class BattlePokemonState:
+    """
+    One pokemon for the length of a battle.
+
+    Stats, types and moves are copied from the Individual when the battle
+    starts, since they can't change until it's over. Damage terms, type
+    effectiveness included, are worked out per move against the current
+    opponent, and only again once a different pokemon is sent out against it.
+    """
+    individual: classes.Individual
+    current_hp: int = field(init=False)
+    status: Optional[str] = None
+    status_turns: int = 0
+    participated: bool = False
+    stats: CombatStats = field(init=False)
+    types: Tuple[str, ...] = field(init=False)
+    type_ids: Tuple[int, int] = field(init=False)  # Chart indexes, see type_chart.py
+    moveset: Tuple[moves.Move, ...] = field(init=False)
+    opponent: Optional[BattlePokemonState] = field(init=False, default=None)
+    damage_table: Dict[Tuple[str, bool], Tuple[float, float, float]] = field(init=False, default_factory=dict)  # (move, burned) -> damage_terms()
+
+    def __post_init__(self) -> None:
+        species = self.individual.species
+        self.stats = CombatStats(*self.individual.get_stats_list())
+        self.types = (species.type_1.name, species.type_2.name) if species.type_2 else (species.type_1.name,)
+        self.type_ids = type_chart.species_types(species)
+        self.moveset = tuple(self.individual.get_move_objects())
+        self.current_hp = self.stats.hp
+
+    def max_hp(self) -> int:
+        return self.stats.hp
+
+    def clone(self) -> BattlePokemonState:
+        """A copy to play out turns on, sharing the snapshot but not the hp or status."""
+        twin = object.__new__(BattlePokemonState)
+        for name in self.__slots__:
+            setattr(twin, name, getattr(self, name))
+        twin.damage_table = dict(self.damage_table)
+        return twin
+
+    def face(self, opponent: BattlePokemonState) -> None:
+        """Work out this pokemon's damage terms against a new opponent."""
+        self.opponent = opponent
+        self.damage_table.clear()
+        for move in self.moveset:
+            self._damage_terms(move, False)
+
+    def damage_terms(self, move: moves.Move, defender: BattlePokemonState, burned: bool = False) -> Tuple[float, float, float]:
+        """
+        (base, stab, effectiveness) for a move against defender, so the damage is
+        int(base * roll * stab * effectiveness). burned lowers the attack stat of physical moves only.
+        """
+        if defender is not self.opponent:
+            self.face(defender)
+        terms = self.damage_table.get((move.key, burned))
+        if terms is None:
+            terms = self._damage_terms(move, burned)
+        return terms
+
+    def _damage_terms(self, move: moves.Move, burned: bool) -> Tuple[float, float, float]:
+        defender = self.opponent.stats
+        if move.category == "physical":
+            attack_stat = self.stats.attack
+            if burned:
+                attack_stat = max(1, int(attack_stat * 0.8))
+            defense_stat = defender.defense
+        else:
+            attack_stat = self.stats.sp_attack
+            defense_stat = defender.sp_defense
+        level = self.individual.level
+        base = (((2 * level / 5) + 2) * move.power * attack_stat / max(1, defense_stat)) / 50 + 2
+        stab = 1.5 if move.type in self.types else 1.0
+        effectiveness = type_chart.effectiveness(move.type, *self.opponent.type_ids)
+        terms = self.damage_table[(move.key, burned)] = (base, stab, effectiveness)
+        return terms
+
+    def is_fainted(self) -> bool:
+        return self.current_hp <= 0
+
+    def apply_damage(self, amount: int) -> int:
+        amount = max(0, int(amount))
+        if amount <= 0:
+            return 0
+        self.current_hp = max(0, self.current_hp - amount)
+        return amount
+
+    def heal(self, amount: int) -> int:
+        amount = max(0, int(amount))
+        before = self.current_hp
+        self.current_hp = min(self.max_hp(), self.current_hp + amount)
+        return self.current_hp - before
+
+    def set_status(self, kind: Optional[str], rng=random) -> None:
+        if kind is None:
+            self.status = None
+            self.status_turns = 0
+            return
+        if kind == "sleep":
+            self.status = kind
+            self.status_turns = rng.randint(1, 3)
+        else:
+            self.status = kind
+            self.status_turns = -1
+
+    def status_text(self) -> str:
+        if not self.status:
+            return ""
+        if self.status == "burn":
+            return "BRN"
+        if self.status == "paralysis":
+            return "PAR"
+        if self.status == "poison":
+            return "PSN"
+        if self.status == "sleep":
+            return "SLP"
+        return self.status.upper()
+
+
+@dataclass
+class BattleSide:
+    participant: BattleParticipant
+    team: List[BattlePokemonState]
+    active_index: int = 0
+    selection_mode: str = "menu"
+    queued_action: Optional[QueuedAction] = None
+
+    def active(self) -> BattlePokemonState:
+        return self.team[self.active_index]
+
+    def alive_indices(self) -> List[int]:
+        return [idx for idx, mon in enumerate(self.team) if not mon.is_fainted()]
+
+    def has_available_switch(self) -> bool:
+        return any(idx != self.active_index and not mon.is_fainted() for idx, mon in enumerate(self.team))
+
+    def force_next_available(self) -> bool:
+        for idx, mon in enumerate(self.team):
+            if idx == self.active_index:
+                continue
+            if not mon.is_fainted():
+                self.active_index = idx
+                self.selection_mode = "menu"
+                self.queued_action = None
+                return True
+        return False
+
+
+def best_move(attacker: BattlePokemonState, defender: BattlePokemonState) -> moves.Move:
+    """The AI's pick: the most powerful move once type effectiveness is counted."""
+    if not attacker.moveset:
+        return moves.get("tackle")
+    return max(attacker.moveset, key=lambda m: m.power * type_chart.effectiveness(m.type, *defender.type_ids))
+
+
+class BattleEngine:
+    """The rules of a battle between two sides. Side 0 is the challenger, side 1 the opponent."""
+
+    def __init__(
+        self,
+        challenger: BattleParticipant,
+        opponent: BattleParticipant,
+        battle_type: str = "trainer",
+        rng=None,
+    ) -> None:
+        self.participants = (challenger, opponent)
+        self.battle_type = battle_type
+        self.rng = rng if rng is not None else random
+        self.sides = [
+            BattleSide(challenger, [BattlePokemonState(mon) for mon in challenger.party]),
+            BattleSide(opponent, [BattlePokemonState(mon) for mon in opponent.party]),
+        ]
+        self.turn = 1
+        self.pending_actions: List[Optional[QueuedAction]] = [None, None]
+        self.finished = False
+        self.winner: Optional[int] = None
+        self.participation: List[set[int]] = [set(), set()]
+
+    def start(self) -> None:
+        """Send out each side's first healthy pokemon."""
+        for side in self.sides:
+            if not side.alive_indices():
+                raise ValueError("Battle cannot start with empty parties.")
+            side.active_index = side.alive_indices()[0]
+
+    def queue(self, side_index: int, action: QueuedAction) -> None:
+        side = self.sides[side_index]
+        side.queued_action = action
+        self.pending_actions[side_index] = action
+        if action.kind == "move":
+            side.active().participated = True
+            self.participation[side_index].add(side.active_index)
+
+    def ready(self) -> bool:
+        return all(action is not None for action in self.pending_actions)
+
+    def choose_ai_action(self, side_index: int) -> QueuedAction:
+        side = self.sides[side_index]
+        if side.selection_mode == "switch":
+            for idx in side.alive_indices():
+                if idx != side.active_index:
+                    return QueuedAction("switch", switch_index=idx)
+        return QueuedAction("move", move=best_move(side.active(), self.sides[1 - side_index].active()))
+
+    def legal_actions(self, side_index: int) -> List[QueuedAction]:
+        """Every move and switch a side could pick this turn. Items and running aren't included."""
+        side = self.sides[side_index]
+        switches = [QueuedAction("switch", switch_index=idx) for idx in side.alive_indices() if idx != side.active_index]
+        if side.selection_mode == "switch":
+            return switches
+        moveset = side.active().moveset or (moves.get("tackle"),)
+        return [QueuedAction("move", move=move) for move in moveset] + switches
+
+    def state_key(self) -> Tuple:
+        """Everything a turn can change, as a tuple that's cheap to hash and can be restore()d."""
+        return tuple(
+            (
+                side.active_index,
+                side.selection_mode == "switch",
+                tuple((mon.current_hp, mon.status, mon.status_turns) for mon in side.team),
+            )
+            for side in self.sides
+        )
+
+    def restore(self, state: Tuple) -> None:
+        """Go back to a state_key() taken before the battle ended."""
+        for side, (active_index, switching, team) in zip(self.sides, state):
+            side.active_index = active_index
+            side.selection_mode = "switch" if switching else "menu"
+            side.queued_action = None
+            for mon, (hp, status, status_turns) in zip(side.team, team):
+                mon.current_hp = hp
+                mon.status = status
+                mon.status_turns = status_turns
+        self.pending_actions = [None, None]
+        self.finished = False
+        self.winner = None
+
+    def clone(self, rng=None) -> BattleEngine:
+        """A copy of the battle to look ahead on, without the queued actions."""
+        twin = object.__new__(BattleEngine)
+        twin.participants = self.participants
+        twin.battle_type = self.battle_type
+        twin.rng = rng if rng is not None else random.Random()
+        twin.sides = [
+            BattleSide(side.participant, [mon.clone() for mon in side.team], side.active_index, side.selection_mode)
+            for side in self.sides
+        ]
+        # Point each twin at its opponent's twin, so the damage terms worked out so far still apply.
+        twins = {id(mon): copy for side, twin_side in zip(self.sides, twin.sides) for mon, copy in zip(side.team, twin_side.team)}
+        for twin_side in twin.sides:
+            for mon in twin_side.team:
+                if mon.opponent is not None:
+                    mon.opponent = twins.get(id(mon.opponent))
+                    if mon.opponent is None:
+                        mon.damage_table.clear()
+        twin.turn = self.turn
+        twin.pending_actions = [None, None]
+        twin.finished = self.finished
+        twin.winner = self.winner
+        twin.participation = [set(slots) for slots in self.participation]
+        return twin
+
+    def queue_ai_actions(self, sides: Optional[Sequence[int]] = None) -> None:
+        """Queue an action for every side in sides (by default the sides without a trainer) that has none."""
+        if sides is None:
+            sides = [idx for idx, side in enumerate(self.sides) if side.participant.user_id is None]
+        for idx in sides:
+            if self.pending_actions[idx] is None and not self.finished:
+                self.queue(idx, self.choose_ai_action(idx))
+
+    def resolve_turn(self) -> List[BattleEvent]:
+        """Play out the queued actions and end of turn effects. Returns what happened, in order."""
+        events: List[BattleEvent] = []
+        if self.finished:
+            return events
+        actions: List[Tuple[int, QueuedAction]] = []
+        for idx, action in enumerate(self.pending_actions):
+            if action is not None:
+                actions.append((idx, action))
+        order = sorted(actions, key=lambda entry: self._action_order_key(*entry), reverse=True)
+        for side_index, action in order:
+            if self.finished:
+                break
+            event = None
+            if action.kind == "move":
+                event = self._execute_move(side_index, action.move)
+            elif action.kind == "switch":
+                event = self._execute_switch(side_index, action.switch_index)
+            elif action.kind == "item":
+                event = self._execute_item(side_index, action)
+            elif action.kind == "run":
+                self.finished = True
+                self.winner = 1 - side_index
+                event = BattleEvent("flee", side_index, f"{self.sides[side_index].participant.name} fled the battle!")
+            if event:
+                events.append(event)
+        self.turn += 1
+        for idx in range(len(self.sides)):
+            if self.finished:
+                break
+            event = self._apply_end_of_turn_status(idx)
+            if event:
+                events.append(event)
+        self.pending_actions = [None, None]
+        for side in self.sides:
+            if side.selection_mode != "switch":
+                side.selection_mode = "menu"
+            side.queued_action = None
+        return events
+
+    def play(self, max_turns: int = 500) -> List[BattleEvent]:
+        """Let the AI pick for both sides until the battle ends. A battle still going after max_turns is a draw."""
+        events: List[BattleEvent] = []
+        self.start()
+        while not self.finished and self.turn <= max_turns:
+            self.queue_ai_actions(range(len(self.sides)))
+            events.extend(self.resolve_turn())
+        return events
+
+    def _action_order_key(self, side_index: int, action: QueuedAction) -> Tuple[int, int, float]:
+        if action.kind == "run":
+            priority = 6
+        elif action.kind == "switch":
+            priority = 5
+        elif action.kind == "item":
+            priority = 4
+        elif action.kind == "move" and action.move:
+            priority = 3 + action.move.priority
+        else:
+            priority = 0
+        speed = self.sides[side_index].active().stats.speed
+        return (priority, speed, self.rng.random())
+
+    def _execute_move(self, side_index: int, move: Optional[moves.Move]) -> Optional[BattleEvent]:
+        side = self.sides[side_index]
+        attacker = side.active()
+        if attacker.is_fainted():
+            return None
+        if attacker.status == "sleep":
+            if attacker.status_turns > 0:
+                attacker.status_turns -= 1
+                if attacker.status_turns <= 0:
+                    attacker.set_status(None)
+                    return BattleEvent("wake", side_index, f"{attacker.individual.get_title()} woke up!")
+                return BattleEvent("asleep", side_index, f"{attacker.individual.get_title()} is fast asleep!")
+        if attacker.status == "paralysis" and self.rng.random() < 0.25:
+            return BattleEvent("paralyzed", side_index, f"{attacker.individual.get_title()} is paralyzed! It can't move!")
+        if not move:
+            move = moves.get("tackle")
+        target_index = 1 - side_index
+        defender_side = self.sides[target_index]
+        defender = defender_side.active()
+        damage = self.calculate_damage(attacker, defender, move)
+        effectiveness = self.effectiveness(attacker, defender, move)
+        healed = 0
+        if damage > 0:
+            defender.apply_damage(damage)
+        if move.heal:
+            healed = attacker.heal(move.heal)
+        data: Dict[str, Any] = {
+            "move": move.key, "damage": damage, "effectiveness": effectiveness,
+            "healed": healed, "status": None, "fainted": False,
+        }
+        entry = f"{attacker.individual.get_title()} used {move.name}!"
+        if damage:
+            entry += f" It dealt {damage} damage."
+        note = type_chart.describe(effectiveness)
+        if note:
+            entry += f" {note}"
+        if healed:
+            entry += f" It restored {healed} HP!"
+        if move.status and effectiveness and not defender.is_fainted():
+            if self.rng.random() <= move.status_chance:
+                if defender.status != move.status:
+                    defender.set_status(move.status, self.rng)
+                    data["status"] = move.status
+                    entry += f" {defender.individual.get_title()} is now {defender.status_text()}!"
+        if defender.is_fainted():
+            data["fainted"] = True
+            entry += f" {defender.individual.get_title()} fainted!"
+            faint_message = self._handle_faint(target_index)
+            if faint_message:
+                entry += f" {faint_message}"
+        return BattleEvent("move", side_index, entry, data)
+
+    def _execute_switch(self, side_index: int, slot: Optional[int]) -> Optional[BattleEvent]:
+        if slot is None:
+            return None
+        side = self.sides[side_index]
+        if slot < 0 or slot >= len(side.team):
+            return None
+        side.active_index = slot
+        side.selection_mode = "menu"
+        return BattleEvent("switch", side_index, f"{side.participant.name} sent out {side.active().individual.get_title()}!", {"slot": slot})
+
+    def _execute_item(self, side_index: int, action: QueuedAction) -> Optional[BattleEvent]:
+        if not action.item_key:
+            return None
+        side = self.sides[side_index]
+        item = action.item
+        if item is None:
+            return BattleEvent("item_failed", side_index, f"{side.participant.name} tried to use an unknown item.", {"item": action.item_key})
+        if not action.item_spent:
+            return BattleEvent("item_failed", side_index, f"{side.participant.name} tried to use a {item['name']}, but didn't have one!", {"item": action.item_key})
+        heal_amount = int(item.get("battle_heal", 0))
+        healed = side.active().heal(heal_amount)
+        return BattleEvent("item", side_index, f"{side.participant.name} used {item['name']} and restored {healed} HP!", {"item": action.item_key, "healed": healed})
+
+    def calculate_damage(self, attacker: BattlePokemonState, defender: BattlePokemonState, move: moves.Move) -> int:
+        if move.category == "status" or move.power <= 0:
+            return 0
+        base, stab, effectiveness = attacker.damage_terms(move, defender, attacker.status == "burn")
+        if not effectiveness:
+            return 0
+        modifier = self.rng.uniform(0.85, 1.0)
+        damage = int(base * modifier * stab * effectiveness)
+        return max(1, damage)
+
+    def effectiveness(self, attacker: BattlePokemonState, defender: BattlePokemonState, move: moves.Move) -> float:
+        """The type multiplier of a move, or 1 for moves that don't deal damage."""
+        if move.category == "status" or move.power <= 0:
+            return 1.0
+        return attacker.damage_terms(move, defender)[2]
+
+    def _handle_faint(self, side_index: int) -> Optional[str]:
+        side = self.sides[side_index]
+        if side.participant.user_id is None:
+            if side.force_next_available():
+                self.pending_actions[side_index] = None
+                side.selection_mode = "menu"
+                return None
+        else:
+            if side.has_available_switch():
+                self.pending_actions[side_index] = None
+                side.selection_mode = "switch"
+                return f"{side.participant.name}, choose your next Pokémon!"
+        self.finished = True
+        self.winner = 1 - side_index
+        return None
+
+    def _apply_end_of_turn_status(self, side_index: int) -> Optional[BattleEvent]:
+        side = self.sides[side_index]
+        active = side.active()
+        if active.is_fainted() or not active.status:
+            return None
+        if active.status == "burn":
+            damage = max(1, active.max_hp() // 16)
+            message = f"{active.individual.get_title()} is hurt by its burn! (-{damage} HP)"
+        elif active.status == "poison":
+            damage = max(1, active.max_hp() // 8)
+            message = f"{active.individual.get_title()} is hurt by poison! (-{damage} HP)"
+        else:
+            return None
+        active.apply_damage(damage)
+        fainted = active.is_fainted()
+        if fainted:
+            faint_message = self._handle_faint(side_index)
+            if faint_message:
+                message += f" {faint_message}"
+        return BattleEvent("status_damage", side_index, message, {"status": active.status, "damage": damage, "fainted": fainted})
+
+    def xp_for_side(self, side_index: int) -> int:
+        opponent_index = 1 - side_index
+        defeated_levels = []
+        for mon in self.sides[opponent_index].team:
+            if mon.is_fainted():
+                defeated_levels.append(mon.individual.level)
+        if not defeated_levels:
+            return 0
+        base = sum(level for level in defeated_levels) // max(1, len(defeated_levels))
+        return max(10, base * 5)
@@ -0,0 +1,107 @@
+import asyncio
+import json
+import os
+
+"""
+This module keeps every user's battle history in its own append-only file.
+
+Each battle is one json line in data/battles/<uid>.jsonl. Recording a
+battle appends a line instead of rewriting the user record, and there is
+no cap on how long the history gets. The user record only keeps the
+totals, see battle_stats in user_schema.py.
+
+Reads stream the file rather than loading it: entries() goes oldest
+first, and recent() reads backwards from the end for history pages.
+A line cut short by a crash is skipped.
+"""
+
+
+def _reverse_lines(f, block_size=8192):
+    """Yield the lines of a binary file from last to first, reading it in blocks."""
+    f.seek(0, os.SEEK_END)
+    position = f.tell()
+    remainder = b""
+    while position > 0:
+        read_size = min(block_size, position)
+        position -= read_size
+        f.seek(position)
+        lines = (f.read(read_size) + remainder).split(b"\n")
+        # The first piece may be the end of a line from the previous block.
+        remainder = lines.pop(0)
+        for line in reversed(lines):
+            if line:
+                yield line
+    if remainder:
+        yield remainder
+
+
+def _decode(line):
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+
+class Battle_Log:
+    """Append-only battle history, one json lines file per user."""
+    def __init__(self, path_prefix):
+        self.path_prefix = path_prefix     # Directory (with trailing slash) holding the logs
+
+    def __str__(self):
+        return self.path_prefix
+
+    def _path(self, uid):
+        return f"{self.path_prefix}{uid}.jsonl"
+
+    def has_log(self, uid):
+        return os.path.exists(self._path(uid))
+
+    def append_many(self, uid, entries):
+        """Append entries to a user's log, in one write."""
+        if not entries:
+            return
+        os.makedirs(self.path_prefix, exist_ok=True)
+        payload = "".join(json.dumps(entry) + "\n" for entry in entries)
+        # One write to a file opened for appending, so concurrent appends don't interleave.
+        with open(self._path(uid), "a", encoding="utf-8") as f:
+            f.write(payload)
+
+    async def append(self, uid, entries):
+        """append_many(), without blocking the event loop."""
+        await asyncio.get_running_loop().run_in_executor(None, self.append_many, uid, entries)
+
+    def entries(self, uid):
+        """Stream a user's battles, oldest first."""
+        try:
+            f = open(self._path(uid), "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            for line in f:
+                entry = _decode(line)
+                if entry is not None:
+                    yield entry
+
+    def recent(self, uid, limit, skip=0):
+        """The newest battles first, skipping the first `skip`. Only reads as much of the file as it needs."""
+        found = []
+        try:
+            f = open(self._path(uid), "rb")
+        except FileNotFoundError:
+            return found
+        with f:
+            for line in _reverse_lines(f):
+                entry = _decode(line)
+                if entry is None:
+                    continue
+                if skip:
+                    skip -= 1
+                    continue
+                found.append(entry)
+                if len(found) >= limit:
+                    break
+        return found
+
+    async def arecent(self, uid, limit, skip=0):
+        """recent(), read off the event loop."""
+        return await asyncio.get_running_loop().run_in_executor(None, self.recent, uid, limit, skip)
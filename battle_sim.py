@@ -0,0 +1,448 @@
+import argparse
+import math
+import os
+import random
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import List, Optional, Sequence
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import classes
+from battle_engine import BattleEngine, BattleParticipant, BattlePokemonState, best_move
+
+"""
+This module plays the same battle many times to see who usually wins.
+
+simulate() runs battles through battle_engine.py with the AI choosing
+for both sides, spread over a process pool. Battle i always uses the
+random seed (seed, i), so the results don't depend on how many workers
+ran them. simulate_numpy() plays every battle at once as numpy arrays,
+which is much faster for big runs. It follows the same rules, but draws
+its random numbers differently, so it agrees with simulate() on average
+rather than battle by battle.
+
+Both return a SimulationResult with win rates, turns and damage, each
+with a 95% confidence interval.
+
+    python battle_sim.py "pikachu:25,bulbasaur:20" "charmander:30" --battles 10000 --seed 1
+
+Side 0 is the first party, side 1 the second.
+"""
+
+Z_95 = 1.96
+
+
+def wilson_interval(successes, trials, z=Z_95):
+    """Confidence interval for a rate, which stays sensible near 0 and 1."""
+    if not trials:
+        return (0.0, 0.0)
+    rate = successes / trials
+    denominator = 1 + z * z / trials
+    centre = (rate + z * z / (2 * trials)) / denominator
+    spread = z * math.sqrt(rate * (1 - rate) / trials + z * z / (4 * trials * trials)) / denominator
+    return (max(0.0, centre - spread), min(1.0, centre + spread))
+
+
+def _mean_interval(total, total_sq, count, z=Z_95):
+    if not count:
+        return (0.0, 0.0, 0.0)
+    mean = total / count
+    variance = max(0.0, total_sq / count - mean * mean)
+    spread = z * math.sqrt(variance / count)
+    return (mean, mean - spread, mean + spread)
+
+
+def _percentile(counts, fraction):
+    """The value below which `fraction` of a Counter of values falls."""
+    total = sum(counts.values())
+    if not total:
+        return 0
+    target = fraction * total
+    seen = 0
+    for value in sorted(counts):
+        seen += counts[value]
+        if seen >= target:
+            return value
+    return max(counts)
+
+
+@dataclass
+class SimulationResult:
+    """Totals over a batch of battles. Batches add up with merge()."""
+    battles: int = 0
+    wins: List[int] = field(default_factory=lambda: [0, 0])
+    draws: int = 0
+    turns: int = 0
+    turns_sq: int = 0
+    damage: List[int] = field(default_factory=lambda: [0, 0])      # Damage each side dealt, over every battle
+    damage_sq: List[int] = field(default_factory=lambda: [0, 0])
+    hits: List[Counter] = field(default_factory=lambda: [Counter(), Counter()])  # Damage of each hit -> how often
+
+    def add_battle(self, winner, turns, damage):
+        self.battles += 1
+        if winner is None:
+            self.draws += 1
+        else:
+            self.wins[winner] += 1
+        self.turns += turns
+        self.turns_sq += turns * turns
+        for side in (0, 1):
+            self.damage[side] += damage[side]
+            self.damage_sq[side] += damage[side] * damage[side]
+
+    def merge(self, other):
+        self.battles += other.battles
+        self.draws += other.draws
+        self.turns += other.turns
+        self.turns_sq += other.turns_sq
+        for side in (0, 1):
+            self.wins[side] += other.wins[side]
+            self.damage[side] += other.damage[side]
+            self.damage_sq[side] += other.damage_sq[side]
+            self.hits[side].update(other.hits[side])
+        return self
+
+    def win_rate(self, side):
+        return self.wins[side] / self.battles if self.battles else 0.0
+
+    def win_interval(self, side):
+        return wilson_interval(self.wins[side], self.battles)
+
+    def turns_interval(self):
+        """Average turns per battle, as (mean, low, high)."""
+        return _mean_interval(self.turns, self.turns_sq, self.battles)
+
+    def damage_interval(self, side):
+        """Average damage a side deals per battle, as (mean, low, high)."""
+        return _mean_interval(self.damage[side], self.damage_sq[side], self.battles)
+
+    def hit_percentiles(self, side, fractions=(0.1, 0.5, 0.9)):
+        return [_percentile(self.hits[side], fraction) for fraction in fractions]
+
+    def report(self, names=("Side 0", "Side 1")):
+        lines = [f"{self.battles} battles"]
+        for side in (0, 1):
+            low, high = self.win_interval(side)
+            lines.append(f"{names[side]} wins {self.win_rate(side):.1%} (95% CI {low:.1%} - {high:.1%})")
+        lines.append(f"Draws {self.draws / max(1, self.battles):.1%}")
+        mean, low, high = self.turns_interval()
+        lines.append(f"Turns {mean:.2f} (95% CI {low:.2f} - {high:.2f})")
+        for side in (0, 1):
+            mean, low, high = self.damage_interval(side)
+            p10, p50, p90 = self.hit_percentiles(side)
+            lines.append(
+                f"{names[side]} deals {mean:.1f} damage per battle (95% CI {low:.1f} - {high:.1f}), "
+                f"hits p10/p50/p90 {p10}/{p50}/{p90}"
+            )
+        return "\n".join(lines)
+
+
+def _decode_party(party) -> List[classes.Individual]:
+    decoded = []
+    for data in party:
+        mon = data if isinstance(data, classes.Individual) else classes.Individual.from_dict(data)
+        if mon:
+            decoded.append(mon)
+    return decoded
+
+
+def _run_chunk(party_a, party_b, seed, start, stop, max_turns) -> SimulationResult:
+    """Play battles start to stop. Top level so worker processes can call it."""
+    team_a = _decode_party(party_a)
+    team_b = _decode_party(party_b)
+    result = SimulationResult()
+    for battle in range(start, stop):
+        engine = BattleEngine(
+            BattleParticipant(None, "Side 0", team_a),
+            BattleParticipant(None, "Side 1", team_b),
+            rng=random.Random(f"{seed}:{battle}"),
+        )
+        damage = [0, 0]
+        for event in engine.play(max_turns):
+            if event.kind == "move" and event.data["damage"]:
+                damage[event.side] += event.data["damage"]
+                result.hits[event.side][event.data["damage"]] += 1
+        result.add_battle(engine.winner if engine.finished else None, engine.turn - 1, damage)
+    return result
+
+
+def simulate(
+    party_a: Sequence[classes.Individual],
+    party_b: Sequence[classes.Individual],
+    battles: int,
+    seed: int = 0,
+    workers: Optional[int] = None,
+    max_turns: int = 500,
+) -> SimulationResult:
+    """
+    Play `battles` battles between two parties with the battle engine.
+    workers=1 plays them in this process; by default there's one worker per core.
+    """
+    # Workers get the pokemon as dicts, which are cheaper to send than objects.
+    party_a = [mon.to_dict() for mon in party_a]
+    party_b = [mon.to_dict() for mon in party_b]
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or battles < 2:
+        return _run_chunk(party_a, party_b, seed, 0, battles, max_turns)
+    chunk = max(1, math.ceil(battles / (workers * 4)))
+    result = SimulationResult()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(_run_chunk, party_a, party_b, seed, start, min(start + chunk, battles), max_turns)
+            for start in range(0, battles, chunk)
+        ]
+        for future in futures:
+            result.merge(future.result())
+    return result
+
+
+# Status codes for the numpy path.
+NO_STATUS, BURN, PARALYSIS, POISON, SLEEP = range(5)
+STATUS_CODES = {None: NO_STATUS, "burn": BURN, "paralysis": PARALYSIS, "poison": POISON, "sleep": SLEEP}
+
+
+class _Matchup:
+    """Everything about two parties that doesn't change during a battle, as arrays."""
+    def __init__(self, team_a, team_b):
+        teams = ([BattlePokemonState(mon) for mon in team_a], [BattlePokemonState(mon) for mon in team_b])
+        self.slots = slots = max(len(team_a), len(team_b))
+        shape = (2, slots)
+        self.max_hp = numpy.zeros(shape, dtype=numpy.int64)   # [side, slot]. Empty slots have no hp, so they count as fainted
+        self.speed = numpy.zeros(shape, dtype=numpy.int64)
+        self.choice = numpy.zeros((2, slots, slots), dtype=numpy.intp)  # [side, slot, foe slot] -> the AI's move
+        for side, team in enumerate(teams):
+            for slot, mon in enumerate(team):
+                self.max_hp[side, slot] = mon.stats.hp
+                self.speed[side, slot] = mon.stats.speed
+
+        # Every move either side might use, so moves are indexed the same on both sides.
+        move_list = []
+        for side, team in enumerate(teams):
+            for slot, mon in enumerate(team):
+                for foe_slot, foe in enumerate(teams[1 - side]):
+                    move = best_move(mon, foe)
+                    if move not in move_list:
+                        move_list.append(move)
+                    self.choice[side, slot, foe_slot] = move_list.index(move)
+        self.priority = numpy.array([3 + move.priority for move in move_list], dtype=numpy.int64)
+        self.damaging = numpy.array([move.category != "status" and move.power > 0 for move in move_list])
+        self.heal = numpy.array([move.heal for move in move_list], dtype=numpy.int64)
+        self.status = numpy.array([STATUS_CODES.get(move.status, NO_STATUS) for move in move_list], dtype=numpy.int64)
+        self.status_chance = numpy.array([move.status_chance for move in move_list], dtype=numpy.float64)
+
+        # [side, move, attacker, defender]. The attacker isn't always the pokemon that picked the move,
+        # because one sent out mid-turn uses the move its fainted teammate picked.
+        count = len(move_list)
+        self.base = numpy.zeros((2, count, slots, slots))
+        self.base_burned = numpy.zeros((2, count, slots, slots))
+        self.stab = numpy.ones((2, count, slots))
+        self.effectiveness = numpy.ones((2, count, slots))  # [side, move, defender]
+        for side, team in enumerate(teams):
+            for index, move in enumerate(move_list):
+                if not self.damaging[index]:
+                    continue
+                for attacker_slot, attacker in enumerate(team):
+                    for defender_slot, defender in enumerate(teams[1 - side]):
+                        base, stab, effectiveness = attacker.damage_terms(move, defender)
+                        self.base[side, index, attacker_slot, defender_slot] = base
+                        self.base_burned[side, index, attacker_slot, defender_slot] = attacker.damage_terms(move, defender, True)[0]
+                        self.stab[side, index, attacker_slot] = stab
+                        self.effectiveness[side, index, defender_slot] = effectiveness
+
+
+class _Numpy_Battles:
+    """The state of many copies of one battle, advanced a turn at a time."""
+    def __init__(self, matchup, battles, rng):
+        self.m = matchup
+        self.rng = rng
+        self.hp = numpy.repeat(matchup.max_hp[None], battles, axis=0)                     # [battle, side, slot]
+        self.status = numpy.zeros_like(self.hp)
+        self.status_turns = numpy.zeros_like(self.hp)
+        alive = self.hp > 0
+        self.active = numpy.argmax(alive, axis=2)                                          # [battle, side]
+        self.finished = numpy.zeros(battles, dtype=bool)
+        self.winner = numpy.full(battles, -1)
+        self.turns = numpy.zeros(battles, dtype=numpy.int64)
+        self.damage = numpy.zeros((battles, 2), dtype=numpy.int64)
+        self.hits = ([], [])                                                               # Arrays of hit damage per side
+
+    def _faint(self, battles, side):
+        """Send out the next healthy pokemon where side's active one fainted, or end the battle."""
+        alive = self.hp[battles, side] > 0
+        has_next = alive.any(axis=1)
+        self.active[battles[has_next], side[has_next]] = numpy.argmax(alive[has_next], axis=1)
+        lost = battles[~has_next]
+        self.finished[lost] = True
+        self.winner[lost] = 1 - side[~has_next]
+
+    def _act(self, battles, side, move):
+        """One move per battle: side's active pokemon uses the queued move."""
+        m = self.m
+        going = ~self.finished[battles]
+        battles, side, move = battles[going], side[going], move[going]
+        attacker = self.active[battles, side]
+        foe = 1 - side
+        defender = self.active[battles, foe]
+        moving = self.hp[battles, side, attacker] > 0
+
+        status = self.status[battles, side, attacker]
+        asleep = moving & (status == SLEEP) & (self.status_turns[battles, side, attacker] > 0)
+        sleepers = (battles[asleep], side[asleep], attacker[asleep])
+        self.status_turns[sleepers] -= 1
+        woke = self.status_turns[sleepers] <= 0
+        self.status[tuple(index[woke] for index in sleepers)] = NO_STATUS
+        moving &= ~asleep
+        moving &= ~((status == PARALYSIS) & (self.rng.random(len(battles)) < 0.25))
+
+        battles, side, move, attacker, foe, defender = (
+            array[moving] for array in (battles, side, move, attacker, foe, defender)
+        )
+        burned = self.status[battles, side, attacker] == BURN
+        base = numpy.where(
+            burned,
+            m.base_burned[side, move, attacker, defender],
+            m.base[side, move, attacker, defender],
+        )
+        effectiveness = m.effectiveness[side, move, defender]
+        roll = self.rng.uniform(0.85, 1.0, len(battles))
+        damage = numpy.maximum(1, (base * roll * m.stab[side, move, attacker] * effectiveness).astype(numpy.int64))
+        damage = numpy.where(m.damaging[move] & (effectiveness > 0), damage, 0)
+        self.hp[battles, foe, defender] = numpy.maximum(0, self.hp[battles, foe, defender] - damage)
+        numpy.add.at(self.damage, (battles, side), damage)
+        for s in (0, 1):
+            dealt = damage[(side == s) & (damage > 0)]
+            if len(dealt):
+                self.hits[s].append(dealt)
+
+        heal = m.heal[move]
+        self.hp[battles, side, attacker] = numpy.minimum(
+            m.max_hp[side, attacker], self.hp[battles, side, attacker] + heal
+        )
+
+        inflicted = m.status[move]
+        lands = (
+            (inflicted != NO_STATUS)
+            & (effectiveness > 0)
+            & (self.hp[battles, foe, defender] > 0)
+            & (self.rng.random(len(battles)) <= m.status_chance[move])
+            & (self.status[battles, foe, defender] != inflicted)
+        )
+        targets = (battles[lands], foe[lands], defender[lands])
+        self.status[targets] = inflicted[lands]
+        self.status_turns[targets] = numpy.where(
+            inflicted[lands] == SLEEP, self.rng.integers(1, 4, int(lands.sum())), -1
+        )
+
+        fainted = self.hp[battles, foe, defender] <= 0
+        self._faint(battles[fainted], foe[fainted])
+
+    def _end_of_turn(self, battles, side):
+        going = ~self.finished[battles]
+        battles = battles[going]
+        active = self.active[battles, side]
+        hp = self.hp[battles, side, active]
+        status = self.status[battles, side, active]
+        max_hp = self.m.max_hp[side, active]
+        damage = numpy.where(status == BURN, numpy.maximum(1, max_hp // 16), 0)
+        damage = numpy.where(status == POISON, numpy.maximum(1, max_hp // 8), damage)
+        hurt = (hp > 0) & (damage > 0)
+        battles, active, damage = battles[hurt], active[hurt], damage[hurt]
+        self.hp[battles, side, active] = numpy.maximum(0, self.hp[battles, side, active] - damage)
+        fainted = self.hp[battles, side, active] <= 0
+        self._faint(battles[fainted], numpy.full(int(fainted.sum()), side))
+
+    def turn(self):
+        battles = numpy.flatnonzero(~self.finished)
+        active = self.active[battles]
+        queued = [self.m.choice[s, active[:, s], active[:, 1 - s]] for s in (0, 1)]
+        (priority_0, priority_1) = (self.m.priority[queued[s]] for s in (0, 1))
+        (speed_0, speed_1) = (self.m.speed[s, active[:, s]] for s in (0, 1))
+        ties = self.rng.random((len(battles), 2))
+        zero_first = (priority_0 > priority_1) | (
+            (priority_0 == priority_1) & ((speed_0 > speed_1) | ((speed_0 == speed_1) & (ties[:, 0] > ties[:, 1])))
+        )
+        first = numpy.where(zero_first, 0, 1)
+        second = 1 - first
+        queued = numpy.stack(queued, axis=1)
+        rows = numpy.arange(len(battles))
+        self._act(battles, first, queued[rows, first])
+        self._act(battles, second, queued[rows, second])
+        self.turns[battles] += 1
+        for side in (0, 1):
+            self._end_of_turn(battles, side)
+
+
+def simulate_numpy(
+    party_a: Sequence[classes.Individual],
+    party_b: Sequence[classes.Individual],
+    battles: int,
+    seed: int = 0,
+    max_turns: int = 500,
+) -> SimulationResult:
+    """Play `battles` battles between two parties at once, as arrays. Needs numpy."""
+    if numpy is None:
+        raise RuntimeError("simulate_numpy() needs numpy. Install it, or use simulate().")
+    if not party_a or not party_b:
+        raise ValueError("Battle cannot start with empty parties.")
+    state = _Numpy_Battles(_Matchup(list(party_a), list(party_b)), battles, numpy.random.default_rng(seed))
+    for _ in range(max_turns):
+        if state.finished.all():
+            break
+        state.turn()
+
+    result = SimulationResult(battles=battles)
+    for side in (0, 1):
+        result.wins[side] = int((state.winner == side).sum())
+        result.damage[side] = int(state.damage[:, side].sum())
+        result.damage_sq[side] = int((state.damage[:, side] ** 2).sum())
+        if state.hits[side]:
+            values, counts = numpy.unique(numpy.concatenate(state.hits[side]), return_counts=True)
+            result.hits[side] = Counter(dict(zip(values.tolist(), counts.tolist())))
+    result.draws = battles - sum(result.wins)
+    result.turns = int(state.turns.sum())
+    result.turns_sq = int((state.turns ** 2).sum())
+    return result
+
+
+def parse_party(text: str) -> List[classes.Individual]:
+    """Read a party like "pikachu:25,bulbasaur" or "25:30,1". Levels default to 5."""
+    party = []
+    for entry in text.split(","):
+        name, _, level = entry.strip().partition(":")
+        species = classes.get_species(int(name)) if name.isdigit() else classes.find_species(name)
+        if not species:
+            raise ValueError(f"Unknown pokemon {name!r}.")
+        party.append(classes.Individual(species, level=int(level) if level else 5))
+    return party
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Play the same battle many times and report who wins.")
+    parser.add_argument("party_a", help='first party, e.g. "pikachu:25,bulbasaur:20"')
+    parser.add_argument("party_b", help="second party")
+    parser.add_argument("--battles", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0, help="also picks the parties' IVs")
+    parser.add_argument("--workers", type=int, default=None, help="processes to use, one per core by default")
+    parser.add_argument("--max-turns", type=int, default=500, help="battles still going after this are draws")
+    parser.add_argument("--numpy", action="store_true", help="play every battle at once with numpy")
+    args = parser.parse_args()
+
+    # Individuals roll their IVs from the global random, so seed it for a repeatable matchup.
+    random.seed(args.seed)
+    party_a = parse_party(args.party_a)
+    party_b = parse_party(args.party_b)
+    if args.numpy:
+        result = simulate_numpy(party_a, party_b, args.battles, args.seed, args.max_turns)
+    else:
+        result = simulate(party_a, party_b, args.battles, args.seed, args.workers, args.max_turns)
+    names = [", ".join(mon.get_title() for mon in party) for party in (party_a, party_b)]
+    print(result.report(names))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import argparse
+import random
+import time
+
+from frequency_cache import Frequency_Cache
+
+"""
+Benchmark the Frequency_Cache eviction engine against the original
+scan-based implementation.
+
+Both caches are fed the same workload: fill the cache, then run a mix of
+hits on cached keys and inserts of new keys (which force an eviction).
+Everything stays in memory so only the cache bookkeeping is measured.
+
+Usage: python bench_frequency_cache.py [--ops 2000] [--sizes 100 1000 10000 100000]
+"""
+
+
+class Legacy_Frequency_Cache:
+    """The original in-memory bookkeeping: decay every count, scan to evict."""
+    def __init__(self, max_size, decay_factor=0.9):
+        self.max_size = max_size
+        self.cache = {}
+        self.access_count = {}
+        self.decay_factor = decay_factor
+
+    def __getitem__(self, key):
+        for k in self.access_count.keys():
+            self.access_count[k] *= self.decay_factor
+        self.access_count[key] += 1
+        return self.cache[key]
+
+    def __setitem__(self, key, newvalue):
+        self.cache[key] = newvalue
+        if key not in self.access_count:
+            self.access_count[key] = 0
+        if len(self.cache) > self.max_size:
+            least_accessed = min(self.cache, key=lambda k: (self.access_count[k], self.cache[k]))
+            self.cache.pop(least_accessed)
+
+
+def _workload(size, ops, hit_ratio, seed):
+    """Build a list of ("get"/"set", key) operations after a full prefill."""
+    rng = random.Random(seed)
+    cached = list(range(size))
+    next_key = size
+    plan = []
+    for _ in range(ops):
+        if rng.random() < hit_ratio:
+            plan.append(("get", rng.choice(cached)))
+        else:
+            plan.append(("set", next_key))
+            next_key += 1
+    return plan
+
+
+def _run(cache, size, plan):
+    for key in range(size):
+        cache[key] = key
+    get_time = 0.0
+    set_time = 0.0
+    for op, key in plan:
+        if op == "get":
+            if key not in cache.cache:
+                # Evicted earlier in the run; re-insert so both caches see the same work.
+                op = "set"
+            else:
+                start = time.perf_counter()
+                cache[key]
+                get_time += time.perf_counter() - start
+                continue
+        start = time.perf_counter()
+        cache[key] = key
+        set_time += time.perf_counter() - start
+    return get_time, set_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Frequency_Cache against the original implementation.")
+    parser.add_argument("--ops", type=int, default=2000, help="operations per cache size")
+    parser.add_argument("--hit-ratio", type=float, default=0.8, help="fraction of operations that are hits")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 100000])
+    parser.add_argument("--seed", type=int, default=151)
+    args = parser.parse_args()
+
+    print(f"{'size':>8} {'impl':>8} {'get us/op':>10} {'set us/op':>10} {'total s':>9}")
+    for size in args.sizes:
+        plan = _workload(size, args.ops, args.hit_ratio, args.seed)
+        gets = sum(1 for op, _ in plan if op == "get") or 1
+        sets = len(plan) - gets or 1
+        for name, cache in (
+            ("legacy", Legacy_Frequency_Cache(size)),
+            ("heap", Frequency_Cache(size, "", static=True)),
+        ):
+            get_time, set_time = _run(cache, size, plan)
+            print(
+                f"{size:>8} {name:>8} {get_time / gets * 1e6:>10.2f} "
+                f"{set_time / sets * 1e6:>10.2f} {get_time + set_time:>9.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import asyncio
+
+"""
+This module buffers the BP users earn by chatting.
+
+Chat BP used to load, update and save a whole user record for every
+message. Instead, BP_Ledger keeps a running total per user in memory and
+adds it to their record later: whenever the record is saved anyway, when
+it's evicted from the cache, every few seconds on a timer, and on shutdown.
+
+Anything that shows or spends BP should use balance() or settle(), so
+pending BP still counts.
+"""
+
+
+class BP_Ledger:
+    """Pending BP per user, folded into a Frequency_Cache of user records."""
+    def __init__(self, cache, flush_interval=30):
+        self.cache = cache                    # The Frequency_Cache holding user records
+        self.pending = {}                     # uid -> BP earned but not in the record yet
+        self.folded = {}                      # uid -> BP put in the record but not saved yet
+        self.flush_interval = flush_interval  # Seconds between timed flushes
+        self.flusher = None                   # Timed flush task, see start()
+        self.listeners = []                   # Called as callback(uid, delta) whenever BP is added
+        cache.add_listener(self._on_cache_event)
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def add(self, uid, delta):
+        self.pending[uid] = self.pending.get(uid, 0) + delta
+        for callback in self.listeners:
+            callback(uid, delta)
+
+    def pending_for(self, uid):
+        return self.pending.get(uid, 0)
+
+    def balance(self, uid, user):
+        """A user's BP, counting what hasn't been folded into their record yet."""
+        return user.get("bp", 0) + self.pending.get(uid, 0)
+
+    def _fold(self, uid, user):
+        delta = self.pending.pop(uid, 0)
+        if delta:
+            user["bp"] = user.get("bp", 0) + delta
+            self.folded[uid] = self.folded.get(uid, 0) + delta
+        return delta
+
+    def settle(self, uid, user):
+        """Fold a user's pending BP into their record and save it. Returns the BP added."""
+        delta = self._fold(uid, user)
+        if delta:
+            self.cache.save_item(uid)
+        return delta
+
+    def _on_cache_event(self, uid, event):
+        if event == "rollback":
+            # The record went back to before the BP was added, so it's pending again.
+            delta = self.folded.pop(uid, 0)
+            if delta:
+                self.pending[uid] = self.pending.get(uid, 0) + delta
+            return
+        if uid in self.pending and uid in self.cache.cache:
+            if event == "evict":
+                # Last chance to reach the record while it's in memory.
+                self.settle(uid, self.cache.cache[uid])
+            elif event == "save":
+                # It's being written anyway, so the BP comes along for free.
+                self._fold(uid, self.cache.cache[uid])
+        if event == "save":
+            self.folded.pop(uid, None)
+
+    async def flush(self):
+        """Fold every pending total into its record. Returns how many users were updated."""
+        count = 0
+        for uid in list(self.pending):
+            # Locked, so the BP isn't folded into a record in the middle of someone else's transaction.
+            async with self.cache.locked(uid):
+                try:
+                    user = await self.cache.aget(uid)
+                except FileNotFoundError:
+                    # The user is gone, so is their BP.
+                    self.pending.pop(uid, None)
+                    continue
+                if self.settle(uid, user):
+                    count += 1
+        return count
+
+    def flush_now(self):
+        """Blocking flush(), for shutdown when there is no event loop."""
+        count = 0
+        for uid in list(self.pending):
+            try:
+                user = self.cache[uid]
+            except FileNotFoundError:
+                self.pending.pop(uid, None)
+                continue
+            if self.settle(uid, user):
+                count += 1
+        return count
+
+    async def run(self):
+        """Flush forever. Run this as a task on the bot's event loop."""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except OSError as e:
+                print(f"BP ledger flush failed: {e}")
+
+    def start(self):
+        """Start the timed flush once. Safe to call on every reconnect."""
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.create_task(self.run())
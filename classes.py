@@ -3,11 +3,12 @@ from __future__ import annotations
 from enum import Enum
 from functools import lru_cache
 from typing import Dict, Iterable, List, Optional, Sequence
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, fields
 import random
 import uuid
 import math
 
+import dex_table
 import moves
 import evolutions
 
@@ -53,7 +54,7 @@ type_names = [
     
 Elemental_Type = Enum("Elemental_Type", type_names)
 
-@dataclass
+@dataclass(frozen=True)
 class Species():
     
     pokedex_number : int
@@ -173,21 +174,103 @@ class Species():
         growth_rate     = d[27]
         )
     
+    def to_row(self) -> Dict:
+        """Flatten into plain values, with types as their enum value (0 for none)."""
+        row = {f.name: getattr(self, f.name) for f in fields(self)}
+        row["type_1"] = self.type_1.value
+        row["type_2"] = self.type_2.value if self.type_2 else 0
+        return row
+
+    @classmethod
+    def from_row(cls, row):
+        """Inverse of to_row()."""
+        values = dict(row)
+        values["type_1"] = Elemental_Type(values["type_1"])
+        values["type_2"] = Elemental_Type(values["type_2"]) if values["type_2"] else None
+        return cls(**values)
+
     @classmethod
     def load_index(cls, pokedex_number, file_path = "data/pokedex.csv"):
         """
-        Load a species from a csv file.
+        Look up a species by national dex number.
         
-        This is done by simply looping through the list until we find the right natdexno.
+        The csv is only parsed once, see species_registry().
         """
-        with open(file_path, "r", encoding="utf-8") as f:
-            
-            for dexentry in f.read().splitlines():
-                d = dexentry.split(",")
-                
-                if str(pokedex_number) == d[1]:
-                    # Use int(float()) pattern to convert "18.0" into 18.
-                    return Species.from_data(d)
+        return species_registry(file_path).get(pokedex_number)
+
+
+class Species_Registry():
+    """
+    Every species in a pokedex csv, parsed once.
+    
+    Species are frozen, so the same instance is shared by every
+    individual of that species instead of each one parsing its own.
+    The rows come from the compiled table in dex_table.py when possible,
+    which is rebuilt whenever the csv changes.
+    """
+    def __init__(self, file_path = "data/pokedex.csv"):
+        self.file_path = file_path
+        self.species: List[Species] = []        # Every row, in csv order
+        self.by_number: Dict[int, Species] = {}
+        self.by_name: Dict[str, Species] = {}
+        self.table = dex_table.load(file_path, parse_pokedex_rows)  # None if it couldn't be compiled
+        rows = self.table.rows() if self.table else parse_pokedex_rows(file_path)
+        for row in rows:
+            spec = Species.from_row(row)
+            self.species.append(spec)
+            # Alternate forms share a dex number; the first row is the base form.
+            self.by_number.setdefault(spec.pokedex_number, spec)
+            self.by_name.setdefault(spec.name.lower(), spec)
+
+    def __iter__(self):
+        return iter(self.species)
+
+    def __len__(self):
+        return len(self.species)
+
+    def get(self, pokedex_number) -> Optional[Species]:
+        """Find a species by dex number. Accepts ints or numeric strings."""
+        try:
+            return self.by_number.get(int(pokedex_number))
+        except (TypeError, ValueError):
+            return None
+
+    def find(self, name: str) -> Optional[Species]:
+        """Find a species by name, ignoring case."""
+        return self.by_name.get(str(name).strip().lower())
+
+
+def parse_pokedex_rows(file_path = "data/pokedex.csv") -> List[Dict]:
+    """Parse every species row of a pokedex csv into plain row dicts."""
+    rows = []
+    with open(file_path, "r", encoding="utf-8") as f:
+        for dexentry in f.read().splitlines():
+            d = dexentry.split(",")
+            if len(d) < 25 or d[1] == "pokedex_number":
+                continue
+            rows.append(Species.from_data(d).to_row())
+    return rows
+
+
+def species_registry(file_path = "data/pokedex.csv") -> Species_Registry:
+    """The shared registry for a pokedex csv, loaded on first use."""
+    return _load_registry(file_path)
+
+
+@lru_cache(maxsize=None)
+def _load_registry(file_path):
+    # Always called positionally, so every caller shares one cache entry per file.
+    return Species_Registry(file_path)
+
+
+def get_species(pokedex_number) -> Optional[Species]:
+    """Look up a species by dex number in the default pokedex."""
+    return species_registry().get(pokedex_number)
+
+
+def find_species(name: str) -> Optional[Species]:
+    """Look up a species by name in the default pokedex."""
+    return species_registry().find(name)
 
 
 @dataclass
@@ -389,7 +472,9 @@ class Individual():
             return None
 
         nickname = data.get("nickname")
-        species = Species.load_index(data["species"])
+        species = get_species(data["species"])
+        if not species:
+            return None
         level = data.get("level", 1)
         shiny = data.get("shiny", False)
         instance_id = data.get("uid")
@@ -434,27 +519,54 @@ class Individual():
                 self.moves = self._normalise_moves(self.moves)
         evo = evolutions.next_evolution(self.species.pokedex_number, self.level)
         if evo:
-            new_species = Species.load_index(evo)
+            new_species = get_species(evo)
             if new_species:
                 self.species = new_species
                 self.moves = self._normalise_moves(self.moves)
                 events["evolution"].append(f"Evolved into {self.species.name}!")
         return events
 
+
+class Individual_Map():
+    """
+    Identity map of decoded individuals, grouped by owner and keyed by uid.
+
+    decode() hands back the same Individual for as long as the stored dict
+    it came from is the one in the roster, so a command decodes each pokemon
+    at most once. Call forget() with the owner whenever their record is
+    written, so the next decode sees what was saved.
+    """
+    def __init__(self):
+        self.owners: Dict[object, Dict[str, tuple]] = {}  # owner -> {uid: (stored dict, Individual)}
+
+    def decode(self, owner, data) -> Optional[Individual]:
+        instance_id = data.get("uid") if isinstance(data, dict) else None
+        decoded = self.owners.setdefault(owner, {})
+        entry = decoded.get(instance_id)
+        if entry and entry[0] is data:
+            return entry[1]
+        mon = Individual.from_dict(data)
+        # Dicts without a uid get a fresh one every decode, so there's nothing to key them by.
+        if mon and instance_id:
+            decoded[instance_id] = (data, mon)
+        return mon
+
+    def forget(self, owner):
+        self.owners.pop(owner, None)
+
+
+DECODED = Individual_Map()  # Shared by everything that decodes user rosters
+
+
 @lru_cache(maxsize=1)
 def _encounter_table(file_path="data/pokedex.csv"):
-    """Load every catchable species once and cache the cumulative rates."""
+    """Build the cumulative catch rates of every species once."""
     table = []
     running_total = 0
-    with open(file_path, "r", encoding="utf-8") as f:
-        for dexentry in f.read().splitlines():
-            d = dexentry.split(",")
-            if len(d) < 25 or d[1] == "pokedex_number":
-                continue
-            spec = Species.from_data(d)
-            cr = spec.catch_rate if spec.catch_rate else 1
-            running_total += cr
-            table.append((running_total, spec))
+    for spec in species_registry(file_path):
+        cr = spec.catch_rate if spec.catch_rate else 1
+        running_total += cr
+        table.append((running_total, spec))
     return table, running_total
 
 
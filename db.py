@@ -1,16 +1,93 @@
+import atexit
+
+from battle_log import Battle_Log
+from bp_ledger import BP_Ledger
 from frequency_cache import Frequency_Cache
+from leaderboards import Leaderboards
+from storage import Log_Storage, Sqlite_Storage
+import user_schema
 
 """
 This module stores references to cache objects so other modules can access them.
 """
 
-USERS = Frequency_Cache(100, "data/users/", static=False)
+# "json" keeps one file per user in data/users/, which suits small servers.
+# "sqlite" keeps every user in data/users.sqlite3.
+# "log" appends users to segment files in data/users_log/.
+# Move existing users over with one of
+# python storage.py migrate data/users/ data/users.sqlite3
+# python storage.py migrate data/users/ data/users_log/ --backend log
+USER_BACKEND = "json"
+
+# PC boxes use the same kind of storage, see BOXES below.
+if USER_BACKEND == "sqlite":
+    user_storage = Sqlite_Storage("data/users.sqlite3")
+    box_storage = Sqlite_Storage("data/users.sqlite3", table="boxes")
+elif USER_BACKEND == "log":
+    user_storage = Log_Storage("data/users_log/")
+    box_storage = Log_Storage("data/boxes_log/")
+else:
+    user_storage = None
+    box_storage = None
+# Old user records are brought up to date as they're loaded, see user_schema.py.
+USERS = Frequency_Cache(100, "data/users/", static=False, write_delay=5, storage=user_storage, upgrade=user_schema.upgrade_on_load)
+# Each user's older pokemon, kept out of their record so it stays small. Only loaded to view or withdraw them.
+BOXES = Frequency_Cache(20, "data/boxes/", static=False, write_delay=5, storage=box_storage)
 ITEMS = Frequency_Cache(100, "data/items/")
+# Every battle ever fought, appended per user. Records only keep the totals.
+BATTLE_LOG = Battle_Log("data/battles/")
+# Before anything loads a record, since upgrading old ones moves their history into the log.
+user_schema.battle_log = BATTLE_LOG
+# Chat BP waits here and is added to USERS records in batches.
+BP_LEDGER = BP_Ledger(USERS)
+# Sorted as records are saved, so a top 10 never touches the disk.
+LEADERBOARDS = Leaderboards(USERS, BP_LEDGER, "data/leaderboards.json")
+
+exit_hooks = False  # Set once start_flushers() has registered the exit-time save
 
 
 
 def save_db():
     print("Saving databases...")
-    dexes = [USERS]
+    BP_LEDGER.flush_now()
+    # Moving a pokemon between a record and its box writes one of them straight away (see users.py),
+    # so whatever order these are saved in, a pokemon is never missing from both.
+    dexes = [BOXES, USERS]
     for dex in dexes:
-        dex.save_items() # Static dexes will ignore this.
\ No newline at end of file
+        dex.save_items() # Static dexes will ignore this.
+    # Last, so the boards are only marked as matching the store once it's all written.
+    LEADERBOARDS.close()
+
+
+async def asave_db():
+    """save_db() for a running bot: writes everything buffered without blocking the event loop."""
+    await BP_LEDGER.flush()
+    # Battle log entries are appended as they happen, so there's nothing of theirs to save.
+    for dex in [BOXES, USERS, ITEMS]:
+        await dex.aflush(force=True) # Static dexes will ignore this.
+    await LEADERBOARDS.asave()
+
+
+def start_flushers():
+    """Start writing changed records in the background. Call once the bot is running."""
+    global exit_hooks
+    if not exit_hooks:
+        # Make sure buffered writes reach the disk however the process exits.
+        # Only the bot does this: anything else importing this module, like a script,
+        # must never save its stale copies over the bot's.
+        # atexit runs these last-registered first, so the save happens before the close.
+        atexit.register(close_db)
+        atexit.register(save_db)
+        exit_hooks = True
+    USERS.start_write_behind()
+    BOXES.start_write_behind()
+    BP_LEDGER.start()
+    LEADERBOARDS.start()
+    USERS.start_index_watcher()
+    USERS.start_storage_maintenance()
+    BOXES.start_storage_maintenance()
+
+
+def close_db():
+    USERS.storage.close()
+    BOXES.storage.close()
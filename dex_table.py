@@ -0,0 +1,196 @@
+import mmap
+import os
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+"""
+This module compiles the pokedex csv into a binary table that loads instantly.
+
+The csv stays the source of truth. The compiled copy sits next to it
+(data/pokedex.bin) and remembers the csv's mtime and size, so editing the
+csv makes the next load recompile it automatically.
+
+The table is column-major: every numeric column is one contiguous array,
+and every text column is an array of offsets into a shared string blob.
+Loading just memory-maps the file, and column() hands back a zero-copy
+view of a whole column (a numpy array when numpy is installed).
+
+To compile by hand: python dex_table.py data/pokedex.csv
+"""
+
+MAGIC = b"PKDX"
+VERSION = 1
+HEADER = struct.Struct("<4sHIqq")  # magic, version, row count, csv mtime_ns, csv size
+ALIGN = 8
+
+# (column, struct format) for every numeric Species field.
+# Elemental types are stored as their enum value, with 0 meaning no type.
+NUMERIC_COLUMNS = (
+    ("pokedex_number", "i"),
+    ("generation", "h"),
+    ("type_1", "B"),
+    ("type_2", "B"),
+    ("hp", "H"),
+    ("attack", "H"),
+    ("defense", "H"),
+    ("sp_attack", "H"),
+    ("sp_defense", "H"),
+    ("speed", "H"),
+    ("catch_rate", "H"),
+)
+
+# Every text Species field, stored exactly as the csv had it.
+STRING_COLUMNS = (
+    "name",
+    "status",
+    "pokedex_species",
+    "height_m",
+    "weight_kg",
+    "ability_1",
+    "ability_2",
+    "ability_hidden",
+    "base_friendship",
+    "base_experience",
+    "growth_rate",
+)
+
+
+def compiled_path(csv_path):
+    return os.path.splitext(csv_path)[0] + ".bin"
+
+
+def _aligned(position):
+    return (position + ALIGN - 1) // ALIGN * ALIGN
+
+
+def _layout(count):
+    """Work out where each column starts for a table of `count` rows."""
+    offsets = {}
+    position = _aligned(HEADER.size)
+    for name, fmt in NUMERIC_COLUMNS:
+        offsets[name] = position
+        position = _aligned(position + count * struct.calcsize(fmt))
+    for name in STRING_COLUMNS:
+        offsets[name] = position
+        position = _aligned(position + (count + 1) * 4)
+    return offsets, position
+
+
+def compile_table(rows, csv_path, out_path=None):
+    """
+    Write rows (dicts holding every column) to a binary table.
+    The csv's mtime and size are stamped in the header for staleness checks.
+    """
+    out_path = out_path or compiled_path(csv_path)
+    stat = os.stat(csv_path)
+    count = len(rows)
+    offsets, blob_start = _layout(count)
+    buffer = bytearray(blob_start)
+    HEADER.pack_into(buffer, 0, MAGIC, VERSION, count, stat.st_mtime_ns, stat.st_size)
+    for name, fmt in NUMERIC_COLUMNS:
+        values = [row[name] for row in rows]
+        struct.pack_into(f"<{count}{fmt}", buffer, offsets[name], *values)
+    blob = bytearray()
+    for name in STRING_COLUMNS:
+        # Offsets into the blob, with one extra entry for the end of the last string.
+        bounds = [len(blob)]
+        for row in rows:
+            blob += str(row[name]).encode("utf-8")
+            bounds.append(len(blob))
+        struct.pack_into(f"<{count + 1}I", buffer, offsets[name], *bounds)
+    temp_path = f"{out_path}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(buffer)
+        f.write(blob)
+    os.replace(temp_path, out_path)
+    return out_path
+
+
+class Dex_Table:
+    """A compiled pokedex, memory-mapped read-only."""
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, mtime_ns, size = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.map.close()
+            raise ValueError(f"{path} is not a version {VERSION} pokedex table.")
+        self.count = count
+        self.source_mtime_ns = mtime_ns
+        self.source_size = size
+        self.offsets, self.blob_start = _layout(count)
+        self.formats = dict(NUMERIC_COLUMNS)
+
+    def __len__(self):
+        return self.count
+
+    def matches(self, csv_path):
+        """True if the table was compiled from the csv as it is now."""
+        stat = os.stat(csv_path)
+        return stat.st_mtime_ns == self.source_mtime_ns and stat.st_size == self.source_size
+
+    def column(self, name):
+        """A zero-copy view of a whole numeric column."""
+        fmt = self.formats[name]
+        start = self.offsets[name]
+        end = start + self.count * struct.calcsize(fmt)
+        if numpy is not None:
+            return numpy.frombuffer(self.map, dtype=numpy.dtype("<" + fmt), count=self.count, offset=start)
+        return memoryview(self.map)[start:end].cast(fmt)
+
+    def string(self, name, index):
+        start, end = struct.unpack_from("<2I", self.map, self.offsets[name] + index * 4)
+        return self.map[self.blob_start + start:self.blob_start + end].decode("utf-8")
+
+    def row(self, index):
+        """Decode one row into a dict of every column."""
+        row = {}
+        for name, fmt in NUMERIC_COLUMNS:
+            row[name] = struct.unpack_from("<" + fmt, self.map, self.offsets[name] + index * struct.calcsize(fmt))[0]
+        for name in STRING_COLUMNS:
+            row[name] = self.string(name, index)
+        return row
+
+    def rows(self):
+        return [self.row(index) for index in range(self.count)]
+
+    def close(self):
+        self.map.close()
+
+
+def load(csv_path, parse_rows):
+    """
+    Open the compiled table for a csv, compiling it first if it is missing or stale.
+
+    parse_rows is called with the csv path to get fresh rows when a compile is needed.
+    Returns None if the table can't be built, so callers can fall back to the csv.
+    """
+    path = compiled_path(csv_path)
+    try:
+        table = Dex_Table(path)
+        if table.matches(csv_path):
+            return table
+        table.close()
+    except (OSError, ValueError, struct.error):
+        pass
+    try:
+        compile_table(parse_rows(csv_path), csv_path, path)
+        return Dex_Table(path)
+    except (OSError, ValueError, struct.error) as e:
+        print(f"Couldn't compile {csv_path} into {path}, reading the csv instead: {e}")
+        return None
+
+
+if __name__ == "__main__":
+    import sys
+
+    import classes
+
+    csv_path = sys.argv[1] if len(sys.argv) > 1 else "data/pokedex.csv"
+    out = compile_table(classes.parse_pokedex_rows(csv_path), csv_path)
+    print(f"Compiled {csv_path} into {out}.")
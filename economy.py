@@ -1,6 +1,7 @@
 import discobot_modules.text_coloring as tc
 from db import USERS
 from db import ITEMS
+from db import BP_LEDGER
 import embeds
 
 """
@@ -21,17 +22,18 @@ async def buy(message, item_key):
         print(f"{tc.R}Cannot grant item {tc.W}\"{item_key}\"{tc.R} No item exists.{tc.W}")
         return
     item = ITEMS[item_key]
-    user = USERS[uid]
     item_name = item["name"]
-    if user["bp"] < item["price"]:
+    # Perform Transaction
+    # The balance is checked inside it, so two purchases at once can't both spend the same BP.
+    async with USERS.transaction(uid) as user:
+        BP_LEDGER.settle(uid, user)
+        affordable = user["bp"] >= item["price"]
+        if affordable:
+            await user_gain_item(uid, item_key)
+            user["bp"] -= item["price"]
+    if not affordable:
         await message.reply(f"You're too poor to afford a {item_name}. Come back when you're a little... *mmmm...* Richer.")
         return
-    # Perform Transaction
-    user_gain_item(uid, item_key)
-    user = USERS[uid]
-    user["bp"] -= item["price"]
-    USERS[uid] = user
-    USERS.save_item(uid)
     await message.reply(f"Here's your {item_name}! We hope to see you again!")
         
     
@@ -41,7 +43,7 @@ def user_item_count(uid, item_key):
         return 0
     return USERS[uid]["items"][item_key]
 
-def user_gain_item(uid, item_key, qty=1):
+async def user_gain_item(uid, item_key, qty=1):
     """
     Grant an item to a user and save to db.
     
@@ -54,16 +56,15 @@ def user_gain_item(uid, item_key, qty=1):
     if qty < 0:
         print(f"{tc.O}Warning: tried to give {qty} {tc.W}\"{item_key}\"{tc.O} to user {tc.B}{uid}{tc.O}\nQuantity converted to positive.{tc.W}")
         qty = -qty
-    user = USERS[uid]
+    user = await USERS.aget(uid)
     if item_key not in user["items"]:
         user["items"][item_key] = qty
     else:
         user["items"][item_key] += qty
 
-    USERS[uid] = user
-    USERS.save_item(uid)
+    await USERS.aput(uid, user)
 
-def user_spend_item(uid, item_key, qty=1):
+async def user_spend_item(uid, item_key, qty=1):
     """
     Take an item from a user and save to db
     
@@ -78,12 +79,11 @@ def user_spend_item(uid, item_key, qty=1):
     if qty < 0:
         print(f"{tc.O}Warning: tried to give {qty} {tc.W}\"{item_key}\"{tc.O} to user {tc.B}{uid}{tc.O}\nQuantity converted to positive.{tc.W}")
         qty = -qty
-    user = USERS[uid]
+    user = await USERS.aget(uid)
     if item_key not in user["items"]:
         return False
     if user["items"][item_key] < qty:
         return False
     user["items"][item_key] -= qty
-    USERS[uid] = user
-    USERS.save_item(uid)
+    await USERS.aput(uid, user)
     return True
@@ -3,13 +3,16 @@ import discord
 from discobot_modules.graphics import moon_bar
 from db import USERS
 from db import ITEMS
+from db import BP_LEDGER
+from db import LEADERBOARDS
+from leaderboards import user_wincount, user_winlossratio
 import classes
 from economy import user_item_count
-from pathlib import Path
 from typing import Iterable, List, Sequence, TYPE_CHECKING
 
 if TYPE_CHECKING:
     from battle import BattleParticipant, BattleResult
+    from users import Collection_Page
 
 """
 This module defines all the embeds that the bot can display.
@@ -40,9 +43,11 @@ def help():
     em.add_field(name="!shop", value="Show the shop screen, so you can buy items.", inline=False)
     em.add_field(name="!pokedex", value="View the pokedex. Type !pokedex 151 to see a specific pokemon.")
     em.add_field(name="!summary", value="Take a look at your own pokemon. type a number to see a specific one of your mons.")
+    em.add_field(name="!box", value="Browse your whole collection a page at a time. Filter with a species, `shiny` or `lv20`, and sort by `level`, `species` or `recent`.", inline=False)
     em.add_field(name="!party", value="Review and edit your battling party. Try `!party add 3` to add a caught Pokémon.", inline=False)
     em.add_field(name="!train", value="Spend BP to boost your party's stats, e.g. `!train 1 attack`.", inline=False)
     em.add_field(name="!battle", value="Challenge another trainer with your party using `!battle @trainer` and pick moves with the reaction controls.")
+    em.add_field(name="!history", value="Look back through every battle you've fought, newest first.")
     em.add_field(name="!dev", value="Check out the bot creator and read Mew's source code!")
     #em.add_field(name="!leaderboard", value="Display the leaderboard of today's top players.")
     return em
@@ -85,47 +90,19 @@ def plug():
 # Profile Embeds
 ############################
 
-def _battle_value(entry) -> float:
-    if isinstance(entry, dict):
-        outcome = entry.get("outcome")
-        if outcome == "win":
-            return 1.0
-        if outcome == "draw":
-            return 0.5
-        return 0.0
-    if isinstance(entry, (list, tuple)) and entry:
-        try:
-            return float(entry[0])
-        except (TypeError, ValueError):
-            return 0.0
-    return 0.0
-
-
-def user_wincount(user):
-    total = 0
-    for battle in user.get("battles", []):
-        if isinstance(battle, dict):
-            if battle.get("outcome") == "win":
-                total += 1
-        elif isinstance(battle, (list, tuple)) and battle:
-            if battle[0] == 1:
-                total += 1
-    return total
-
-
-def user_winlossratio(user):
-    battles = user.get("battles", [])
-    if not battles:
-        return 0
-    total = 0
-    for battle in battles:
-        total += _battle_value(battle)
-    return total / len(battles)
-
-def profile(user):
+def _collection_lines(collection: "Collection_Page", levels=True):
+    lines = []
+    for number, mon in collection.entries:
+        shiny = " ✨" if mon.shiny else ""
+        level = f" Lv{mon.level}" if levels else ""
+        lines.append(f"{number}. {mon.get_title()}{level}{shiny}")
+    return lines
+
+
+def profile(user, party_members: Sequence[classes.Individual], collection: "Collection_Page"):
 
     udic = USERS[user.id]
-    bp = udic.get("bp", 0)
+    bp = BP_LEDGER.balance(user.id, udic)
     wins = user_wincount(udic)
     wlr = user_winlossratio(udic)
     desc = f":coin:{bp}\n:trophy:{wins}\n:lifter:{wlr:.2f}"
@@ -134,31 +111,19 @@ def profile(user):
     if getattr(user, "display_avatar", None):
         em.set_thumbnail(url=user.display_avatar.url)
 
-    roster_map = {}
-    collection = []
-    for index, mon_data in enumerate(udic.get("pokemon", []), start=1):
-        mon = classes.Individual.from_dict(mon_data)
-        if not mon:
-            continue
-        roster_map[mon_data.get("uid")] = mon
-        if len(collection) < 10:
-            shiny = " ✨" if mon.shiny else ""
-            collection.append(f"{index}. {mon.get_title()}{shiny}")
-
     party_lines = []
-    for idx, mon_id in enumerate(udic.get("party", []), start=1):
-        mon = roster_map.get(mon_id)
-        if not mon:
-            continue
+    for idx, mon in enumerate(party_members, start=1):
         shiny = " ✨" if mon.shiny else ""
         party_lines.append(f"{idx}. {mon.get_title()} Lv{mon.level}{shiny}")
     party_text = "\n".join(party_lines) if party_lines else "Set your party with `!party add <number>`."
 
     em.add_field(name="Party", value=party_text, inline=False)
 
-    pkcount = len(roster_map)
-    collection_text = "\n".join(collection) if collection else "None yet."
-    em.add_field(name=f"Caught Pokémon: {pkcount}", value=collection_text, inline=False)
+    collection_lines = _collection_lines(collection, levels=False)
+    if collection.pages > 1 or collection.hidden:
+        collection_lines.append("… see the rest with `!box`")
+    collection_text = "\n".join(collection_lines) if collection_lines else "None yet."
+    em.add_field(name=f"Caught Pokémon: {collection.total + collection.hidden}", value=collection_text, inline=False)
 
     em.add_field(name="Items", value="—", inline=False)
     em.add_field(name="<:poke:1092956340349046844> Pokeball", value=str(user_item_count(user.id, "pokeball")))
@@ -168,7 +133,7 @@ def profile(user):
     return em
 
 
-def party(user, party_members: Sequence[classes.Individual], roster_members: Sequence[classes.Individual], note: str = ""):
+def party(user, party_members: Sequence[classes.Individual], collection: "Collection_Page", note: str = ""):
     title = getattr(user, "display_name", None) or getattr(user, "name", "Trainer")
     description = note or "Use `!party add <number>` to add Pokémon from your collection."
     em = discord.Embed(title=f"{title}'s Party", description=description, color=0x5B6EE1)
@@ -185,21 +150,50 @@ def party(user, party_members: Sequence[classes.Individual], roster_members: Seq
     else:
         em.add_field(name="Active Party", value="No Pokémon selected. Try `!party add 1`.", inline=False)
 
-    if roster_members:
-        lines = []
-        for idx, mon in enumerate(roster_members, start=1):
-            shiny = " ✨" if mon.shiny else ""
-            lines.append(f"{idx}. {mon.get_title()} Lv{mon.level}{shiny}")
-            if idx == 20:
-                lines.append("…")
-                break
-        em.add_field(name="Collection", value="\n".join(lines), inline=False)
+    if collection.entries:
+        name = "Collection"
+        if collection.pages > 1:
+            name += f" (page {collection.page}/{collection.pages})"
+        lines = _collection_lines(collection)
+        if collection.hidden:
+            lines.append(f"+ {collection.hidden} more in your PC box, see `!box`")
+        em.add_field(name=name, value="\n".join(lines), inline=False)
     else:
         em.add_field(name="Collection", value="You haven't caught any Pokémon yet.", inline=False)
 
     return em
 
 
+def box(user, collection: "Collection_Page", options: dict):
+    title = getattr(user, "display_name", None) or getattr(user, "name", "Trainer")
+    shown = []
+    if options.get("species") is not None:
+        spec = classes.get_species(options["species"])
+        shown.append(spec.name if spec else f"#{options['species']}")
+    if options.get("shiny"):
+        shown.append("shiny")
+    if options.get("min_level"):
+        shown.append(f"Lv{options['min_level']}+")
+    if options.get("sort", "caught") != "caught":
+        shown.append(f"by {options['sort']}")
+    description = ", ".join(shown) if shown else "Every Pokémon you've caught."
+    em = discord.Embed(title=f"{title}'s Box", description=description, color=0x5B6EE1)
+
+    if getattr(user, "display_avatar", None):
+        em.set_thumbnail(url=user.display_avatar.url)
+
+    if collection.entries:
+        em.add_field(
+            name=f"{collection.total} Pokémon (page {collection.page}/{collection.pages})",
+            value="\n".join(_collection_lines(collection)),
+            inline=False,
+        )
+    else:
+        em.add_field(name="Nothing here", value="No Pokémon match that search.", inline=False)
+    em.set_footer(text="Try `!box 2`, `!box shiny`, `!box level`, `!box recent` or `!box pikachu lv20`.")
+    return em
+
+
 ############################
 # Pokemon Embeds
 ############################
@@ -244,7 +238,7 @@ def pokedex(pokemon_id):
     if pokemon_id < 1:
         pokemon_id = 890
     
-    pkmn = classes.Species.load_index(pokemon_id)
+    pkmn = classes.get_species(pokemon_id)
     title= f"{pkmn.name} #{pokemon_id}"
     poketypes = pkmn.get_elemental_typing()
     poketypes = [x.name for x in poketypes]
@@ -416,50 +410,42 @@ def battle(result: "BattleResult"):
     em.set_footer(text=f"Rounds fought: {result.rounds}")
     return em
 
+def battle_history(user, udic, entries, page: int):
+    title = getattr(user, "display_name", None) or getattr(user, "name", "Trainer")
+    wins = user_wincount(udic)
+    wlr = user_winlossratio(udic)
+    em = discord.Embed(title=f"{title}'s Battles", description=f":trophy:{wins}\n:lifter:{wlr:.2f}", color=0x5B6EE1)
+    icons = {"win": "✅", "loss": "❌", "draw": "➖"}
+    lines = []
+    for entry in entries:
+        context = entry.get("context", {})
+        if context.get("type") == "wild":
+            against = f"a wild {context.get('name', 'Pokémon')}"
+        elif context.get("opponent"):
+            against = f"<@{context['opponent']}>"
+        else:
+            against = "a trainer"
+        when = f" <t:{int(entry['timestamp'])}:R>" if entry.get("timestamp") else ""
+        lines.append(f"{icons.get(entry.get('outcome'), '•')} {entry.get('outcome', '?').title()} against {against}{when}")
+    if lines:
+        em.add_field(name=f"Page {page}", value="\n".join(lines), inline=False)
+    else:
+        em.add_field(name=f"Page {page}", value="No battles here yet.", inline=False)
+    em.set_footer(text="Older battles: `!history 2`, `!history 3`, ...")
+    return em
+
+
 ############################
 # Leaderboard Embeds
 ############################
 
 
-def _all_users():
-    users = []
-    seen = set()
-    # Include any users already cached in memory.
-    for uid, data in USERS.cache.items():
-        users.append((uid, data))
-        seen.add(uid)
-
-    # Load any remaining users from disk.
-    directory = Path(USERS.path_prefix)
-    if directory.exists():
-        for file in directory.glob("*.json"):
-            key = file.stem
-            try:
-                key = int(key)
-            except ValueError:
-                pass
-            if key in seen:
-                continue
-            try:
-                users.append((key, USERS[key]))
-            except FileNotFoundError:
-                continue
-    return users
-
-
-def leaderboard(title, desc, sortingfunc, value_func, emoji, length=10, color=0x606170):
-    # Sort leaderboard by specific topic
-    sorted_udex = sorted(_all_users(), key=sortingfunc, reverse=True)
-
-    # Create embed
+def leaderboard(title, desc, board, format_value, emoji, length=10, color=0x606170):
+    # Boards are kept sorted in db.LEADERBOARDS, so just read off the top.
     em = discord.Embed(title=title, description=desc, color=color, url="")
 
-    for uid, user in sorted_udex:
-        display_name = user.get("name", f"User {uid}")
-        value = value_func(uid, user)
-        em.add_field(name=display_name, value=f"{emoji} {value}", inline=False)
-        if len(em.fields) == length:
-            break
+    for _uid, display_name, score in LEADERBOARDS.top(board, length):
+        em.add_field(name=display_name, value=f"{emoji} {format_value(score)}", inline=False)
 
     if len(em.fields) == 0:
         em.add_field(name="No trainers found", value="Start chatting to appear on the leaderboard!", inline=False)
@@ -470,8 +456,8 @@ def leaderboard_bp():
     return leaderboard(
                     "RICHEST PLAYERS",
                     "Some of the most active users today...",
-                    lambda x: x[1].get("bp", 0),
-                    lambda _uid, user: user.get("bp", 0),
+                    "bp",
+                    str,
                     ":coin:"
                     )
 
@@ -479,8 +465,8 @@ def leaderboard_most_mons():
     return leaderboard(
                     "POKEMON COLLECTORS",
                     "Some of the most active users today...",
-                    lambda x: len(x[1].get("pokemon", [])),
-                    lambda _uid, user: len(user.get("pokemon", [])),
+                    "pokemon",
+                    str,
                     "<:poke:1092956340349046844>"
                     )
 
@@ -488,8 +474,8 @@ def leaderboard_wins():
     return leaderboard(
                     "BIGGEST FIGHTERS",
                     "Some of the most active users today...",
-                    lambda x: user_wincount(x[1]),
-                    lambda _uid, user: user_wincount(user),
+                    "wins",
+                    str,
                     ":trophy:"
                     )
 
@@ -497,7 +483,7 @@ def leaderboard_wlr():
     return leaderboard(
                     "EXPERT BATTLERS",
                     "Some of the most active users today...",
-                    lambda x: user_winlossratio(x[1]),
-                    lambda _uid, user: f"{user_winlossratio(user):.2f}",
+                    "wlr",
+                    lambda wlr: f"{wlr:.2f}",
                     ":lifter:"
                     )
@@ -36,9 +36,9 @@ async def new_encounter(channel):
             await encounter_message.channel.send(f"{reactor.mention}, you need to ping the bot to set up first!")
             return er(complete_action=False)
 
-        users.ensure_user_record(reactor.id)
-        users.update_display_name(reactor)
-        party_members = users.get_party_members(reactor.id)
+        await users.ensure_user_record(reactor.id)
+        await users.update_display_name(reactor)
+        party_members = await users.get_party_members(reactor.id)
         if not party_members:
             await encounter_message.channel.send(
                 f"{reactor.mention}, set up a party first with `!party add <number>`!"
@@ -61,17 +61,21 @@ async def new_encounter(channel):
             await encounter_message.channel.send(f"{reactor.mention}, you need to ping the bot to set up first!")
             return er(complete_action=False)
 
-        users.ensure_user_record(reactor.id)
-        users.update_display_name(reactor)
-        has_ball = economy.user_spend_item(reactor.id, ball)
-        ballname = ITEMS[ball]["name"]
+        # Spending the ball and catching are saved together, once.
+        async with USERS.transaction(reactor.id):
+            await users.ensure_user_record(reactor.id)
+            await users.update_display_name(reactor)
+            has_ball = await economy.user_spend_item(reactor.id, ball)
+            ballname = ITEMS[ball]["name"]
+            if has_ball:
+                probability = float(mon.species.catch_rate) / 255.0
+                catch = random.random() <= probability*ITEMS[ball]["catch_rate"]
+                if catch:
+                    await users.catch_pokemon(reactor.id, mon)
         if not has_ball:
             await encounter_message.channel.send(f"{reactor.mention}, you don't have any {ballname}s!")
             return er(complete_action=False)
-        probability = float(mon.species.catch_rate) / 255.0
-        catch = random.random() <= probability*ITEMS[ball]["catch_rate"]
         if catch:
-            users.catch_pokemon(reactor.id, mon)
             await encounter_message.channel.send(f"Congratulations, {reactor.mention}, you caught {mon.get_name()}!")
             return er(remove_dis_post=True, clear_reactions=True)
         else:
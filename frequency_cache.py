@@ -1,84 +1,754 @@
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import contextlib
+import itertools
 import json
-import os
+import time
+
+from storage import Json_Storage
+
+RENORMALISE_AT = 1e200  # Weight at which stored access counts are rescaled
+
+
+class _Eviction_Heap:
+    """
+    Indexed binary min-heap of cache keys.
+
+    The heap is ordered by a rank function (access count, then last touch),
+    so the root is always the next key to evict. A position index lets a key
+    be re-sifted after its count changes, so touch, push and pop are all
+    O(log n) instead of scanning the whole cache.
+    """
+    def __init__(self, rank):
+        self.rank = rank      # Callable that maps a key to a sortable value
+        self.heap = []        # Keys, in heap order
+        self.position = {}    # key -> index in self.heap
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __contains__(self, key):
+        return key in self.position
+
+    def push(self, key):
+        self.heap.append(key)
+        self.position[key] = len(self.heap) - 1
+        self._sift_up(len(self.heap) - 1)
+
+    def peek(self):
+        return self.heap[0]
+
+    def pop(self):
+        return self.remove(self.heap[0])
+
+    def remove(self, key):
+        index = self.position.pop(key)
+        last = self.heap.pop()
+        if index < len(self.heap):
+            # Fill the hole with the last leaf and restore the heap property.
+            self.heap[index] = last
+            self.position[last] = index
+            self.update(last)
+        return key
+
+    def rebuild(self):
+        """Re-heapify every key, for when many ranks changed at once."""
+        for index in reversed(range(len(self.heap) // 2)):
+            self._sift_down(index)
+
+    def update(self, key):
+        """Restore heap order after the rank of a key has changed."""
+        index = self.position[key]
+        index = self._sift_up(index)
+        self._sift_down(index)
+
+    def _swap(self, a, b):
+        heap = self.heap
+        heap[a], heap[b] = heap[b], heap[a]
+        self.position[heap[a]] = a
+        self.position[heap[b]] = b
+
+    def _sift_up(self, index):
+        rank = self.rank
+        while index > 0:
+            parent = (index - 1) // 2
+            if rank(self.heap[index]) < rank(self.heap[parent]):
+                self._swap(index, parent)
+                index = parent
+            else:
+                break
+        return index
+
+    def _sift_down(self, index):
+        rank = self.rank
+        size = len(self.heap)
+        while True:
+            smallest = index
+            for child in (2 * index + 1, 2 * index + 2):
+                if child < size and rank(self.heap[child]) < rank(self.heap[smallest]):
+                    smallest = child
+            if smallest == index:
+                return index
+            self._swap(index, smallest)
+            index = smallest
+
+
+class _Key_Lock:
+    """An asyncio lock that the task holding it can take again without waiting."""
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.owner = None     # Task holding the lock
+        self.depth = 0        # How many times the owner has taken it
+        self.waiting = 0      # Tasks queued for it, so it isn't thrown away under them
+
+
+class _Key_Locks:
+    """
+    One lock per key, made when first needed and dropped once nobody holds or wants it.
+
+    Keys are always taken in the same order (see order()), so two tasks
+    locking overlapping sets of keys can't deadlock. Locks are reentrant
+    per task, but not shared with tasks it starts, so don't wait on a
+    child task that needs a key you hold.
+    """
+    def __init__(self):
+        self.locks = {}       # key -> _Key_Lock
+
+    def __contains__(self, key):
+        return key in self.locks and self.locks[key].lock.locked()
+
+    @staticmethod
+    def order(keys):
+        # Keys may be a mix of ints and strings, so sort on a form every key has.
+        return sorted(dict.fromkeys(keys), key=lambda key: (type(key).__name__, str(key)))
+
+    async def acquire(self, key):
+        entry = self.locks.get(key)
+        if entry is None:
+            entry = self.locks[key] = _Key_Lock()
+        task = asyncio.current_task()
+        if entry.owner is task:
+            entry.depth += 1
+            return
+        entry.waiting += 1
+        try:
+            await entry.lock.acquire()
+        finally:
+            entry.waiting -= 1
+            if not entry.lock.locked() and not entry.waiting:
+                # Cancelled while waiting, and nobody else needs it.
+                self.locks.pop(key, None)
+        entry.owner = task
+        entry.depth = 1
+
+    def release(self, key):
+        entry = self.locks[key]
+        entry.depth -= 1
+        if entry.depth:
+            return
+        entry.owner = None
+        entry.lock.release()
+        if not entry.waiting:
+            del self.locks[key]
+
 
 class Frequency_Cache:
     """
     Represents a caching system to retrieve json files from a directory.
     It stores a certain number of objects before evicting the least
     frequently accessed item from the cache.
-    
+
     Can specify a unique path and max size.
     Can specify static or non-static.
-    non-static caches will save their data 
+    non-static caches will save their data
     to its file before decaching it.
+    non-static caches with a write delay only write
+    changed items, in batches, see save_item().
+
+    Event handlers should use aget(), aput() and aflush(),
+    which do their file I/O on a small thread pool.
+
+    Items are stored as json files under path_prefix by default.
+    Pass a storage backend from storage.py to keep them elsewhere.
+    Pass an upgrade hook to migrate old items as they are loaded.
     """
-    def __init__(self, max_size, path_prefix, decay_factor=0.9, static=True):
+    def __init__(self, max_size, path_prefix, decay_factor=0.9, static=True, history_size=None, write_delay=0, io_workers=4, watch_interval=None, storage=None, upgrade=None):
         self.max_size = max_size           # Maximum number of items in the cache
         self.path_prefix = path_prefix     # Prefix for database path
+        self.storage = storage if storage is not None else Json_Storage(path_prefix)  # Where items live, see storage.py
         self.static = static               # Determines if the database is mutable
         self.cache = OrderedDict()         # Ordered dictionary to store cache items
         self.access_count = {}             # Dictionary to store access counts for each item
         self.decay_factor = decay_factor   # Factor to decay access counts
-    
+        self.weight = 1.0                  # What one access is worth right now, see frequency()
+        self.history = OrderedDict()       # Evicted keys whose counts we still remember, oldest first
+        self.history_size = history_size if history_size is not None else max_size * 10
+        self.last_touch = {}               # Tie breaker: when each cached item was last used
+        self._clock = itertools.count()    # Monotonic source for last_touch
+        self.eviction_heap = _Eviction_Heap(self._eviction_rank)
+        self.write_delay = write_delay     # Seconds to coalesce saves before writing, 0 writes at once
+        self.dirty = {}                    # Unsaved keys -> when they were first saved
+        self.flusher = None                # Write-behind task, see start_write_behind()
+        self.io_workers = io_workers       # Threads for file I/O done by the async methods
+        self.executor = None               # Created on first use, see _io()
+        self.loading = {}                  # key -> future of a load in progress, shared by callers
+        self.writes = {}                   # key -> latest background write task
+        self.evicting = {}                 # Evicted data not yet written, so loads don't read stale files and failed writes are retried
+        self.watch_interval = watch_interval  # Seconds between directory rescans, None to never rescan
+        self.watcher = None                # Directory rescan task, see start_index_watcher()
+        self.maintainer = None             # Storage housekeeping task, see start_storage_maintenance()
+        self.known_keys = self.storage.keys()  # Every stored key, as strings, so lookups skip the disk
+        self.upgrade = upgrade             # Called as upgrade(key, data) on every load, returns True if it changed data
+        self.listeners = []                # Called when an item is saved or evicted, see add_listener()
+        self.transactions = {}             # key -> how many open transactions hold it, see transaction()
+        self.locks = _Key_Locks()          # Per-key locks for handlers that read, await, then write, see locked()
+
     def __contains__(self, key):
-        if key in self.cache:
+        if key in self.cache or key in self.evicting:
             # Happy Path, it's easily true
             return True
-        else:
-            path = f"{self.path_prefix}{key}.json"
-            return os.path.isfile(path)
-    
+        # Otherwise ask the key index instead of the disk.
+        return str(key) in self.known_keys
+
+    def add_listener(self, callback):
+        """
+        Call callback(key, event) whenever an item is saved or evicted.
+        event is "save" or "evict". Both happen before the item is written,
+        so listeners may still change it, and an "evict" listener may still
+        save_item() it. event is "rollback" when a transaction puts an item back.
+        Lets other modules drop anything they derived from the old value.
+        """
+        self.listeners.append(callback)
+
+    def _notify(self, key, event):
+        for callback in self.listeners:
+            callback(key, event)
+
+    def stored_keys(self):
+        """Every key that has been saved, whether or not it is cached. Keys are strings."""
+        return set(self.known_keys)
+
+    def frequency(self, key):
+        """
+        Return the decayed access count of a key.
+
+        Stored counts are scaled by the current weight, so they are only
+        normalised here, when someone actually reads them.
+        """
+        return self.access_count.get(key, 0) / self.weight
+
+    def _renormalise(self):
+        """Fold the weight back into the stored counts before it overflows."""
+        for k in self.access_count:
+            self.access_count[k] /= self.weight
+        self.weight = 1.0
+        # Tiny counts may round to the same value, which changes tie breaks.
+        self.eviction_heap.rebuild()
+
+    def _eviction_rank(self, key):
+        # Least accessed first, then least recently used.
+        return (self.access_count[key], self.last_touch[key])
 
-    
     def __getitem__(self, key):
         if key in self.cache:
             # Happy Path, move this item to the end so it's sorted by recency
             self.cache.move_to_end(key)
         else:
             # If the item is not in the cache, load it from the JSON file
-            with open(f"{self.path_prefix}{key}.json", "r+", encoding="utf-8") as f:
-                print(f"{self.path_prefix}{key}.json")
-                data = json.load(f)
-            # Call __setitem__ to add new value and decache old ones
-            self[key] = data
-            
+            data = self.evicting[key] if key in self.evicting else self._read_file(key)
+            self._admit(key, data)
+
         # Both Paths converge here.
-        # Decay all access counts and increment this one.
-        for k in self.access_count.keys():
-            self.access_count[k] *= self.decay_factor
-        self.access_count[key] += 1
-        
+        # Rather than decaying every count, make each new access worth more.
+        # This keeps the same ordering as decaying everything, in O(1).
+        self.weight /= self.decay_factor
+        if self.weight > RENORMALISE_AT:
+            self._renormalise()
+        self.access_count[key] += self.weight
+        self.last_touch[key] = next(self._clock)
+        self.eviction_heap.update(key)
+
         return self.cache[key]
-    
+
     def __setitem__(self, key, newvalue):
-        # Add the item and initialize the access count to 0. 
+        # Add the item and initialize the access count to 0.
         # If it is being accessed by __getitem__, increment later.
+        if key in self.cache:
+            self.cache[key] = newvalue
+            return
+        while len(self.cache) >= self.max_size:
+            # If full, remove least accessed item from cache before adding the new one,
+            # so a freshly loaded item can't be evicted by its own insert.
+            # If every item is held by a transaction, go over max_size for now instead,
+            # and shrink back on later inserts.
+            if self._evict() is None:
+                break
         self.cache[key] = newvalue
         if key not in self.access_count: # if there's already a value in access_count, keep it
             self.access_count[key] = 0
-        if len(self.cache) > self.max_size:
-            # If full, remove least accessed item from cache.
-            # ChatGPT:
-            # "In this version, the min() function uses a lambda function 
-            # as the key argument that sorts items first by access count 
-            # and then by insertion order."
-            least_accessed = min(self.cache, key=lambda k: (self.access_count[k], self.cache[k]))
-            if not self.static:
-                self.save_item(least_accessed)
-            self.cache.pop(least_accessed)
-            #self.access_count.pop(least_accessed) # Keep track of accesses even after data is freed.
-            # I'm ok storing 1000 integers in RAM.
+        self.history.pop(key, None)
+        self.last_touch[key] = next(self._clock)
+        self.eviction_heap.push(key)
+
+    def _admit(self, key, data):
+        """Cache a freshly loaded item, upgrading it first if the cache has an upgrade hook."""
+        changed = self.upgrade is not None and self.upgrade(key, data)
+        # Call __setitem__ to add new value and decache old ones
+        self[key] = data
+        if key in self.evicting and key not in self.writes:
+            # Its eviction write failed, so it's back to being an unsaved cached item.
+            self.evicting.pop(key)
+            self._mark_dirty([key])
+        if changed:
+            self.save_item(key)
+
+    def _evict(self):
+        """
+        Remove the least frequently accessed item, saving it first if needed.
+        Items held by a transaction are skipped. Returns None if every item is held.
+        """
+        held = []
+        while self.eviction_heap and self.eviction_heap.peek() in self.transactions:
+            held.append(self.eviction_heap.pop())
+        least_accessed = self.eviction_heap.pop() if self.eviction_heap else None
+        for key in held:
+            self.eviction_heap.push(key)
+        if least_accessed is None:
+            return None
+        self._notify(least_accessed, "evict")
+        if least_accessed in self.dirty or least_accessed in self.writes:
+            # Pending writes can't wait for the flusher once the data is gone,
+            # and one already under way might fail, so it's written again from here.
+            self.dirty.pop(least_accessed, None)
+            data = self.cache[least_accessed]
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                try:
+                    self._write_file(least_accessed, json.dumps(data))
+                except OSError as e:
+                    # Kept in memory for the next forced flush to retry.
+                    print(f"Failed to write {least_accessed} to {self.storage}: {e}")
+                    self.evicting[least_accessed] = data
+            else:
+                # Inside the bot, write in the background and serve loads from memory meanwhile.
+                self.evicting[least_accessed] = data
+                task = self._schedule_write(least_accessed, json.dumps(data))
+                task.add_done_callback(lambda finished: self._finish_evicting(least_accessed, data, finished))
+        self.cache.pop(least_accessed)
+        self.last_touch.pop(least_accessed, None)
+        # Keep track of accesses even after data is freed, but only for a while.
+        self.history[least_accessed] = None
+        if len(self.history) > self.history_size:
+            forgotten, _ = self.history.popitem(last=False)
+            self.access_count.pop(forgotten, None)
+        return least_accessed
 
     def save_item(self, key):
+        """
+        Mark an item as changed so it gets written to its file.
+
+        Without a write delay the item is written right away. With one,
+        repeated saves of the same key are coalesced and written once by
+        flush(), at most write_delay seconds after the first save.
+        """
+        if self.static:
+            return
+        if key not in self.cache:
+            raise KeyError(key)
+        if key in self.transactions:
+            if self._held_elsewhere(key):
+                # It would be committed or rolled back with someone else's changes. Use aput(), which waits.
+                raise RuntimeError(f"{key} is held by another task's transaction.")
+            # The transaction saves it once, when it commits.
+            return
+        self.known_keys.add(str(key))
+        self._notify(key, "save")
+        if not self.write_delay:
+            self.write_item(key)
+            return
+        self.dirty.setdefault(key, time.monotonic())
+
+    def write_item(self, key):
+        """Write an item to its file now and clear its dirty flag."""
         if self.static:
             return
-        with open(f"{self.path_prefix}{key}.json", "w+", encoding="utf-8") as file: 
-            json.dump(self.cache[key], file)
+        self.dirty.pop(key, None)
+        self.known_keys.add(str(key))
+        try:
+            self._write_file(key, json.dumps(self.cache[key]))
+        except BaseException:
+            self._mark_dirty([key])
+            raise
 
-    def save_items(self):
+    def _read_file(self, key):
+        return self.storage.read(key)
+
+    def _write_file(self, key, payload):
+        self.storage.write_many([(key, payload)])
+
+    def _mark_dirty(self, keys):
+        """Mark keys as unsaved again, e.g. after their write failed, so a later flush retries them."""
+        now = time.monotonic()
+        for key in keys:
+            if key in self.cache:
+                self.dirty.setdefault(key, now)
+
+    def _due_keys(self, force):
+        cutoff = time.monotonic() - self.write_delay
+        due = []
+        # Dirty keys are kept in the order they were first saved, oldest first.
+        for key, since in self.dirty.items():
+            if not force and since > cutoff:
+                break
+            due.append(key)
+        return due
+
+    def flush(self, force=False):
+        """
+        Write every dirty item whose write delay has passed.
+        If force is set, write every dirty item regardless.
+        Returns how many items were written.
+        """
         if self.static:
+            return 0
+        due = self._due_keys(force)
+        batch = []
+        for key in due:
+            self.dirty.pop(key)
+            batch.append((key, json.dumps(self.cache[key])))
+        evicted = list(self.evicting.items()) if force else []
+        for key, data in evicted:
+            # Evicted items whose background writes never got to run, or failed.
+            batch.append((key, json.dumps(data)))
+        # One batch, so backends that support it commit everything together.
+        try:
+            self.storage.write_many(batch)
+        except BaseException:
+            self._mark_dirty(due)
+            raise
+        for key, data in evicted:
+            if self.evicting.get(key) is data:
+                self.evicting.pop(key)
+        return len(due)
+
+    def save_items(self):
+        """Write every unsaved change. Clean items are left alone."""
+        self.flush(force=True)
+
+    ############################
+    # Async API
+    ############################
+
+    def _io(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                max_workers=self.io_workers,
+                thread_name_prefix=f"cache-io-{self.path_prefix}",
+            )
+        return self.executor
+
+    async def _run_io(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._io(), func, *args)
+
+    def _schedule_write(self, key, payload):
+        return self._schedule_batch([(key, payload)])
+
+    def _schedule_batch(self, items):
+        """
+        Write serialised (key, payload) pairs on the I/O pool as one batch.
+        Writes to the same key are chained, so an older payload never lands last.
+        """
+        keys = [key for key, _ in items]
+        previous = {self.writes[key] for key in keys if key in self.writes}
+
+        async def write():
+            if previous:
+                await asyncio.wait(previous)
+            await self._run_io(self.storage.write_many, items)
+
+        task = asyncio.ensure_future(write())
+        for key in keys:
+            self.writes[key] = task
+
+        def done(finished):
+            for key in keys:
+                if self.writes.get(key) is finished:
+                    self.writes.pop(key)
+            if finished.cancelled() or finished.exception():
+                if not finished.cancelled():
+                    print(f"Failed to write {keys} to {self.storage}: {finished.exception()}")
+                # Still cached items go back to the flusher; evicted ones stay in self.evicting.
+                self._mark_dirty(keys)
+        task.add_done_callback(done)
+        return task
+
+    def _finish_evicting(self, key, data, finished):
+        if self.evicting.get(key) is not data:
+            return
+        if not finished.cancelled() and not finished.exception():
+            self.evicting.pop(key)
+        elif key in self.cache:
+            # Loaded again meanwhile, so the cached copy is the one to save.
+            self.evicting.pop(key)
+            self._mark_dirty([key])
+
+    async def _load(self, key):
+        if key in self.evicting:
+            return self.evicting[key]
+        return await self._run_io(self._read_file, key)
+
+    async def aget(self, key):
+        """
+        Get an item without blocking the event loop.
+
+        Cache hits return straight away. Misses are read on the I/O pool,
+        and concurrent misses for the same key share a single read.
+        """
+        if key not in self.cache:
+            pending = self.loading.get(key)
+            if pending is None:
+                pending = asyncio.ensure_future(self._load(key))
+                self.loading[key] = pending
+                pending.add_done_callback(lambda _: self.loading.pop(key, None))
+            data = await asyncio.shield(pending)
+            if key not in self.cache:
+                self._admit(key, data)
+        return self[key]
+
+    def _held_elsewhere(self, key):
+        """True if key is in a transaction run by some other task than this one."""
+        if key not in self.transactions:
+            return False
+        entry = self.locks.locks.get(key)
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        return entry is None or entry.owner is not task
+
+    async def aput(self, key, newvalue):
+        """
+        Store an item and save it, writing on the I/O pool when there is no write delay.
+        If another task's transaction holds the key, waits for it to finish first.
+        """
+        if self._held_elsewhere(key):
+            # Otherwise this write would be saved by its commit, or undone by its rollback.
+            async with self.locked(key):
+                return await self.aput(key, newvalue)
+        self[key] = newvalue
+        if self.static or key in self.transactions:
             return
-        for key in self.cache:
+        if self.write_delay:
             self.save_item(key)
-            
\ No newline at end of file
+            return
+        self.dirty.pop(key, None)
+        self.known_keys.add(str(key))
+        self._notify(key, "save")
+        await self._schedule_write(key, json.dumps(newvalue))
+
+    async def awrite(self, key):
+        """
+        Write a cached item now, whatever the write delay, and wait until storage has it.
+        For when something else may only be saved once this is on disk.
+        Can't be used on a key held by a transaction, which only saves at its commit.
+        """
+        if self.static:
+            return
+        if self._held_elsewhere(key):
+            async with self.locked(key):
+                return await self.awrite(key)
+        if key in self.transactions:
+            raise RuntimeError(f"{key} is held by a transaction, so it can't be written before the commit.")
+        self.dirty.pop(key, None)
+        self.known_keys.add(str(key))
+        try:
+            await self._schedule_write(key, json.dumps(self.cache[key]))
+        except BaseException:
+            # Leave it for the write-behind to try again.
+            self.dirty.setdefault(key, time.monotonic())
+            raise
+
+    @contextlib.asynccontextmanager
+    async def locked(self, *keys):
+        """
+        Hold the locks for these keys, so no other task can lock them meanwhile.
+
+            async with USERS.locked(uid_a, uid_b):
+
+        Handlers for different keys still run side by side. Take every key
+        you need in one call: they're locked in a fixed order, which is
+        what stops two tasks from deadlocking on each other's keys.
+        A task can lock a key it already holds.
+        """
+        taken = []
+        try:
+            for key in self.locks.order(keys):
+                await self.locks.acquire(key)
+                taken.append(key)
+            yield
+        finally:
+            for key in reversed(taken):
+                self.locks.release(key)
+
+    @contextlib.asynccontextmanager
+    async def transaction(self, *keys):
+        """
+        Load items once, let the block change them, then save them once.
+
+            async with USERS.transaction(uid) as user:
+            async with USERS.transaction(uid_a, uid_b) as (user_a, user_b):
+
+        While the block runs, save_item() and aput() on these keys only
+        mark them for the commit, so helpers that save can be called freely.
+        That's only for the task running the block: aput() from any other
+        task waits until the commit or rollback is done.
+        Items that changed are saved together when the block ends, in a
+        single batch. If the block raises, every item is put back the way
+        it was when the transaction started.
+        Transactions the same task opens on keys it already holds join the
+        outer one, which commits or rolls back.
+
+        The keys stay locked (see locked()) until the commit or rollback is
+        done, so concurrent transactions on the same user take turns.
+        """
+        async with self.locked(*keys):
+            async with self._transaction(keys) as values:
+                yield values
+
+    @contextlib.asynccontextmanager
+    async def _transaction(self, keys):
+        keys = list(dict.fromkeys(keys))
+        owned = [key for key in keys if key not in self.transactions]
+        # Hold the keys before loading, so loading one can't evict another.
+        for key in keys:
+            self.transactions[key] = self.transactions.get(key, 0) + 1
+        try:
+            values = [await self.aget(key) for key in keys]
+            snapshots = {key: (self.cache[key], json.dumps(self.cache[key])) for key in owned}
+        except BaseException:
+            self._release(keys)
+            raise
+        try:
+            yield values[0] if len(values) == 1 else values
+        except BaseException:
+            self._release(keys)
+            self._rollback(snapshots)
+            raise
+        self._release(keys)
+        await self._commit(snapshots)
+
+    def _release(self, keys):
+        for key in keys:
+            self.transactions[key] -= 1
+            if not self.transactions[key]:
+                del self.transactions[key]
+
+    def _rollback(self, snapshots):
+        for key, (original, snapshot) in snapshots.items():
+            restored = json.loads(snapshot)
+            if isinstance(original, dict):
+                # Restore in place, since callers may still hold the dict.
+                original.clear()
+                original.update(restored)
+                restored = original
+            self[key] = restored
+            self._notify(key, "rollback")
+
+    async def _commit(self, snapshots):
+        if self.static:
+            return
+        changed = [
+            key for key, (_, snapshot) in snapshots.items()
+            if key in self.cache and json.dumps(self.cache[key]) != snapshot
+        ]
+        for key in changed:
+            self.known_keys.add(str(key))
+            self._notify(key, "save")
+        if self.write_delay:
+            now = time.monotonic()
+            for key in changed:
+                self.dirty.setdefault(key, now)
+            return
+        if changed:
+            for key in changed:
+                self.dirty.pop(key, None)
+            await self._schedule_batch([(key, json.dumps(self.cache[key])) for key in changed])
+
+    async def aflush(self, force=False):
+        """Async flush(): write due dirty items on the I/O pool. Returns how many were written."""
+        if self.static:
+            return 0
+        due = self._due_keys(force)
+        batch = []
+        for key in due:
+            # Serialise now, on the loop, so handlers can keep mutating the dicts.
+            self.dirty.pop(key)
+            batch.append((key, json.dumps(self.cache[key])))
+        if batch:
+            self._schedule_batch(batch)
+        # Evicted items whose writes failed are only held here, so retry them every time.
+        for key, data in list(self.evicting.items()):
+            if key not in self.writes and key not in self.cache:
+                task = self._schedule_write(key, json.dumps(data))
+                task.add_done_callback(lambda finished, key=key, data=data: self._finish_evicting(key, data, finished))
+        tasks = set(self.writes.values())
+        if tasks:
+            await asyncio.wait(tasks)
+        return len(due)
+
+    async def write_behind(self, interval=1):
+        """Flush due items forever. Run this as a task on the bot's event loop."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.aflush()
+            except OSError as e:
+                print(f"Write-behind flush failed for {self.storage}: {e}")
+
+    def start_write_behind(self, interval=1):
+        """Start the write-behind task once. Safe to call on every reconnect."""
+        if self.static or not self.write_delay:
+            return
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.create_task(self.write_behind(interval))
+
+    async def refresh_index(self):
+        """Rescan the directory for files added by something other than this cache."""
+        scanned = await self._run_io(self.storage.keys)
+        # Keep keys whose files may not have been written yet.
+        pending = {str(key) for key in list(self.dirty) + list(self.evicting) + list(self.writes)}
+        self.known_keys = scanned | pending
+
+    async def watch_index(self, interval):
+        """Refresh the key index forever. Run this as a task on the bot's event loop."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh_index()
+            except OSError as e:
+                print(f"Key index refresh failed for {self.storage}: {e}")
+
+    def start_index_watcher(self):
+        """Start rescanning the directory, if a watch interval was set."""
+        if not self.watch_interval:
+            return
+        if self.watcher is None or self.watcher.done():
+            self.watcher = asyncio.create_task(self.watch_index(self.watch_interval))
+
+    async def maintain_storage(self, interval):
+        """Run the storage backend's housekeeping forever, off the event loop."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self._run_io(self.storage.maintain)
+            except OSError as e:
+                print(f"Storage maintenance failed for {self.storage}: {e}")
+
+    def start_storage_maintenance(self, interval=60):
+        """Start the storage housekeeping task once. Safe to call on every reconnect."""
+        if self.static:
+            return
+        if self.maintainer is None or self.maintainer.done():
+            self.maintainer = asyncio.create_task(self.maintain_storage(interval))
@@ -0,0 +1,232 @@
+import asyncio
+import bisect
+import json
+import os
+
+import user_schema
+
+"""
+This module keeps the leaderboards sorted as user records change.
+
+Every time a user record is saved, its scores are recomputed and moved
+to their new place in each board, so showing a top 10 just reads the
+first 10 entries instead of loading every user. Chat BP from the ledger
+in bp_ledger.py is applied to the bp board as it's earned.
+
+The boards are saved to a json file next to the user store, and rebuilt
+from the store if that file is missing or can't be trusted: if it came
+from a different store, or the bot didn't shut down cleanly last time,
+since then the store and the saved boards may disagree either way.
+"""
+
+
+def battle_totals(user):
+    """Lifetime wins, losses and draws over every kind of battle."""
+    totals = {"win": 0, "loss": 0, "draw": 0}
+    for counts in user.get("battle_stats", {}).values():
+        for outcome in totals:
+            totals[outcome] += counts.get(outcome, 0)
+    return totals
+
+
+def user_wincount(user):
+    return battle_totals(user)["win"]
+
+
+def user_winlossratio(user):
+    """Share of battles won, with a draw worth half a win."""
+    totals = battle_totals(user)
+    played = sum(totals.values())
+    if not played:
+        return 0
+    return (totals["win"] + totals["draw"] * 0.5) / played
+
+
+# Board name -> how to score a user record. The bp board also counts pending chat BP.
+BOARDS = {
+    "bp": lambda user: user.get("bp", 0),
+    "pokemon": user_schema.pokemon_count,
+    "wins": user_wincount,
+    "wlr": user_winlossratio,
+}
+
+
+def _uid(key):
+    # Json turns every key into a string; user ids are ints.
+    try:
+        return int(key)
+    except (TypeError, ValueError):
+        return key
+
+
+class Ranking:
+    """One leaderboard, kept sorted best first."""
+    def __init__(self):
+        self.scores = {}   # uid -> score
+        self.order = []    # (-score, uid), ascending, so the best score is first
+
+    def __len__(self):
+        return len(self.order)
+
+    def update(self, uid, score):
+        old = self.scores.get(uid)
+        if old == score:
+            return False
+        if old is not None:
+            del self.order[bisect.bisect_left(self.order, (-old, uid))]
+        self.scores[uid] = score
+        bisect.insort(self.order, (-score, uid))
+        return True
+
+    def top(self, n):
+        """The best n entries, as (uid, score)."""
+        return [(uid, -negative) for negative, uid in self.order[:n]]
+
+
+class Leaderboards:
+    """Every board in BOARDS, kept up to date from a Frequency_Cache of user records."""
+    def __init__(self, cache, ledger, path):
+        self.cache = cache          # The Frequency_Cache holding user records
+        self.ledger = ledger        # The BP_Ledger whose pending BP counts towards bp
+        self.path = path            # Where the boards are saved
+        self.marker = f"{path}.open"  # Exists while the bot runs, so a crash is noticed on the next start
+        self.source = f"{type(cache.storage).__name__}:{cache.storage}"  # The store the boards were scored from
+        self.boards = {name: Ranking() for name in BOARDS}
+        self.names = {}             # uid -> display name, so a board never loads a record
+        self.changed = False        # Set when the boards differ from the saved file
+        self.saver = None           # Periodic save task, see start()
+        if not self.load():
+            self.rebuild()
+        cache.add_listener(self._on_cache_event)
+        ledger.add_listener(self._on_bp)
+
+    def update(self, uid, user):
+        """Rescore one user record on every board."""
+        name = user.get("name", str(uid))
+        if self.names.get(uid) != name:
+            self.names[uid] = name
+            self.changed = True
+        for board, score in BOARDS.items():
+            value = score(user)
+            if board == "bp":
+                value += self.ledger.pending_for(uid)
+            if self.boards[board].update(uid, value):
+                self.changed = True
+
+    def _on_cache_event(self, uid, event):
+        if event == "save" and uid in self.cache.cache:
+            self.update(uid, self.cache.cache[uid])
+
+    def _on_bp(self, uid, delta):
+        bp = self.boards["bp"]
+        if bp.update(uid, bp.scores.get(uid, 0) + delta):
+            self.changed = True
+
+    def top(self, board, n=10):
+        """The best n users on a board, as (uid, name, score)."""
+        return [(uid, self.names.get(uid, f"User {uid}"), score) for uid, score in self.boards[board].top(n)]
+
+    def rebuild(self):
+        """Score every stored record. Reads the store directly, so the cache isn't flushed out."""
+        self.boards = {name: Ranking() for name in BOARDS}
+        self.names = {}
+        for key in self.cache.storage.keys():
+            uid = _uid(key)
+            if uid in self.cache.cache:
+                user = self.cache.cache[uid]
+            else:
+                try:
+                    user = self.cache.storage.read(key)
+                except (FileNotFoundError, ValueError):
+                    continue
+                if self.cache.upgrade is not None:
+                    # Score it as it will look once loaded; the store itself is left alone.
+                    self.cache.upgrade(key, user)
+            self.update(uid, user)
+        self.changed = True
+
+    def to_json(self):
+        return json.dumps({
+            "source": self.source,
+            "names": self.names,
+            "boards": {name: ranking.scores for name, ranking in self.boards.items()},
+        })
+
+    def load(self):
+        """
+        Read the saved boards. Returns False if there are none, they don't match BOARDS,
+        they came from another store, or the last run didn't close() them.
+        """
+        if os.path.exists(self.marker):
+            print(f"The bot didn't shut down cleanly, so the leaderboards will be rebuilt from {self.source}.")
+            return False
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return False
+        if set(saved.get("boards", {})) != set(BOARDS):
+            return False
+        if saved.get("source") != self.source:
+            print(f"The leaderboards were saved from {saved.get('source')}, so they will be rebuilt from {self.source}.")
+            return False
+        if not self.cache.stored_keys() <= {str(key) for key in saved["boards"]["bp"]}:
+            # Users were added to the store behind the bot's back, e.g. by storage.py migrate.
+            return False
+        self.names = {_uid(key): name for key, name in saved.get("names", {}).items()}
+        for board, scores in saved["boards"].items():
+            ranking = self.boards[board]
+            for key, score in scores.items():
+                ranking.update(_uid(key), score)
+        return True
+
+    def _write(self, payload):
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(payload)
+        os.replace(temp_path, self.path)
+
+    def save(self):
+        """Write the boards to disk if they changed."""
+        if not self.changed:
+            return
+        self.changed = False
+        self._write(self.to_json())
+
+    def close(self):
+        """Save the boards and note that they match the store. Call once the records are saved too."""
+        self.changed = False
+        self._write(self.to_json())
+        try:
+            os.remove(self.marker)
+        except FileNotFoundError:
+            pass
+
+    async def asave(self):
+        """save() with the write done off the event loop."""
+        if not self.changed:
+            return
+        self.changed = False
+        payload = self.to_json()
+        await asyncio.get_running_loop().run_in_executor(None, self._write, payload)
+
+    async def run(self, interval):
+        """Save the boards forever. Run this as a task on the bot's event loop."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.asave()
+            except OSError as e:
+                self.changed = True
+                print(f"Couldn't save leaderboards to {self.path}: {e}")
+
+    def start(self, interval=60):
+        """
+        Start saving the boards periodically. Safe to call on every reconnect.
+        Until close() is called, the next start rebuilds the boards rather than trusting the file.
+        """
+        if not os.path.exists(self.marker):
+            with open(self.marker, "w", encoding="utf-8") as f:
+                f.write(self.source)
+        if self.saver is None or self.saver.done():
+            self.saver = asyncio.create_task(self.run(interval))
@@ -11,6 +11,7 @@ import discobot_modules.text_coloring as tc
 import classes
 import embeds
 import users
+import user_schema
 import db
 import encounters
 import economy
@@ -31,6 +32,7 @@ home_channel = 1093393965539139644
 async def on_ready():
     msg = "Mew pokebot active."
     print(msg)
+    db.start_flushers()
     if home_channel:
         await client.get_channel(home_channel).send(msg)
     await at.iterate_timers()
@@ -66,9 +68,9 @@ async def on_message(message):
     author_id = message.author.id
     award_chat_bp = True
     if author_id not in db.USERS:
-        users.new_user(message.author)
-    users.ensure_user_record(author_id)
-    users.update_display_name(message.author)
+        await users.new_user(message.author)
+    await users.ensure_user_record(author_id)
+    await users.update_display_name(message.author)
 
     if command == "!hello":
         await message.channel.send("hi :)")
@@ -120,15 +122,15 @@ async def on_message(message):
             await message.reply("Pokémon numbers start at 1.")
             return
         try:
-            user = db.USERS[author_id]
-            pokemon_list = user["pokemon"]
-            if not pokemon_list:
+            user = await db.USERS.aget(author_id)
+            pokemon_count = user_schema.pokemon_count(user)
+            if not pokemon_count:
                 await message.reply("You haven't caught any Pokémon yet!")
                 return
-            if index > len(pokemon_list):
+            if index > pokemon_count:
                 await message.reply("You don't have that many Pokémon yet.")
                 return
-            pkmn = classes.Individual.from_dict(pokemon_list[index - 1])
+            pkmn = await users.get_collection_entry(author_id, index)
             if not pkmn:
                 raise ValueError
         except (KeyError, IndexError, ValueError):
@@ -139,6 +141,12 @@ async def on_message(message):
     if command == "!party":
         await users.party_command(message, args)
 
+    if command == "!box":
+        await users.box_command(message, args)
+
+    if command == "!history":
+        await users.history_command(message, args)
+
     if command == "!train":
         await users.train_command(message, args)
 
@@ -169,14 +177,14 @@ async def on_message(message):
                 await message.reply("Battling bots isn't supported yet.")
             else:
                 if opponent.id not in db.USERS:
-                    users.new_user(opponent)
-                users.ensure_user_record(opponent.id)
-                users.update_display_name(opponent)
-                challenger_party = users.get_party_members(author_id)
+                    await users.new_user(opponent)
+                await users.ensure_user_record(opponent.id)
+                await users.update_display_name(opponent)
+                challenger_party = await users.get_party_members(author_id)
                 if not challenger_party:
                     await message.reply("Set up a party with `!party add <number>` before battling!")
                 else:
-                    opponent_party = users.get_party_members(opponent.id)
+                    opponent_party = await users.get_party_members(opponent.id)
                     if not opponent_party:
                         await message.reply(f"{opponent.mention} doesn't have a party ready yet.")
                     else:
@@ -194,7 +202,7 @@ async def on_message(message):
     if award_chat_bp:
         frequency = 1.0
         if random.random() <= frequency:
-            users.adjust_bp(author_id, 1)
+            db.BP_LEDGER.add(author_id, 1)
     
     # Random Spawns
     SPAWN_RATE = 0.02
@@ -212,17 +220,19 @@ async def on_message(message):
         if msgl == "!admin help":
             await message.reply(embed = embeds.help())
         if command == "!save":
-            db.save_db()
+            await db.asave_db()
             await message.channel.send("Saved database.")
         if command in ["]", "die", "kill"]:
             await message.channel.send("Saving database and killing bot process...")
             db.save_db()
             quit()
         if command == "!makpkmn" and len(args) >= 2:
-            spec = classes.Species.load_index(int(args[0]))
+            spec = classes.get_species(int(args[0]))
             newmon = classes.Individual(spec, nickname=args[1])
-            db.USERS[message.author.id]["pokemon"].append(newmon.to_dict())
-            db.USERS.save_item(message.author.id)
+            admin_record = await db.USERS.aget(message.author.id)
+            admin_record["pokemon"].append(newmon.to_dict())
+            admin_record.setdefault("roster_index", {})[newmon.instance_id] = len(admin_record["pokemon"]) - 1
+            await db.USERS.aput(message.author.id, admin_record)
         if command == "!spawn":
             await encounters.roll_possible_encounter(message.channel, 1)
     
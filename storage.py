@@ -0,0 +1,473 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+
+"""
+This module defines the storage backends a Frequency_Cache can sit on.
+
+A backend only moves serialised records in and out of durable storage.
+Caching, dirty tracking and threading decisions all stay in the cache.
+Every backend has the same small surface:
+
+    keys()             -> set of every stored key, as strings
+    read(key)          -> the decoded record, or raise Record_Not_Found
+    write_many(items)  -> store (key, json text) pairs as one batch
+    maintain()         -> periodic housekeeping, run off the event loop
+    close()
+
+Json_Storage keeps one file per record, which is easy to inspect and fine
+for small servers. Sqlite_Storage keeps every record in one WAL-mode
+database, which scales to many users and commits a batch atomically.
+Log_Storage appends records to segment files, which makes a write one
+short append no matter how big the record's file would have been.
+
+To move an existing install over, stop the bot and run one of:
+
+    python storage.py migrate data/users/ data/users.sqlite3
+    python storage.py migrate data/users/ data/users_log/ --backend log
+"""
+
+
+class Record_Not_Found(FileNotFoundError):
+    """
+    Raised when a key has no stored record.
+    It is a FileNotFoundError so callers written for the json files keep working.
+    """
+
+
+class Json_Storage:
+    """Stores each record as its own json file in a directory."""
+    def __init__(self, path_prefix):
+        self.path_prefix = path_prefix     # Directory (with trailing slash) holding the files
+
+    def __str__(self):
+        return self.path_prefix
+
+    def _path(self, key):
+        return f"{self.path_prefix}{key}.json"
+
+    def keys(self):
+        """List the keys of every json file in the directory, in one pass."""
+        keys = set()
+        try:
+            with os.scandir(self.path_prefix or ".") as entries:
+                for entry in entries:
+                    if entry.name.endswith(".json") and entry.is_file():
+                        keys.add(entry.name[:-len(".json")])
+        except FileNotFoundError:
+            pass
+        return keys
+
+    def read(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "r+", encoding="utf-8") as f:
+                print(path)
+                return json.load(f)
+        except FileNotFoundError:
+            raise Record_Not_Found(path) from None
+
+    def write_many(self, items):
+        for key, payload in items:
+            # Write to a temporary file and swap it in, so a crash mid-write
+            # or two overlapping writes can never leave a truncated record.
+            path = self._path(key)
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as file:
+                file.write(payload)
+            os.replace(temp_path, path)
+
+    def maintain(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class Sqlite_Storage:
+    """
+    Stores every record as a json document in one SQLite table.
+
+    The database runs in WAL mode so reads never wait on the writer,
+    and each write_many() call is a single transaction.
+    Each thread gets its own connection, since the cache reads and
+    writes from a thread pool.
+    """
+    def __init__(self, db_path, table="records"):
+        if not table.isidentifier():
+            raise ValueError(f"Invalid table name: {table!r}")
+        self.db_path = db_path             # Path of the database file
+        self.table = table                 # Table holding this cache's records
+        self.local = threading.local()     # Per-thread connection
+        self.connections = []              # Every connection opened, so close() can find them
+        self.lock = threading.Lock()       # Guards self.connections
+        self._connection()                 # Create the database and table up front
+
+    def __str__(self):
+        return f"{self.db_path}:{self.table}"
+
+    def _connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            with connection:
+                connection.execute(
+                    f"CREATE TABLE IF NOT EXISTS {self.table} (key TEXT PRIMARY KEY, data TEXT NOT NULL)"
+                )
+            self.local.connection = connection
+            with self.lock:
+                self.connections.append(connection)
+        return connection
+
+    def keys(self):
+        rows = self._connection().execute(f"SELECT key FROM {self.table}")
+        return {key for (key,) in rows}
+
+    def read(self, key):
+        row = self._connection().execute(
+            f"SELECT data FROM {self.table} WHERE key = ?", (str(key),)
+        ).fetchone()
+        if row is None:
+            raise Record_Not_Found(f"{self}/{key}")
+        return json.loads(row[0])
+
+    def write_many(self, items):
+        rows = [(str(key), payload) for key, payload in items]
+        if not rows:
+            return
+        connection = self._connection()
+        with connection:
+            connection.executemany(
+                f"INSERT OR REPLACE INTO {self.table} (key, data) VALUES (?, ?)", rows
+            )
+
+    def maintain(self):
+        pass
+
+    def close(self):
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections.clear()
+        self.local = threading.local()
+
+
+class Log_Storage:
+    """
+    Stores records by appending them to segment files.
+
+    A write appends one line per record, "key<TAB>json", to the active
+    segment, and an in-memory index remembers where the newest copy of
+    each key lives. Nothing is rewritten in place, so changing one BP
+    counter costs one short append instead of rewriting a whole file.
+
+    Full segments are sealed. maintain() rewrites sealed segments that
+    are mostly stale copies into one compact segment. A checkpoint of the
+    index is saved whenever segments are sealed or compacted, so startup
+    only has to scan the segments written since.
+    """
+    SEGMENT_PREFIX = "segment-"
+    SEGMENT_SUFFIX = ".log"
+    CHECKPOINT = "checkpoint.json"
+
+    def __init__(self, directory, segment_size=8 * 1024 * 1024, compact_ratio=0.5):
+        self.directory = directory         # Folder holding segments and the checkpoint
+        self.segment_size = segment_size   # Bytes after which the active segment is sealed
+        self.compact_ratio = compact_ratio # Fraction of stale bytes in sealed segments that triggers compaction
+        self.lock = threading.RLock()      # Guards everything below
+        self.compact_lock = threading.Lock()  # Only one compaction at a time
+        self.index = {}                    # key -> (segment, offset, length) of its newest payload
+        self.segment_bytes = {}            # segment -> size in bytes
+        self.live_bytes = {}               # segment -> payload bytes the index still points at
+        self.readers = {}                  # segment -> open file used for reads
+        self.active = None                 # Number of the segment being appended to
+        self.writer = None                 # Append handle for the active segment
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+
+    def __str__(self):
+        return self.directory
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, f"{self.SEGMENT_PREFIX}{segment:08d}{self.SEGMENT_SUFFIX}")
+
+    def _segments_on_disk(self):
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.startswith(self.SEGMENT_PREFIX) and name.endswith(self.SEGMENT_SUFFIX):
+                number = name[len(self.SEGMENT_PREFIX):-len(self.SEGMENT_SUFFIX)]
+                if number.isdigit():
+                    segments.append(int(number))
+        return sorted(segments)
+
+    ############################
+    # Startup
+    ############################
+
+    def _recover(self):
+        """Rebuild the index from the checkpoint plus any segments written after it."""
+        segments = self._segments_on_disk()
+        checkpointed = self._load_checkpoint(segments)
+        for segment in segments:
+            if segment not in checkpointed:
+                self._scan_segment(segment)
+        self.active = segments[-1] if segments else 1
+        self.segment_bytes.setdefault(self.active, 0)
+        self.writer = open(self._segment_path(self.active), "ab")
+
+    def _load_checkpoint(self, segments):
+        """
+        Load the checkpointed index if it still matches the segments on disk.
+        Returns the segments it covers, or an empty set to rescan everything.
+        """
+        try:
+            with open(os.path.join(self.directory, self.CHECKPOINT), "r", encoding="utf-8") as f:
+                checkpoint = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return set()
+        covered = {int(segment): stat for segment, stat in checkpoint.get("segments", {}).items()}
+        for segment, (size, inode) in covered.items():
+            try:
+                stat = os.stat(self._segment_path(segment))
+            except FileNotFoundError:
+                return set()
+            # A compacted or rewritten segment no longer matches its offsets.
+            if stat.st_size != size or stat.st_ino != inode:
+                return set()
+        # Segments older than the checkpoint's newest must all be in it,
+        # otherwise replaying them would override newer data.
+        newest = max(covered, default=0)
+        if any(segment < newest and segment not in covered for segment in segments):
+            return set()
+        for key, (segment, offset, length) in checkpoint.get("index", {}).items():
+            self.index[key] = (segment, offset, length)
+            self.live_bytes[segment] = self.live_bytes.get(segment, 0) + length
+        for segment, (size, _) in covered.items():
+            self.segment_bytes[segment] = size
+        return set(covered)
+
+    def _scan_segment(self, segment):
+        path = self._segment_path(segment)
+        offset = 0
+        with open(path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break # Torn write from a crash, cut off below.
+                tab = line.index(b"\t")
+                key = line[:tab].decode("utf-8")
+                self._place(key, segment, offset + tab + 1, len(line) - tab - 2)
+                offset += len(line)
+        if os.path.getsize(path) != offset:
+            with open(path, "r+b") as f:
+                f.truncate(offset)
+        self.segment_bytes[segment] = offset
+
+    def _place(self, key, segment, offset, length):
+        old = self.index.get(key)
+        if old:
+            self.live_bytes[old[0]] -= old[2]
+        self.index[key] = (segment, offset, length)
+        self.live_bytes[segment] = self.live_bytes.get(segment, 0) + length
+
+    def _save_checkpoint(self):
+        """Save the index entries that live in sealed segments. Call with the lock held."""
+        sealed = [segment for segment in self.segment_bytes if segment != self.active]
+        segments = {}
+        for segment in sealed:
+            stat = os.stat(self._segment_path(segment))
+            segments[str(segment)] = [stat.st_size, stat.st_ino]
+        index = {key: list(loc) for key, loc in self.index.items() if loc[0] != self.active}
+        path = os.path.join(self.directory, self.CHECKPOINT)
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            json.dump({"segments": segments, "index": index}, f)
+        os.replace(f"{path}.tmp", path)
+
+    ############################
+    # Reads and writes
+    ############################
+
+    def keys(self):
+        with self.lock:
+            return set(self.index)
+
+    def _reader(self, segment):
+        reader = self.readers.get(segment)
+        if reader is None:
+            reader = open(self._segment_path(segment), "rb")
+            self.readers[segment] = reader
+        return reader
+
+    def read(self, key):
+        with self.lock:
+            location = self.index.get(str(key))
+            if location is None:
+                raise Record_Not_Found(f"{self}/{key}")
+            segment, offset, length = location
+            reader = self._reader(segment)
+            reader.seek(offset)
+            payload = reader.read(length)
+        return json.loads(payload)
+
+    def write_many(self, items):
+        if not items:
+            return
+        lines = []
+        with self.lock:
+            if self.segment_bytes[self.active] >= self.segment_size:
+                self._rotate()
+            offset = self.segment_bytes[self.active]
+            placements = []
+            for key, payload in items:
+                key = str(key)
+                encoded_key = key.encode("utf-8")
+                encoded = payload.encode("utf-8")
+                placements.append((key, offset + len(encoded_key) + 1, len(encoded)))
+                line = encoded_key + b"\t" + encoded + b"\n"
+                lines.append(line)
+                offset += len(line)
+            self.writer.write(b"".join(lines))
+            self.writer.flush()
+            for key, payload_offset, length in placements:
+                self._place(key, self.active, payload_offset, length)
+            self.segment_bytes[self.active] = offset
+
+    def _rotate(self):
+        """Seal the active segment and start a new one. Call with the lock held."""
+        self.writer.close()
+        self.active += 1
+        self.segment_bytes[self.active] = 0
+        self.writer = open(self._segment_path(self.active), "ab")
+        self._save_checkpoint()
+
+    ############################
+    # Compaction
+    ############################
+
+    def maintain(self):
+        """Compact sealed segments once enough of them is stale. Returns True if it compacted."""
+        with self.compact_lock:
+            return self._compact()
+
+    def _compact(self):
+        with self.lock:
+            sealed = sorted(segment for segment in self.segment_bytes if segment != self.active)
+            total = sum(self.segment_bytes[segment] for segment in sealed)
+            live = sum(self.live_bytes.get(segment, 0) for segment in sealed)
+            if not sealed or total == 0 or (total - live) / total < self.compact_ratio:
+                return False
+            survivors = sorted(
+                (loc, key) for key, loc in self.index.items() if loc[0] in self.segment_bytes and loc[0] != self.active
+            )
+        # Sealed segments never change, so copying them can happen without the lock.
+        target = sealed[-1]
+        temp_path = f"{self._segment_path(target)}.compact"
+        moved = []
+        offset = 0
+        sources = {}
+        try:
+            with open(temp_path, "wb") as out:
+                for (segment, payload_offset, length), key in survivors:
+                    source = sources.get(segment)
+                    if source is None:
+                        source = sources[segment] = open(self._segment_path(segment), "rb")
+                    source.seek(payload_offset)
+                    encoded_key = key.encode("utf-8")
+                    line = encoded_key + b"\t" + source.read(length) + b"\n"
+                    out.write(line)
+                    moved.append((key, (segment, payload_offset, length), offset + len(encoded_key) + 1))
+                    offset += len(line)
+        finally:
+            for source in sources.values():
+                source.close()
+        with self.lock:
+            for segment in sealed:
+                reader = self.readers.pop(segment, None)
+                if reader:
+                    reader.close()
+            os.replace(temp_path, self._segment_path(target))
+            for segment in sealed[:-1]:
+                os.remove(self._segment_path(segment))
+                self.segment_bytes.pop(segment, None)
+                self.live_bytes.pop(segment, None)
+            self.segment_bytes[target] = offset
+            self.live_bytes[target] = 0
+            for key, old_location, new_offset in moved:
+                # Keys rewritten while we were copying already point somewhere newer.
+                if self.index.get(key) == old_location:
+                    self.index[key] = (target, new_offset, old_location[2])
+                    self.live_bytes[target] += old_location[2]
+            self._save_checkpoint()
+        return True
+
+    def close(self):
+        with self.lock:
+            if self.writer:
+                self.writer.close()
+                self.writer = None
+            for reader in self.readers.values():
+                reader.close()
+            self.readers.clear()
+            self._save_checkpoint()
+
+
+def migrate_json(json_dir, target, batch_size=500):
+    """
+    Copy every json record in a directory into another storage backend.
+    Run this while the bot is stopped. Returns how many records were copied.
+    """
+    if not json_dir.endswith(("/", os.sep)):
+        json_dir += "/"
+    source = Json_Storage(json_dir)
+    batch = []
+    copied = 0
+    try:
+        for key in sorted(source.keys()):
+            with open(source._path(key), "r", encoding="utf-8") as f:
+                # Round trip through json so a corrupt file fails here, not in the bot.
+                batch.append((key, json.dumps(json.load(f))))
+            if len(batch) >= batch_size:
+                target.write_many(batch)
+                copied += len(batch)
+                batch = []
+        target.write_many(batch)
+        copied += len(batch)
+    finally:
+        target.close()
+    return copied
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the bot's record storage.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    migrate = commands.add_parser("migrate", help="Copy a directory of json records into another backend.")
+    migrate.add_argument("json_dir", help="Directory of json records, e.g. data/users/")
+    migrate.add_argument("target", help="SQLite database file, or log directory with --backend log")
+    migrate.add_argument("--backend", choices=["sqlite", "log"], default="sqlite")
+    migrate.add_argument("--table", default="records", help="SQLite table name")
+    migrate.add_argument("--batch-size", type=int, default=500)
+    compact = commands.add_parser("compact", help="Compact a log directory now.")
+    compact.add_argument("log_dir", help="Log directory, e.g. data/users_log/")
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        if args.backend == "log":
+            target = Log_Storage(args.target)
+        else:
+            target = Sqlite_Storage(args.target, args.table)
+        copied = migrate_json(args.json_dir, target, args.batch_size)
+        print(f"Copied {copied} records from {args.json_dir} into {target}.")
+    elif args.command == "compact":
+        target = Log_Storage(args.log_dir)
+        try:
+            compacted = target.maintain()
+        finally:
+            target.close()
+        print("Compacted." if compacted else "Not enough stale data to compact.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import unittest
+
+"""
+Moving pokemon between a user record and their PC box, with the bot
+killed part way through. Each case runs in its own process, which saves
+one cache and then dies before the other cache's write-behind gets to it.
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SETUP = """
+import asyncio
+import os
+import sys
+
+import users
+from frequency_cache import Frequency_Cache
+
+users.USERS = USERS = Frequency_Cache(10, sys.argv[1], static=False, write_delay=5)
+users.BOXES = BOXES = Frequency_Cache(10, sys.argv[2], static=False, write_delay=5)
+"""
+
+ARCHIVE = """
+async def main():
+    user = {"pokemon": [{"uid": f"p{i}"} for i in range(15)], "party": [], "boxed": 0}
+    await USERS.aput(1, user)
+    await USERS.aflush(force=True)
+    # Dirty before the archive, so its write-behind is due first.
+    user["name"] = "Ash"
+    await USERS.aput(1, user)
+    await users.archive_overflow(1, user)
+    await USERS.aflush(force=True)
+    os._exit(0)
+"""
+
+WITHDRAW = """
+async def main():
+    user = {"pokemon": [{"uid": f"p{i}"} for i in range(12)], "party": [], "boxed": 3}
+    await USERS.aput(1, user)
+    await USERS.aflush(force=True)
+    await BOXES.aput(1, {"uid": 1, "pokemon": [{"uid": f"b{i}"} for i in range(3)]})
+    await BOXES.aflush(force=True)
+    await users.withdraw_pokemon(1, user, 0)
+    await BOXES.aflush(force=True)
+    os._exit(0)
+"""
+
+
+class Killed_Between_Flushes(unittest.TestCase):
+    def run_and_kill(self, scenario):
+        """Run a scenario in a process that dies mid-move. Returns every pokemon uid left on disk."""
+        with tempfile.TemporaryDirectory() as temp:
+            users_dir = os.path.join(temp, "users") + os.sep
+            boxes_dir = os.path.join(temp, "boxes") + os.sep
+            os.makedirs(users_dir)
+            os.makedirs(boxes_dir)
+            script = SETUP + textwrap.dedent(scenario) + "\nasyncio.run(main())\n"
+            subprocess.run(
+                [sys.executable, "-c", script, users_dir, boxes_dir],
+                cwd=ROOT, check=True, capture_output=True,
+            )
+            found = set()
+            for directory in (users_dir, boxes_dir):
+                path = os.path.join(directory, "1.json")
+                if os.path.exists(path):
+                    with open(path, "r", encoding="utf-8") as f:
+                        found.update(entry["uid"] for entry in json.load(f)["pokemon"])
+            return found
+
+    def test_archive_keeps_every_pokemon(self):
+        self.assertEqual(self.run_and_kill(ARCHIVE), {f"p{i}" for i in range(15)})
+
+    def test_withdraw_keeps_every_pokemon(self):
+        expected = {f"p{i}" for i in range(12)} | {f"b{i}" for i in range(3)}
+        self.assertEqual(self.run_and_kill(WITHDRAW), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+from functools import lru_cache
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import classes
+import moves
+from classes import Elemental_Type
+
+"""
+This module knows how well each elemental type hits every other type.
+
+The chart is dense and indexed by Elemental_Type.value, with index 0
+standing for "no type" (a single-typed species' second type) and always
+1x, the same way dex_table.py stores types. Multipliers against every
+pair of defending types are worked out once, so a lookup is one index
+into a flat list however the defender is typed.
+
+move_matrix() answers "how well does every move hit every species" in
+one go, as a numpy array when numpy is installed.
+"""
+
+SIZE = len(Elemental_Type) + 1  # Row and column 0 are "no type"
+
+# Attacking type -> defending type -> multiplier. Anything not listed is 1x.
+MATCHUPS = {
+    "normal": {"rock": 0.5, "ghost": 0, "steel": 0.5},
+    "fire": {"fire": 0.5, "water": 0.5, "grass": 2, "ice": 2, "bug": 2, "rock": 0.5, "dragon": 0.5, "steel": 2},
+    "water": {"fire": 2, "water": 0.5, "grass": 0.5, "ground": 2, "rock": 2, "dragon": 0.5},
+    "electric": {"water": 2, "electric": 0.5, "grass": 0.5, "ground": 0, "flying": 2, "dragon": 0.5},
+    "grass": {
+        "fire": 0.5, "water": 2, "grass": 0.5, "poison": 0.5, "ground": 2,
+        "flying": 0.5, "bug": 0.5, "rock": 2, "dragon": 0.5, "steel": 0.5,
+    },
+    "ice": {"fire": 0.5, "water": 0.5, "grass": 2, "ice": 0.5, "ground": 2, "flying": 2, "dragon": 2, "steel": 0.5},
+    "fighting": {
+        "normal": 2, "ice": 2, "poison": 0.5, "flying": 0.5, "psychic": 0.5, "bug": 0.5,
+        "rock": 2, "ghost": 0, "dark": 2, "steel": 2, "fairy": 0.5,
+    },
+    "poison": {"grass": 2, "poison": 0.5, "ground": 0.5, "rock": 0.5, "ghost": 0.5, "steel": 0, "fairy": 2},
+    "ground": {"fire": 2, "electric": 2, "grass": 0.5, "poison": 2, "flying": 0, "bug": 0.5, "rock": 2, "steel": 2},
+    "flying": {"electric": 0.5, "grass": 2, "fighting": 2, "bug": 2, "rock": 0.5, "steel": 0.5},
+    "psychic": {"fighting": 2, "poison": 2, "psychic": 0.5, "dark": 0, "steel": 0.5},
+    "bug": {
+        "fire": 0.5, "grass": 2, "fighting": 0.5, "poison": 0.5, "flying": 0.5,
+        "psychic": 2, "ghost": 0.5, "dark": 2, "steel": 0.5, "fairy": 0.5,
+    },
+    "rock": {"fire": 2, "ice": 2, "fighting": 0.5, "ground": 0.5, "flying": 2, "bug": 2, "steel": 0.5},
+    "ghost": {"normal": 0, "psychic": 2, "ghost": 2, "dark": 0.5},
+    "dragon": {"dragon": 2, "steel": 0.5, "fairy": 0},
+    "dark": {"fighting": 0.5, "psychic": 2, "ghost": 2, "dark": 0.5, "fairy": 0.5},
+    "steel": {"fire": 0.5, "water": 0.5, "electric": 0.5, "ice": 2, "rock": 2, "steel": 0.5, "fairy": 2},
+    "fairy": {"fire": 0.5, "fighting": 2, "poison": 0.5, "dragon": 2, "dark": 2, "steel": 0.5},
+}
+
+
+def _build_chart():
+    chart = [1.0] * (SIZE * SIZE)
+    for attack, row in MATCHUPS.items():
+        for defend, multiplier in row.items():
+            chart[Elemental_Type[attack].value * SIZE + Elemental_Type[defend].value] = float(multiplier)
+    return chart
+
+
+CHART = _build_chart()  # CHART[attack * SIZE + defend]
+# DUAL[(attack * SIZE + type_1) * SIZE + type_2], with type_2 0 for a single type.
+DUAL = [
+    CHART[attack * SIZE + type_1] * CHART[attack * SIZE + type_2] if type_1 != type_2 else CHART[attack * SIZE + type_1]
+    for attack in range(SIZE)
+    for type_1 in range(SIZE)
+    for type_2 in range(SIZE)
+]
+
+
+def type_id(type_) -> int:
+    """The chart index of an Elemental_Type, a type name or a value. None is 0."""
+    if type_ is None:
+        return 0
+    if isinstance(type_, Elemental_Type):
+        return type_.value
+    if isinstance(type_, str):
+        return Elemental_Type[type_.lower()].value
+    return int(type_)
+
+
+def species_types(species):
+    """A species' (type_1, type_2) chart indexes."""
+    return (species.type_1.value, species.type_2.value if species.type_2 else 0)
+
+
+def multiplier(attack, defend) -> float:
+    """How well one type hits another."""
+    return CHART[type_id(attack) * SIZE + type_id(defend)]
+
+
+def effectiveness(attack, type_1, type_2=None) -> float:
+    """How well a type hits a defender with up to two types."""
+    return DUAL[(type_id(attack) * SIZE + type_id(type_1)) * SIZE + type_id(type_2)]
+
+
+def against_species(attack, species) -> float:
+    type_1, type_2 = species_types(species)
+    return DUAL[(type_id(attack) * SIZE + type_1) * SIZE + type_2]
+
+
+def describe(value) -> str:
+    """The battle log line for a multiplier, or "" for a normal hit."""
+    if value == 0:
+        return "It had no effect..."
+    if value > 1:
+        return "It's super effective!"
+    if value < 1:
+        return "It's not very effective..."
+    return ""
+
+
+@lru_cache(maxsize=None)
+def dual_array():
+    """DUAL as a numpy array indexed [attack, type_1, type_2]."""
+    return numpy.array(DUAL, dtype=numpy.float32).reshape(SIZE, SIZE, SIZE)
+
+
+def move_matrix(move_list=None, species_list=None):
+    """
+    How well every move hits every species, as rows of moves and columns of species.
+    Defaults to every move and every species in the pokedex. Needs numpy.
+    """
+    if numpy is None:
+        raise RuntimeError("move_matrix() needs numpy. Use against_species() one pair at a time instead.")
+    if move_list is None:
+        move_list = list(moves.MOVES.values())
+    move_types = numpy.array([type_id(move.type) for move in move_list], dtype=numpy.intp)
+    registry = classes.species_registry()
+    if species_list is None and registry.table is not None:
+        # Read the type columns straight from the compiled pokedex.
+        type_1 = registry.table.column("type_1").astype(numpy.intp)
+        type_2 = registry.table.column("type_2").astype(numpy.intp)
+    else:
+        pairs = [species_types(species) for species in (species_list if species_list is not None else registry)]
+        type_1 = numpy.array([pair[0] for pair in pairs], dtype=numpy.intp)
+        type_2 = numpy.array([pair[1] for pair in pairs], dtype=numpy.intp)
+    return dual_array()[move_types[:, None], type_1[None, :], type_2[None, :]]
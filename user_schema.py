@@ -0,0 +1,163 @@
+import classes
+
+"""
+This module upgrades stored user records to the current layout.
+
+Every record carries a schema_version. MIGRATIONS[n] upgrades a record
+from version n to n + 1, so an old record is walked forward one step at
+a time, once, when it's loaded. Records without a version are version 0.
+
+To change the layout, write a migration that takes (uid, user) and edits
+the user dict in place, append it to MIGRATIONS, and every record will
+pick it up the next time it's read.
+"""
+
+battle_log = None  # The Battle_Log inline histories move to, set by db.py
+
+
+def _normalise_structure(uid, user):
+    """Fill in missing fields, re-encode every pokemon and repair the party."""
+    user["uid"] = uid
+    user.setdefault("name", str(uid))
+    user.setdefault("bp", 0)
+    if not isinstance(user.get("items"), dict):
+        user["items"] = {}
+    if not isinstance(user.get("pokemon"), list):
+        user["pokemon"] = []
+
+    roster = user["pokemon"]
+    ids_seen = set()
+    for idx, data in enumerate(list(roster)):
+        mon = classes.Individual.from_dict(data)
+        if not mon:
+            continue
+        roster[idx] = mon.to_dict()
+        ids_seen.add(mon.instance_id)
+
+    if not isinstance(user.get("party"), list):
+        user["party"] = []
+    user["party"] = [pid for pid in user["party"] if pid in ids_seen]
+    if not user["party"] and roster:
+        user["party"] = [entry.get("uid") for entry in roster[:6] if entry.get("uid")]
+
+    if not isinstance(user.get("battles"), list):
+        user["battles"] = []
+
+
+BATTLE_KINDS = ("wild", "trainer")
+OUTCOMES = ("win", "loss", "draw")
+
+
+def empty_battle_stats():
+    """Lifetime battle counters, by kind of battle and then by outcome."""
+    return {kind: {outcome: 0 for outcome in OUTCOMES} for kind in BATTLE_KINDS}
+
+
+def battle_kind(context):
+    return "wild" if context.get("type") == "wild" else "trainer"
+
+
+def normalise_battle(battle):
+    """Turn a stored battle history entry into the current dict form, or None if it's unreadable."""
+    if isinstance(battle, dict):
+        context = battle.get("context")
+        entry = {
+            "outcome": battle.get("outcome"),
+            "context": context if isinstance(context, dict) else {},
+            "timestamp": battle.get("timestamp"),
+        }
+    elif isinstance(battle, (list, tuple)) and battle:
+        # Legacy entries are [value, ...] with 1 for a win, from before wild battles existed.
+        outcome = "win" if battle[0] == 1 else "draw" if battle[0] == 0.5 else "loss"
+        entry = {"outcome": outcome, "context": {"type": "trainer"}, "timestamp": None}
+    else:
+        return None
+    return entry if entry["outcome"] in OUTCOMES else None
+
+
+def _count_battles(uid, user):
+    """Backfill battle counters from whatever history the record still has."""
+    stats = empty_battle_stats()
+    for battle in user.get("battles", []):
+        entry = normalise_battle(battle)
+        if entry:
+            stats[battle_kind(entry["context"])][entry["outcome"]] += 1
+    user["battle_stats"] = stats
+
+
+def index_roster(user):
+    """
+    Rebuild the pokemon uid -> roster position index.
+    Anything that removes or reorders pokemon should call this afterwards.
+    """
+    user["roster_index"] = {
+        entry["uid"]: pos for pos, entry in enumerate(user.get("pokemon", []))
+        if isinstance(entry, dict) and entry.get("uid")
+    }
+
+
+def _index_roster(uid, user):
+    index_roster(user)
+
+
+def pokemon_count(user):
+    """Every pokemon a user owns, in their record or in their PC box."""
+    return len(user.get("pokemon", [])) + user.get("boxed", 0)
+
+
+def _add_box_count(uid, user):
+    # Records are moved into their PC box the next time they're used, see users.archive_overflow().
+    user.setdefault("boxed", 0)
+
+
+def _move_battles_to_log(uid, user):
+    """Older records kept their battle history inline. It belongs in the battle log now."""
+    battles = user.get("battles")
+    if battles:
+        if battle_log is None:
+            raise RuntimeError("user_schema.battle_log has to be set before records are upgraded.")
+        # Logs are only started after this step, so one that exists already holds these battles:
+        # the record was loaded before, or scored by a leaderboard rebuild, but not saved since.
+        if not battle_log.has_log(uid):
+            battle_log.append_many(uid, [entry for entry in map(normalise_battle, battles) if entry])
+    user.pop("battles", None)
+
+
+MIGRATIONS = [
+    _normalise_structure,  # 0 -> 1
+    _count_battles,        # 1 -> 2
+    _index_roster,         # 2 -> 3
+    _add_box_count,        # 3 -> 4
+    _move_battles_to_log,  # 4 -> 5
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def is_current(user) -> bool:
+    return user.get("schema_version") == SCHEMA_VERSION
+
+
+def upgrade_user_record(uid, user) -> bool:
+    """
+    Run every migration the record is missing, in order.
+    Returns True if the record changed and needs saving.
+    """
+    version = user.get("schema_version", 0)
+    if version == SCHEMA_VERSION:
+        return False
+    if not isinstance(version, int) or version > SCHEMA_VERSION:
+        raise ValueError(f"User {uid} has unknown schema version {version!r}.")
+    for migration in MIGRATIONS[version:]:
+        migration(uid, user)
+    user["schema_version"] = SCHEMA_VERSION
+    return True
+
+
+def upgrade_on_load(key, user) -> bool:
+    """Frequency_Cache upgrade hook. Keys read back from storage may be strings."""
+    try:
+        uid = int(key)
+    except (TypeError, ValueError):
+        uid = key
+    return upgrade_user_record(uid, user)
@@ -2,11 +2,15 @@ from __future__ import annotations
 
 import math
 import time
+from dataclasses import dataclass, field
 from typing import Dict, List, Optional, Sequence, Tuple
 
+from discobot_modules.emoji_actions import Emoji_Action, action_button_list, ea_response
+
 import classes
-from db import USERS
+from db import USERS, BOXES, BP_LEDGER, BATTLE_LOG
 import embeds
+import user_schema
 
 STAT_DISPLAY = {
     "hp": "HP",
@@ -38,149 +42,329 @@ STAT_ALIASES = {
 
 TRAINING_COST = 5
 
+PAGE_SIZE = 10
+
+# Pokemon kept in the user record: the party plus a few recent catches.
+# Older ones outside the party move to the PC box, so the record stays a few KB.
+HOT_ROSTER_SIZE = 12
+
+# How a collection can be ordered. Each sorts stored dicts, so nothing is decoded to sort.
+COLLECTION_SORTS = {
+    "caught": None,
+    "recent": None,
+    "level": lambda data: -data.get("level", 1),
+    "species": lambda data: data.get("species", 0),
+}
+
 """This module handles user profiles, onboarding, and party management."""
 
+# Decoded pokemon are only good until their owner's record is saved again.
+USERS.add_listener(lambda uid, _event: classes.DECODED.forget(uid))
 
-def ensure_user_record(uid: int) -> Dict:
-    """Ensure that a user record contains the latest structural fields."""
-    if uid not in USERS:
-        raise KeyError(f"User {uid} not found in database.")
 
-    user = USERS[uid]
-    changed = False
-
-    if user.get("uid") != uid:
-        user["uid"] = uid
-        changed = True
-    if "name" not in user:
-        user["name"] = str(uid)
-        changed = True
-    if "bp" not in user:
-        user["bp"] = 0
-        changed = True
-    if "items" not in user or not isinstance(user["items"], dict):
-        user["items"] = {}
-        changed = True
-    if "pokemon" not in user or not isinstance(user["pokemon"], list):
-        user["pokemon"] = []
-        changed = True
+def decode_pokemon(uid: int, data: Dict) -> Optional[classes.Individual]:
+    """Decode a pokemon from a user's roster, reusing it if this command already did."""
+    return classes.DECODED.decode(uid, data)
 
-    roster = user["pokemon"]
-    ids_seen = set()
-    for idx, data in enumerate(list(roster)):
-        mon = classes.Individual.from_dict(data)
-        if not mon:
-            continue
-        serialised = mon.to_dict()
-        if serialised != data:
-            roster[idx] = serialised
-            changed = True
-        ids_seen.add(serialised["uid"])
-
-    if "party" not in user or not isinstance(user["party"], list):
-        user["party"] = []
-        changed = True
-
-    filtered_party = [pid for pid in user["party"] if pid in ids_seen]
-    if filtered_party != user["party"]:
-        user["party"] = filtered_party
-        changed = True
-
-    if not user["party"] and roster:
-        user["party"] = [entry.get("uid") for entry in roster[:6] if entry.get("uid")]
-        changed = True
-
-    if "battles" not in user or not isinstance(user["battles"], list):
-        user["battles"] = []
-        changed = True
-
-    if changed:
-        USERS[uid] = user
-        USERS.save_item(uid)
 
+def roster_position(user: Dict, mon_id: str) -> Optional[int]:
+    """Where a pokemon sits in user["pokemon"], or None if they don't have it."""
+    roster = user.get("pokemon", [])
+    pos = user.get("roster_index", {}).get(mon_id)
+    if pos is not None and pos < len(roster) and roster[pos].get("uid") == mon_id:
+        return pos
+    # Stale or missing, so something changed the roster without reindexing it.
+    user_schema.index_roster(user)
+    return user["roster_index"].get(mon_id)
+
+
+def find_pokemon(uid: int, user: Dict, mon_id: str) -> Optional[classes.Individual]:
+    """Decode one pokemon from a user's roster by its uid."""
+    pos = roster_position(user, mon_id)
+    if pos is None:
+        return None
+    return decode_pokemon(uid, user["pokemon"][pos])
+
+
+@dataclass
+class Collection_Page:
+    """One page of a user's pokemon. Entries are (collection number, pokemon)."""
+    entries: List[Tuple[int, classes.Individual]] = field(default_factory=list)
+    page: int = 1
+    pages: int = 1
+    total: int = 0    # How many pokemon matched the filters
+    hidden: int = 0   # Pokemon left in the PC box because it wasn't opened
+
+
+def _collection_filter(species: Optional[int], min_level: Optional[int], shiny: Optional[bool]):
+    def keep(data: Dict) -> bool:
+        if species is not None and data.get("species") != species:
+            return False
+        if min_level is not None and data.get("level", 1) < min_level:
+            return False
+        if shiny is not None and bool(data.get("shiny", False)) != shiny:
+            return False
+        return True
+    return keep
+
+
+async def get_collection_page(
+    uid: int,
+    page: int = 1,
+    per_page: int = PAGE_SIZE,
+    sort: str = "caught",
+    species: Optional[int] = None,
+    min_level: Optional[int] = None,
+    shiny: Optional[bool] = None,
+    include_box: bool = True,
+) -> Collection_Page:
+    """
+    Filter and sort a user's collection, then decode only one page of it.
+
+    The collection is the PC box followed by the roster, and collection
+    numbers count through both, so they work with `!party add`.
+    With include_box off the box isn't loaded and only the roster is shown.
+    Pages out of range are clamped to the first or last page.
+    """
+    user = await ensure_user_record(uid)
+    keep = _collection_filter(species, min_level, shiny)
+    boxed = user.get("boxed", 0)
+    collection = []
+    hidden = boxed
+    if include_box and boxed:
+        box = await _load_box(uid, user)
+        collection.extend(enumerate(box["pokemon"]))
+        boxed = len(box["pokemon"])
+        hidden = 0
+    collection.extend((boxed + pos, data) for pos, data in enumerate(user["pokemon"]))
+    matches = [(pos, data) for pos, data in collection if keep(data)]
+    if sort == "recent":
+        matches.reverse()
+    elif COLLECTION_SORTS.get(sort):
+        order = COLLECTION_SORTS[sort]
+        matches.sort(key=lambda match: order(match[1]))
+    pages = max(1, math.ceil(len(matches) / per_page))
+    page = min(max(1, page), pages)
+    start = (page - 1) * per_page
+    entries = []
+    for pos, data in matches[start:start + per_page]:
+        mon = decode_pokemon(uid, data)
+        if mon:
+            entries.append((pos + 1, mon))
+    return Collection_Page(entries, page, pages, len(matches), hidden)
+
+
+async def get_collection_entry(uid: int, number: int) -> Optional[classes.Individual]:
+    """Decode one pokemon by collection number. The box is only loaded if it's in there."""
+    user = await ensure_user_record(uid)
+    boxed = user.get("boxed", 0)
+    if number < 1 or number > boxed + len(user["pokemon"]):
+        return None
+    if number <= boxed:
+        box = await _load_box(uid, user)
+        if number > len(box["pokemon"]):
+            return None
+        return decode_pokemon(uid, box["pokemon"][number - 1])
+    return decode_pokemon(uid, user["pokemon"][number - boxed - 1])
+
+
+async def _load_box(uid: int, user: Dict) -> Dict:
+    """Load a user's PC box, making an empty one if they don't have one yet."""
+    box = await BOXES.aget(uid) if uid in BOXES else {"uid": uid, "pokemon": []}
+    # A crash between saving the box and the record can leave a pokemon in both.
+    # The record's copy is the one in use, so drop the boxed one.
+    # Only once the record is on disk, though, and it can't be written mid-transaction.
+    in_roster = {entry.get("uid") for entry in user["pokemon"]}
+    if uid not in USERS.transactions and any(entry.get("uid") in in_roster for entry in box["pokemon"]):
+        await USERS.awrite(uid)
+        box["pokemon"] = [entry for entry in box["pokemon"] if entry.get("uid") not in in_roster]
+        await BOXES.aput(uid, box)
+    if user.get("boxed") != len(box["pokemon"]):
+        user["boxed"] = len(box["pokemon"])
+        await USERS.aput(uid, user)
+    return box
+
+
+async def archive_overflow(uid: int, user: Dict) -> int:
+    """
+    Move the oldest pokemon outside the party into the PC box,
+    until the record holds at most HOT_ROSTER_SIZE. Returns how many moved.
+    """
+    # Locked, since loading the box awaits and a catch meanwhile would change the roster under us.
+    async with USERS.locked(uid):
+        overflow = len(user["pokemon"]) - HOT_ROSTER_SIZE
+        if overflow <= 0:
+            return 0
+        party = set(user.get("party", []))
+        keep, moved = [], []
+        for entry in user["pokemon"]:
+            if len(moved) < overflow and entry.get("uid") not in party:
+                moved.append(entry)
+            else:
+                keep.append(entry)
+        if not moved:
+            return 0
+        box = await _load_box(uid, user)
+        box["pokemon"].extend(moved)
+        # Both caches write behind, on their own schedules, so the box has to reach the disk
+        # before the record is even saved. A crash in between can then only leave a pokemon in both.
+        await BOXES.aput(uid, box)
+        await BOXES.awrite(uid)
+        user["pokemon"] = keep
+        user["boxed"] = len(box["pokemon"])
+        user_schema.index_roster(user)
+        await USERS.aput(uid, user)
+        return len(moved)
+
+
+async def withdraw_pokemon(uid: int, user: Dict, box_position: int) -> Optional[Dict]:
+    """
+    Move a pokemon from the PC box to the end of the roster. Returns its stored dict.
+    Not inside a transaction on the user: the record has to be written before the box is saved.
+    """
+    if uid in USERS.transactions:
+        raise RuntimeError(f"Can't withdraw for {uid} inside a transaction on their record.")
+    async with USERS.locked(uid):
+        box = await _load_box(uid, user)
+        if box_position < 0 or box_position >= len(box["pokemon"]):
+            return None
+        data = box["pokemon"].pop(box_position)
+        user["pokemon"].append(data)
+        user["boxed"] = len(box["pokemon"])
+        user.setdefault("roster_index", {})[data.get("uid")] = len(user["pokemon"]) - 1
+        # The record reaches the disk first this time, for the same reason as in archive_overflow().
+        await USERS.aput(uid, user)
+        await USERS.awrite(uid)
+        await BOXES.aput(uid, box)
+        return data
+
+
+async def add_page_buttons(sent, owner_id: int, page: int, render) -> None:
+    """
+    Add previous/next reactions that page through a collection.
+    render(page) is awaited on each press and returns (embed, Collection_Page).
+    Only the owner can turn the pages.
+    """
+    state = {"page": page}
+
+    async def turn(args, step):
+        reactor = args[1]
+        if reactor.id == owner_id:
+            embed, view = await render(state["page"] + step)
+            if view.page != state["page"]:
+                state["page"] = view.page
+                await sent.edit(embed=embed)
+        return ea_response(complete_action=False)
+
+    await action_button_list(sent, [
+        Emoji_Action("◀️", "Previous page", lambda args: turn(args, -1), pass_user=True),
+        Emoji_Action("▶️", "Next page", lambda args: turn(args, 1), pass_user=True),
+    ])
+
+
+async def ensure_user_record(uid: int) -> Dict:
+    """
+    Ensure that a user record contains the latest structural fields.
+
+    Records are upgraded once when they're loaded (see user_schema.py),
+    so for a current record this is just a version check.
+    """
+    if uid not in USERS:
+        raise KeyError(f"User {uid} not found in database.")
+
+    user = await USERS.aget(uid)
+    if not user_schema.is_current(user):
+        # Only records put in the cache by hand get this far.
+        user_schema.upgrade_user_record(uid, user)
+        await USERS.aput(uid, user)
+    if len(user["pokemon"]) > HOT_ROSTER_SIZE:
+        await archive_overflow(uid, user)
     return user
 
 
-def update_display_name(member) -> None:
+async def update_display_name(member) -> None:
     """Persist the latest display name for leaderboard and embeds."""
     if not member or member.id not in USERS:
         return
     display_name = getattr(member, "display_name", None) or getattr(member, "name", None)
     if not display_name:
         return
-    user = ensure_user_record(member.id)
+    user = await ensure_user_record(member.id)
     if user.get("name") != display_name:
         user["name"] = display_name
-        USERS[member.id] = user
-        USERS.save_item(member.id)
+        await USERS.aput(member.id, user)
 
 
-def get_display_name(uid: int) -> str:
-    user = ensure_user_record(uid)
+async def get_display_name(uid: int) -> str:
+    user = await ensure_user_record(uid)
     return user.get("name", str(uid))
 
 
-def roster_with_ids(uid: int) -> List[Tuple[str, classes.Individual]]:
-    user = ensure_user_record(uid)
+async def roster_with_ids(uid: int) -> List[Tuple[str, classes.Individual]]:
+    user = await ensure_user_record(uid)
     roster: List[Tuple[str, classes.Individual]] = []
     for data in user["pokemon"]:
-        mon = classes.Individual.from_dict(data)
+        mon = decode_pokemon(uid, data)
         if mon:
             roster.append((mon.instance_id, mon))
     return roster
 
 
-def get_party_members(uid: int) -> List[classes.Individual]:
-    user = ensure_user_record(uid)
-    roster_map = {mon_id: mon for mon_id, mon in roster_with_ids(uid)}
+async def get_party_members(uid: int) -> List[classes.Individual]:
+    """Decode just the party, looking each member up by roster position."""
+    user = await ensure_user_record(uid)
     party_members: List[classes.Individual] = []
     for mon_id in user.get("party", []):
-        mon = roster_map.get(mon_id)
+        mon = find_pokemon(uid, user, mon_id)
         if mon:
             party_members.append(mon)
     return party_members
 
 
-def add_to_party(uid: int, index: int) -> Tuple[bool, str]:
-    roster = roster_with_ids(uid)
-    if not roster:
+async def add_to_party(uid: int, index: int) -> Tuple[bool, str]:
+    user = await ensure_user_record(uid)
+    boxed = user.get("boxed", 0)
+    if not boxed and not user["pokemon"]:
         return False, "You haven't caught any Pokémon yet. Try catching a wild one first!"
-    if index < 1 or index > len(roster):
+    if index < 1 or index > boxed + len(user["pokemon"]):
         return False, "That Pokémon index is out of range."
-    mon_id, mon = roster[index - 1]
-    user = ensure_user_record(uid)
+    if index <= boxed:
+        # Boxed pokemon are never in the party, so only withdraw if there's room.
+        if len(user["party"]) >= 6:
+            return False, "Your party is full. Remove a member first."
+        data = await withdraw_pokemon(uid, user, index - 1)
+    else:
+        data = user["pokemon"][index - boxed - 1]
+    mon = decode_pokemon(uid, data) if data else None
+    if not mon:
+        return False, "I couldn't find that Pokémon in your collection."
+    mon_id = mon.instance_id
     if mon_id in user["party"]:
         return False, f"{mon.get_title()} is already in your party."
     if len(user["party"]) >= 6:
         return False, "Your party is full. Remove a member first."
     user["party"].append(mon_id)
-    USERS[uid] = user
-    USERS.save_item(uid)
+    await USERS.aput(uid, user)
     return True, f"Added {mon.get_title()} to your party."
 
 
-def remove_from_party(uid: int, slot: int) -> Tuple[bool, str]:
-    user = ensure_user_record(uid)
+async def remove_from_party(uid: int, slot: int) -> Tuple[bool, str]:
+    user = await ensure_user_record(uid)
     party = user.get("party", [])
     if not party:
         return False, "Your party is already empty."
     if slot < 1 or slot > len(party):
         return False, "That party slot doesn't exist yet."
     mon_id = party.pop(slot - 1)
-    removed_mon: Optional[classes.Individual] = None
-    for data in user["pokemon"]:
-        if data.get("uid") == mon_id:
-            removed_mon = classes.Individual.from_dict(data)
-            break
-    USERS[uid] = user
-    USERS.save_item(uid)
+    removed_mon = find_pokemon(uid, user, mon_id)
+    await USERS.aput(uid, user)
     if removed_mon:
         return True, f"Removed {removed_mon.get_title()} from your party."
     return True, "Removed that party member."
 
 
-def swap_party_members(uid: int, slot_a: int, slot_b: int) -> Tuple[bool, str]:
-    user = ensure_user_record(uid)
+async def swap_party_members(uid: int, slot_a: int, slot_b: int) -> Tuple[bool, str]:
+    user = await ensure_user_record(uid)
     party = user.get("party", [])
     size = len(party)
     if size < 2:
@@ -190,30 +374,29 @@ def swap_party_members(uid: int, slot_a: int, slot_b: int) -> Tuple[bool, str]:
     if slot_a == slot_b:
         return False, "Those slots are the same Pokémon already."
     party[slot_a - 1], party[slot_b - 1] = party[slot_b - 1], party[slot_a - 1]
-    USERS[uid] = user
-    USERS.save_item(uid)
+    await USERS.aput(uid, user)
     return True, "Swapped those party members."
 
 
-def auto_fill_party(uid: int) -> Tuple[bool, str]:
-    roster = roster_with_ids(uid)
+async def auto_fill_party(uid: int) -> Tuple[bool, str]:
+    user = await ensure_user_record(uid)
+    roster = user["pokemon"]
     if not roster:
         return False, "You haven't caught any Pokémon yet."
-    user = ensure_user_record(uid)
-    user["party"] = [mon_id for mon_id, _ in roster[:6]]
-    USERS[uid] = user
-    USERS.save_item(uid)
-    count = min(len(roster), 6)
+    user["party"] = [entry["uid"] for entry in roster[:6] if entry.get("uid")]
+    await USERS.aput(uid, user)
+    count = len(user["party"])
     return True, f"Filled your party with the first {count} Pokémon in your collection."
 
 
-def catch_pokemon(uid: int, mon: classes.Individual) -> None:
-    user = ensure_user_record(uid)
+async def catch_pokemon(uid: int, mon: classes.Individual) -> None:
+    user = await ensure_user_record(uid)
     user.setdefault("pokemon", []).append(mon.to_dict())
+    user.setdefault("roster_index", {})[mon.instance_id] = len(user["pokemon"]) - 1
     if len(user.setdefault("party", [])) < 6:
         user["party"].append(mon.instance_id)
-    USERS[uid] = user
-    USERS.save_item(uid)
+    if not await archive_overflow(uid, user):
+        await USERS.aput(uid, user)
 
 
 def _resolve_stat_key(token: str) -> Optional[str]:
@@ -223,8 +406,8 @@ def _resolve_stat_key(token: str) -> Optional[str]:
     return STAT_ALIASES.get(normalised)
 
 
-def train_pokemon(uid: int, slot: int, stat_key: str, sessions: int = 1) -> Tuple[bool, str, Optional[classes.Individual]]:
-    user = ensure_user_record(uid)
+async def train_pokemon(uid: int, slot: int, stat_key: str, sessions: int = 1) -> Tuple[bool, str, Optional[classes.Individual]]:
+    user = await ensure_user_record(uid)
     party = user.get("party", [])
     if not party:
         return False, "You don't have any Pokémon in your party yet.", None
@@ -232,14 +415,8 @@ def train_pokemon(uid: int, slot: int, stat_key: str, sessions: int = 1) -> Tupl
         return False, "That party slot doesn't exist yet.", None
 
     mon_id = party[slot - 1]
-    roster = user.get("pokemon", [])
-    mon_index: Optional[int] = None
-    mon_obj: Optional[classes.Individual] = None
-    for idx, entry in enumerate(roster):
-        if entry.get("uid") == mon_id:
-            mon_index = idx
-            mon_obj = classes.Individual.from_dict(entry)
-            break
+    mon_index = roster_position(user, mon_id)
+    mon_obj = decode_pokemon(uid, user["pokemon"][mon_index]) if mon_index is not None else None
     if mon_index is None or not mon_obj:
         return False, "I couldn't find that Pokémon in your collection.", None
 
@@ -261,6 +438,7 @@ def train_pokemon(uid: int, slot: int, stat_key: str, sessions: int = 1) -> Tupl
 
     sessions_used = max(1, math.ceil(gain / 4))
     cost = sessions_used * TRAINING_COST
+    BP_LEDGER.settle(uid, user)
     if user.get("bp", 0) < cost:
         plural = "s" if sessions_used != 1 else ""
         return False, f"You need {cost} BP to run {sessions_used} training session{plural}.", None
@@ -272,8 +450,7 @@ def train_pokemon(uid: int, slot: int, stat_key: str, sessions: int = 1) -> Tupl
 
     user["bp"] = user.get("bp", 0) - cost
     user["pokemon"][mon_index] = mon_obj.to_dict()
-    USERS[uid] = user
-    USERS.save_item(uid)
+    await USERS.aput(uid, user)
 
     stat_name = STAT_DISPLAY[stat_key]
     stats = mon_obj.get_stats()
@@ -287,127 +464,216 @@ def train_pokemon(uid: int, slot: int, stat_key: str, sessions: int = 1) -> Tupl
     return True, message, mon_obj
 
 
-def adjust_bp(uid: int, delta: int) -> int:
-    user = ensure_user_record(uid)
+async def adjust_bp(uid: int, delta: int) -> int:
+    user = await ensure_user_record(uid)
+    BP_LEDGER.settle(uid, user)
     user["bp"] = user.get("bp", 0) + delta
-    USERS[uid] = user
-    USERS.save_item(uid)
+    await USERS.aput(uid, user)
     return user["bp"]
 
 
-def record_battle(uid: int, outcome: str, context: Dict) -> None:
+async def record_battle(uid: int, outcome: str, context: Dict) -> Optional[Dict]:
+    """
+    Count a battle on the user's record. Returns its battle log entry, for log_battle()
+    once the record is committed, so a rolled back battle leaves nothing in the log.
+    """
     if uid not in USERS:
-        return
-    user = ensure_user_record(uid)
-    entry = {"outcome": outcome, "context": context, "timestamp": time.time()}
-    user.setdefault("battles", []).append(entry)
-    user["battles"] = user["battles"][-50:]
-    USERS[uid] = user
-    USERS.save_item(uid)
+        return None
+    user = await ensure_user_record(uid)
+    stats = user.setdefault("battle_stats", user_schema.empty_battle_stats())
+    kind = user_schema.battle_kind(context)
+    stats[kind][outcome] = stats[kind].get(outcome, 0) + 1
+    await USERS.aput(uid, user)
+    return {"outcome": outcome, "context": context, "timestamp": time.time()}
 
 
-async def train_command(message, args: Sequence[str]):
+async def log_battle(uid: int, entry: Dict) -> None:
+    await BATTLE_LOG.append(uid, [entry])
+
+
+HISTORY_PAGE_SIZE = 10
+
+
+async def history_command(message, args: Sequence[str]):
+    """Show a user's battles, newest first, e.g. `!history` or `!history 3`."""
     uid = message.author.id
     if uid not in USERS:
-        new_user(message.author)
-    ensure_user_record(uid)
-    update_display_name(message.author)
-
-    if len(args) < 2:
-        await message.reply(
-            "Use `!train <party slot> <stat> [sessions]`, for example `!train 1 attack 3`."
-        )
-        return
+        await new_user(message.author)
+    user = await ensure_user_record(uid)
+    await update_display_name(message.author)
 
-    try:
-        slot = int(args[0])
-    except ValueError:
-        await message.reply("I couldn't understand that party slot number.")
-        return
+    page = int(args[0]) if args and args[0].isdigit() else 1
+    page = max(1, page)
+    entries = await BATTLE_LOG.arecent(uid, HISTORY_PAGE_SIZE, (page - 1) * HISTORY_PAGE_SIZE)
+    await message.reply(embed=embeds.battle_history(message.author, user, entries, page))
 
-    stat_key = _resolve_stat_key(args[1])
-    if not stat_key:
-        await message.reply(
-            "I couldn't tell which stat you meant. Try HP, Attack, Defense, SpAtk, SpDef, or Speed."
-        )
-        return
 
-    sessions = 1
-    if len(args) >= 3:
+async def train_command(message, args: Sequence[str]):
+    uid = message.author.id
+    if uid not in USERS:
+        await new_user(message.author)
+    # One load and one save, however many helpers touch the record.
+    async with USERS.transaction(uid):
+        await ensure_user_record(uid)
+        await update_display_name(message.author)
+
+        if len(args) < 2:
+            await message.reply(
+                "Use `!train <party slot> <stat> [sessions]`, for example `!train 1 attack 3`."
+            )
+            return
+
         try:
-            sessions = max(1, int(args[2]))
+            slot = int(args[0])
         except ValueError:
-            await message.reply("I couldn't understand how many training sessions to run.")
+            await message.reply("I couldn't understand that party slot number.")
             return
-        sessions = min(sessions, 63)
 
-    success, response, mon = train_pokemon(uid, slot, stat_key, sessions)
-    if not success:
-        await message.reply(response)
-        return
+        stat_key = _resolve_stat_key(args[1])
+        if not stat_key:
+            await message.reply(
+                "I couldn't tell which stat you meant. Try HP, Attack, Defense, SpAtk, SpDef, or Speed."
+            )
+            return
+
+        sessions = 1
+        if len(args) >= 3:
+            try:
+                sessions = max(1, int(args[2]))
+            except ValueError:
+                await message.reply("I couldn't understand how many training sessions to run.")
+                return
+            sessions = min(sessions, 63)
+
+        success, response, mon = await train_pokemon(uid, slot, stat_key, sessions)
+        if not success:
+            await message.reply(response)
+            return
 
-    embed = embeds.pokemon_summary(mon)
-    await message.reply(response, embed=embed)
+        embed = embeds.pokemon_summary(mon)
+        await message.reply(response, embed=embed)
 
 
 async def party_command(message, args: Sequence[str]):
     uid = message.author.id
     if uid not in USERS:
-        new_user(message.author)
-    ensure_user_record(uid)
-    update_display_name(message.author)
-
-    response = ""
-    if not args:
-        response = "Use `!party add <number>` to move a Pokémon from your collection into your party."
-    else:
-        action = args[0].lower()
-        if action == "add" and len(args) >= 2:
-            try:
-                index = int(args[1])
-            except ValueError:
-                response = "I couldn't understand that collection number."
-            else:
-                _, response = add_to_party(uid, index)
-        elif action in {"remove", "rm", "drop"} and len(args) >= 2:
-            try:
-                slot = int(args[1])
-            except ValueError:
-                response = "I couldn't understand that party slot."
-            else:
-                _, response = remove_from_party(uid, slot)
-        elif action == "swap" and len(args) >= 3:
-            try:
-                slot_a = int(args[1])
-                slot_b = int(args[2])
-            except ValueError:
-                response = "I couldn't understand one of those party slots."
+        await new_user(message.author)
+    # One load and one save, however many helpers touch the record.
+    add_index = None
+    async with USERS.transaction(uid):
+        await ensure_user_record(uid)
+        await update_display_name(message.author)
+
+        response = ""
+        page = 1
+        if not args:
+            response = "Use `!party add <number>` to move a Pokémon from your collection into your party."
+        else:
+            action = args[0].lower()
+            if action == "add" and len(args) >= 2:
+                try:
+                    index = int(args[1])
+                except ValueError:
+                    response = "I couldn't understand that collection number."
+                else:
+                    # Added after the commit, since it may withdraw from the PC box (see withdraw_pokemon()).
+                    add_index = index
+            elif action in {"remove", "rm", "drop"} and len(args) >= 2:
+                try:
+                    slot = int(args[1])
+                except ValueError:
+                    response = "I couldn't understand that party slot."
+                else:
+                    _, response = await remove_from_party(uid, slot)
+            elif action == "swap" and len(args) >= 3:
+                try:
+                    slot_a = int(args[1])
+                    slot_b = int(args[2])
+                except ValueError:
+                    response = "I couldn't understand one of those party slots."
+                else:
+                    _, response = await swap_party_members(uid, slot_a, slot_b)
+            elif action in {"auto", "fill"}:
+                _, response = await auto_fill_party(uid)
+            elif action == "page" and len(args) >= 2 and args[1].isdigit():
+                page = int(args[1])
             else:
-                _, response = swap_party_members(uid, slot_a, slot_b)
-        elif action in {"auto", "fill"}:
-            _, response = auto_fill_party(uid)
+                response = "Try `!party`, `!party add 3`, `!party remove 1`, `!party swap 1 3`, `!party auto`, or `!party page 2`."
+    if add_index is not None:
+        async with USERS.locked(uid):
+            _, response = await add_to_party(uid, add_index)
+
+    async def render(page):
+        party_members = await get_party_members(uid)
+        collection = await get_collection_page(uid, page, include_box=False)
+        return embeds.party(message.author, party_members, collection, note=response), collection
+
+    embed, collection = await render(page)
+    sent = await message.reply(embed=embed)
+    if collection.pages > 1:
+        await add_page_buttons(sent, uid, collection.page, render)
+
+
+def _parse_box_args(args: Sequence[str]) -> Tuple[Dict, Optional[str]]:
+    """Turn `!box` arguments into get_collection_page() options, or an error message."""
+    options: Dict = {}
+    for token in args:
+        lowered = token.lower()
+        if lowered.isdigit():
+            options["page"] = int(lowered)
+        elif lowered == "shiny":
+            options["shiny"] = True
+        elif lowered in COLLECTION_SORTS:
+            options["sort"] = lowered
+        elif lowered.startswith("lv") and lowered[2:].isdigit():
+            options["min_level"] = int(lowered[2:])
         else:
-            response = "Try `!party`, `!party add 3`, `!party remove 1`, `!party swap 1 3`, or `!party auto`."
+            spec = classes.find_species(token)
+            if not spec:
+                return options, f"I don't know a Pokémon or option called \"{token}\"."
+            options["species"] = spec.pokedex_number
+    return options, None
+
 
-    party_members = get_party_members(uid)
-    roster_members = [mon for _, mon in roster_with_ids(uid)]
-    embed = embeds.party(message.author, party_members, roster_members, note=response)
-    await message.reply(embed=embed)
+async def box_command(message, args: Sequence[str]):
+    """Browse the whole collection a page at a time, e.g. `!box 2`, `!box shiny level`, `!box pikachu lv20`."""
+    uid = message.author.id
+    if uid not in USERS:
+        await new_user(message.author)
+    await ensure_user_record(uid)
+    await update_display_name(message.author)
+
+    options, error = _parse_box_args(args)
+    if error:
+        await message.reply(error)
+        return
+    page = options.pop("page", 1)
+
+    async def render(page):
+        collection = await get_collection_page(uid, page, **options)
+        return embeds.box(message.author, collection, options), collection
+
+    embed, collection = await render(page)
+    sent = await message.reply(embed=embed)
+    if collection.pages > 1:
+        await add_page_buttons(sent, uid, collection.page, render)
 
 
 async def profile(message):
     """Show a profile, making a new user if needed."""
     new = False
     if message.author.id not in USERS:
-        new_user(message.author)
+        await new_user(message.author)
         new = True
-    ensure_user_record(message.author.id)
-    update_display_name(message.author)
+    await ensure_user_record(message.author.id)
+    await update_display_name(message.author)
     tosay = "Welcome to the community!" if new else ""
-    await message.reply(tosay, embed=embeds.profile(message.author))
+    party_members = await get_party_members(message.author.id)
+    collection = await get_collection_page(message.author.id, include_box=False)
+    await message.reply(tosay, embed=embeds.profile(message.author, party_members, collection))
 
 
-def new_user(user) -> None:
+async def new_user(user) -> None:
     # Possibly using a class in addition to this
     # might help with if i ever must change the user struct?
     u = {}
@@ -422,9 +688,15 @@ def new_user(user) -> None:
     u["items"] = {"pokeball": 5}
 
     u["pokemon"] = []
+    u["roster_index"] = {}
     u["party"] = []
 
-    u["battles"] = []
+    u["battle_stats"] = user_schema.empty_battle_stats()
 
-    USERS[user.id] = u
-    USERS.save_item(user.id)
+    u["schema_version"] = user_schema.SCHEMA_VERSION
+
+    async with USERS.locked(user.id):
+        # Two first messages at once would otherwise both make a record.
+        if user.id in USERS:
+            return
+        await USERS.aput(user.id, u)